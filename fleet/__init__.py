@@ -2,19 +2,37 @@ from .direction import Direction
 from .inventory import Inventory, InventorySlot
 from .state_file import (
     StateAttr,
+    SideFileStateAttr,
     StateFile,
     StateNotAcquiredError,
     PromptStateAttr
 )
 from .serializable import *
+from . import runtime
+from .macros import ColumnStop, ColumnResult
+from .scheduler import Scheduler, TokenBucket, Backoff
 from .stateful_turtle import (
     StatefulTurtle,
     StepFinished,
     StateRecoveryError,
     MinedBlacklistedBlockError
 )
-from .turtle_astar import astar
-from .navigation_turtle import NavigationTurtle
+from .turtle_astar import (
+    astar,
+    Bounds,
+    PathResult,
+    PathStatus,
+    UnreachableCache
+)
+from .incremental_planner import IncrementalPlanner
+from .distance_field import DistanceField
+from .hierarchical_planner import HierarchicalPlanner
+from .planner_service import MapSnapshot, PlannerService
+from .navigation_turtle import (
+    NavigationTurtle,
+    UnreachableGoalError,
+    PathBudgetExhaustedError
+)
 from . import block_info
 from . import routines
 from . import math_utils
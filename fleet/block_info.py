@@ -20,3 +20,24 @@ def name_matches_regexes(block_name: Union[bytes, str], regex_list: List[str]):
     if isinstance(block_name, bytes):
         block_name = str(block_name, encoding="utf-8")
     return re.match(combined_regex, block_name)
+
+
+_LUA_PATTERN_ESCAPES = {"-": "%-", r"\.": "%."}
+_TRANSLATABLE = re.compile(r"(?:[\w:\-.*]|\\\.)*")
+
+
+def as_lua_patterns(regex_list: List[str]) -> List[str]:
+    """Translate a list of regexes into Lua patterns that match the same
+    block names, for checking them on the turtle itself. Only the subset of
+    regex that both languages agree on is supported, which is enough for the
+    lists in this module: literal names along with '.', '.*' and '\\.'.
+    """
+    patterns = []
+    for regex in regex_list:
+        if not _TRANSLATABLE.fullmatch(regex):
+            raise ValueError(f"The regex {regex!r} can't be run in Lua!")
+        pattern = re.sub(r"-|\\\.", lambda m: _LUA_PATTERN_ESCAPES[m[0]],
+                         regex)
+        # re.match() only matches at the start of the name
+        patterns.append("^" + pattern)
+    return patterns
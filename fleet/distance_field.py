@@ -0,0 +1,211 @@
+from heapq import heappush, heappop
+from math import inf
+from typing import Sequence, Tuple, Optional, Dict, Set, Iterable
+
+from fleet.math_utils import (
+    NEIGHBOR_KEY_OFFSETS,
+    KEY_BITS,
+    pack_position,
+    unpack_position
+)
+from fleet.turtle_astar import Bounds
+from fleet import Map
+
+_MASK = (1 << KEY_BITS) - 1
+
+
+class DistanceField:
+    """The cost of the cheapest path to a single fixed position (such as a
+    fuel chest) from every position within a bounded region, along with the
+    first step of that path. Once built, both are O(1) lookups, so trips to
+    the same position don't need a search each.
+
+    When obstacles change, only the positions whose paths went through a
+    changed voxel are recomputed, along with anything that got cheaper.
+
+    Costs are the same as in astar() with an e_admissibility of 1, except
+    that paths never leave the bounds.
+
+    Usage:
+        field = DistanceField(fuel_loc, bounds, map, obstacle_cost=10)
+        # Then, whenever it's needed
+        field.update(map)
+        next_pos = field.next_position(map.position)
+    """
+
+    def __init__(self, to_pos: Sequence[int],
+                 bounds: Bounds,
+                 map: Map,
+                 obstacle_cost: float = 10):
+        self.to_pos = tuple(int(axis) for axis in to_pos)
+        corner1, corner2 = bounds
+        self.bounds: Bounds = (
+            tuple(int(min(a, b)) for a, b in zip(corner1, corner2)),
+            tuple(int(max(a, b)) for a, b in zip(corner1, corner2)))
+        self.obstacle_cost = obstacle_cost
+
+        self.expansions = 0
+        """How many positions have been expanded, over the field's lifetime"""
+
+        self._min_axes = _axes(pack_position(self.bounds[0]))
+        self._max_axes = _axes(pack_position(self.bounds[1]))
+        self._goal = pack_position(to_pos)
+        if not self._in_bounds(self._goal):
+            raise ValueError(f"{self.to_pos} is outside of the bounds "
+                             f"{self.bounds}!")
+
+        self._is_obstacle = map.obstacle_key_lookup()
+        self._map_version = map.version
+
+        self._distances: Dict[int, float] = {}
+        self._next: Dict[int, int] = {}
+        """The next step toward the goal, from every reachable position"""
+        self._children: Dict[int, Set[int]] = {}
+        """The inverse of self._next, for finding every position whose path
+        runs through a given position"""
+        self._rebuild()
+
+    def __repr__(self):
+        return f"DistanceField(to_pos={self.to_pos}, bounds={self.bounds}, " \
+               f"reachable={len(self._distances)})"
+
+    def is_for(self, to_pos: Sequence[int], obstacle_cost: float) -> bool:
+        """Returns True if this field can be used for the given trip"""
+        return (self.to_pos == tuple(int(axis) for axis in to_pos)
+                and self.obstacle_cost == obstacle_cost)
+
+    def covers(self, position: Sequence[int]) -> bool:
+        """Returns True if the position is within the field's bounds"""
+        return self._in_bounds(pack_position(position))
+
+    def distance(self, position: Sequence[int]) -> float:
+        """The cost of the cheapest path from position to the goal, or inf if
+        there is none within the bounds"""
+        return self._distances.get(pack_position(position), inf)
+
+    def next_position(self, position: Sequence[int]) \
+            -> Optional[Tuple[int, int, int]]:
+        """The first step of the cheapest path from position to the goal, or
+        None if position is the goal, or has no path within the bounds"""
+        next_key = self._next.get(pack_position(position))
+        return None if next_key is None else unpack_position(next_key)
+
+    def update(self, map: Map):
+        """Catch up with any obstacle changes in the map"""
+        changes = map.changes_since(self._map_version)
+        self._is_obstacle = map.obstacle_key_lookup()
+        self._map_version = map.version
+        if changes is None:
+            self._rebuild()
+            return
+
+        changed = {key for key in changes if self._in_bounds(key)}
+        if not changed:
+            return
+
+        # A changed voxel changes the cost of every edge touching it, so any
+        # path through it may have gotten more expensive. Forget every
+        # position whose path used one of those edges.
+        goal = self._goal
+        stack = []
+        for key in changed:
+            if key == goal:
+                stack.extend(self._children.get(goal, ()))
+            elif key in self._distances:
+                stack.append(key)
+        invalidated = set()
+        while stack:
+            key = stack.pop()
+            if key in invalidated:
+                continue
+            invalidated.add(key)
+            stack.extend(self._children.get(key, ()))
+        for key in invalidated:
+            del self._distances[key]
+            self._children[self._next.pop(key)].discard(key)
+
+        # Then re-seed those positions, along with the neighbors of changed
+        # voxels (whose paths may have gotten cheaper), from whatever
+        # neighbors still have a valid distance
+        seeds = invalidated | changed
+        for key in changed:
+            seeds.update(self._neighbors(key))
+        seeds.discard(goal)
+
+        queue = []
+        for key in seeds:
+            best, best_neighbor = self._distances.get(key, inf), None
+            for neighbor in self._neighbors(key):
+                distance = (self._distances.get(neighbor, inf)
+                            + self._cost(key, neighbor))
+                if distance < best:
+                    best, best_neighbor = distance, neighbor
+            if best_neighbor is not None:
+                self._set(key, best, best_neighbor)
+                heappush(queue, (best, key))
+        self._propagate(queue)
+
+    def _rebuild(self):
+        self._distances = {self._goal: 0}
+        self._next = {}
+        self._children = {}
+        self._propagate([(0, self._goal)])
+
+    def _propagate(self, queue):
+        """Dijkstra outward from every position in the queue"""
+        distances = self._distances
+        is_obstacle = self._is_obstacle
+        neighbors = self._neighbors
+        obstacle_cost = self.obstacle_cost
+        while queue:
+            distance, key = heappop(queue)
+            if distance > distances.get(key, inf):
+                continue
+            self.expansions += 1
+            blocked = is_obstacle(key)
+            for neighbor in neighbors(key):
+                neighbor_distance = distance + (
+                    obstacle_cost if blocked or is_obstacle(neighbor) else 1)
+                if neighbor_distance < distances.get(neighbor, inf):
+                    self._set(neighbor, neighbor_distance, key)
+                    heappush(queue, (neighbor_distance, neighbor))
+
+    def _set(self, key: int, distance: float, next_key: int):
+        self._distances[key] = distance
+        previous = self._next.get(key)
+        if previous is not None:
+            self._children[previous].discard(key)
+        self._next[key] = next_key
+        children = self._children.get(next_key)
+        if children is None:
+            children = self._children[next_key] = set()
+        children.add(key)
+
+    def _cost(self, a: int, b: int) -> float:
+        if self._is_obstacle(a) or self._is_obstacle(b):
+            return self.obstacle_cost
+        return 1
+
+    def _neighbors(self, key: int) -> Iterable[int]:
+        """Every neighbor of a position within the bounds, assuming the
+        position itself is within them"""
+        x, y, z = _axes(key)
+        min_x, min_y, min_z = self._min_axes
+        max_x, max_y, max_z = self._max_axes
+        allowed = (x < max_x, y < max_y, z < max_z,
+                   x > min_x, y > min_y, z > min_z)
+        return [key + offset for offset, neighbor_allowed
+                in zip(NEIGHBOR_KEY_OFFSETS, allowed) if neighbor_allowed]
+
+    def _in_bounds(self, key: int) -> bool:
+        return all(low <= axis <= high for low, axis, high
+                   in zip(self._min_axes, _axes(key), self._max_axes))
+
+
+def _axes(key: int) -> Tuple[int, int, int]:
+    """Unpack a key into its axes, without shifting them back into world
+    coordinates, which is fine for comparisons"""
+    return key >> (KEY_BITS * 2), key >> KEY_BITS & _MASK, key & _MASK
+
+
+__all__ = ["DistanceField"]
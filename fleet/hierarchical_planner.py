@@ -0,0 +1,349 @@
+from functools import lru_cache
+from heapq import heappush, heappop
+from math import inf
+from typing import Sequence, List, Tuple, Dict, Optional
+
+from fleet.math_utils import pack_position, unpack_position
+from fleet.turtle_astar import astar, PathResult, PathStatus
+from fleet import Map
+
+ChunkCoord = Tuple[int, int, int]
+
+_UNIT_VECTORS = ((1, 0, 0), (0, 1, 0), (0, 0, 1))
+
+
+class HierarchicalPlanner:
+    """Plans long trips HPA* style. The world is split into CLUSTER_SIZE**3
+    clusters, and every face between two clusters gets a single portal: a pair
+    of blocks, one on either side of the face. Searching from portal to portal
+    only takes a handful of nodes per cluster crossed, instead of every block
+    along the way.
+
+    The cost of getting between two portals of a cluster is found with a small
+    astar() search confined to that cluster, and is cached until an obstacle
+    within (or next to) the cluster changes. Only the route through the
+    turtle's own cluster and the next one is refined into a block-level path,
+    and plan() returns the part of it that leads out of the turtle's cluster.
+    Following that and planning again continues the trip.
+
+    Trips shorter than min_distance are planned with a plain astar() search.
+
+    Usage:
+        planner = HierarchicalPlanner(e_admissibility=1.1, obstacle_cost=10)
+        path, obstructed = planner.plan(map.position, to_pos, map)
+    """
+    CLUSTER_BITS = 4
+    CLUSTER_SIZE = 1 << CLUSTER_BITS
+
+    ABSTRACT_HEURISTIC_WEIGHT = 1.5
+    """Routes through portals are a little longer than the manhattan distance,
+    since they have to pass through the middle of cluster faces. Left
+    unweighted, the search over portals floods most of the area around the
+    route before settling for the detour. Only the first leg of the route is
+    ever followed before planning again, so a greedier search costs little in
+    path quality."""
+
+    MAX_ABSTRACT_EXPANSIONS = 5000
+    """How many portals a single search may expand before giving up and
+    falling back to astar()"""
+
+    def __init__(self, e_admissibility: float,
+                 obstacle_cost: float,
+                 min_distance: int = CLUSTER_SIZE * 2):
+        """
+        :param e_admissibility: As in astar()
+        :param obstacle_cost: As in astar()
+        :param min_distance: Trips with a manhattan distance shorter than this
+        are planned with a plain astar() search
+        """
+        self.e_admissibility = e_admissibility
+        self.obstacle_cost = obstacle_cost
+        self.min_distance = min_distance
+
+        self._free_cost = 1 / e_admissibility
+        self._map_version: Optional[int] = None
+
+        self._portals: Dict[ChunkCoord, Dict[int, int]] = {}
+        """For each cluster, maps the cluster's side of each of its portals to
+        the block just across the face"""
+        self._costs: Dict[ChunkCoord, Dict[Tuple[int, int], float]] = {}
+        """For each cluster, the cost of travelling between two of its
+        portals, keyed by the pair of portals in ascending order"""
+
+    def is_planning(self, e_admissibility: float,
+                    obstacle_cost: float) -> bool:
+        """Returns True if this planner's caches are valid for the given
+        search"""
+        return (self.e_admissibility == e_admissibility
+                and self.obstacle_cost == obstacle_cost)
+
+    def plan(self, from_pos: Sequence[int], to_pos: Sequence[int],
+             map: Map) -> PathResult:
+        """Plan a path toward to_pos. For long trips, the path stops once it
+        leaves the cluster that from_pos is in, and the result's status is
+        PathStatus.partial."""
+        from_pos = tuple(int(axis) for axis in from_pos)
+        to_pos = tuple(int(axis) for axis in to_pos)
+        distance = sum(abs(a - b) for a, b in zip(from_pos, to_pos))
+        start_cluster = self._cluster_of(from_pos)
+        goal_cluster = self._cluster_of(to_pos)
+        if distance < self.min_distance or start_cluster == goal_cluster:
+            return self._astar(from_pos, to_pos, map)
+
+        self._catch_up(map)
+        route, expansions = self._abstract_search(
+            pack_position(from_pos), pack_position(to_pos), map)
+        if route is None:
+            return self._astar(from_pos, to_pos, map)
+
+        # Refine the route into blocks as far as the cluster after the start
+        # cluster, but only keep the path until it leaves the start cluster.
+        # Looking a cluster ahead lets the path cross into the next cluster
+        # wherever is best, rather than through the middle of the face.
+        next_cluster = self._cluster_of_key(route[-1])
+        for key in route:
+            if self._cluster_of_key(key) != start_cluster:
+                next_cluster = self._cluster_of_key(key)
+                break
+        waypoint = route[0]
+        for key in route:
+            if self._cluster_of_key(key) not in (start_cluster, next_cluster):
+                break
+            waypoint = key
+
+        start_low, start_high = self._cluster_bounds(start_cluster)
+        next_low, next_high = self._cluster_bounds(next_cluster)
+        bounds = (tuple(min(a, b) for a, b in zip(start_low, next_low)),
+                  tuple(max(a, b) for a, b in zip(start_high, next_high)))
+        leg = self._astar(from_pos, unpack_position(waypoint), map,
+                          bounds=bounds)
+        expansions += leg.expansions
+
+        path = []
+        for position in leg.path:
+            path.append(position)
+            if self._cluster_of(position) != start_cluster:
+                break
+
+        status = (PathStatus.found if path[-1] == to_pos
+                  else PathStatus.partial)
+        obstructed = any(map.is_known_obstacle(position)
+                         for position in path)
+        return PathResult(path=path, obstructed=obstructed, status=status,
+                          expansions=expansions)
+
+    def _abstract_search(self, start: int, goal: int, map: Map) \
+            -> Tuple[Optional[List[int]], int]:
+        """A* over portals. Returns the keys along the cheapest route from
+        start to goal, or None if the search gave up.
+
+        Finding the cost of a leg within a cluster takes a search of its own,
+        so legs are first queued with a lower bound of their cost, and their
+        actual cost is only found once they're popped. Most legs never are.
+        """
+        goal_cluster = self._cluster_of_key(goal)
+        goal_axes = unpack_position(goal)
+        free_cost = self._free_cost
+        weight = self.ABSTRACT_HEURISTIC_WEIGHT
+
+        def h(key):
+            return weight * sum(
+                abs(a - b) for a, b in zip(unpack_position(key), goal_axes))
+
+        g_scores = {start: 0}
+        came_from = {start: None}
+        closed = set()
+        counter = 0
+        # Entries are (f, counter, node, parent, g), where g is None if the
+        # cost of the leg from parent to node is still just a lower bound
+        queue = [(0, counter, start, None, 0)]
+        while queue:
+            _, _, current, parent, current_g = heappop(queue)
+            if current in closed:
+                continue
+            if current_g is None:
+                current_g = g_scores[parent] + self._leg_cost(
+                    parent, current, map)
+                if current_g < g_scores.get(current, inf):
+                    g_scores[current] = current_g
+                    came_from[current] = parent
+                    counter += 1
+                    heappush(queue, (current_g + h(current), counter,
+                                     current, parent, current_g))
+                continue
+            if current_g > g_scores[current]:
+                continue
+            if current == goal:
+                break
+            if len(closed) >= self.MAX_ABSTRACT_EXPANSIONS:
+                return None, len(closed)
+            closed.add(current)
+
+            for neighbor, step_cost in self._edges(current, goal,
+                                                   goal_cluster, map):
+                if neighbor in closed:
+                    continue
+                counter += 1
+                if step_cost is None:
+                    distance = sum(abs(a - b) for a, b in zip(
+                        unpack_position(current), unpack_position(neighbor)))
+                    heappush(queue, (current_g + distance * free_cost
+                                     + h(neighbor), counter, neighbor,
+                                     current, None))
+                    continue
+                g = current_g + step_cost
+                if g < g_scores.get(neighbor, inf):
+                    g_scores[neighbor] = g
+                    came_from[neighbor] = current
+                    heappush(queue, (g + h(neighbor), counter, neighbor,
+                                     current, g))
+        else:
+            return None, len(closed)
+
+        route = []
+        node = goal
+        while node is not None:
+            route.append(node)
+            node = came_from[node]
+        route.reverse()
+        return route, len(closed)
+
+    def _edges(self, node: int, goal: int, goal_cluster: ChunkCoord,
+               map: Map) -> List[Tuple[int, Optional[float]]]:
+        """Every abstract edge leaving a node, along with its cost. Legs
+        within the node's cluster have a cost of None, since they're
+        expensive to find."""
+        cluster = self._cluster_of_key(node)
+        portals = self._cluster_portals(cluster, map)
+
+        edges = [(target, None) for target in portals if target != node]
+        if cluster == goal_cluster and goal != node:
+            edges.append((goal, None))
+        across = portals.get(node)
+        if across is not None:
+            edges.append((across, self._step_cost(node, across, map)))
+        return edges
+
+    def _leg_cost(self, a: int, b: int, map: Map) -> float:
+        """The cost of getting from a to b without leaving their cluster.
+        Costs between two portals are cached, but the start and goal change
+        from trip to trip, so legs to or from them aren't."""
+        cluster = self._cluster_of_key(a)
+        portals = self._cluster_portals(cluster, map)
+        if a not in portals or b not in portals:
+            return self._search_leg_cost(a, b, cluster, map)
+
+        costs = self._costs.setdefault(cluster, {})
+        leg = (a, b) if a < b else (b, a)
+        cost = costs.get(leg)
+        if cost is None:
+            cost = costs[leg] = self._search_leg_cost(a, b, cluster, map)
+        return cost
+
+    def _search_leg_cost(self, a: int, b: int, cluster: ChunkCoord,
+                         map: Map) -> float:
+        result = self._astar(unpack_position(a), unpack_position(b), map,
+                             bounds=self._cluster_bounds(cluster))
+        if result.status is not PathStatus.found:
+            return inf
+        keys = [pack_position(position) for position in result.path]
+        return sum(self._step_cost(key, next_key, map)
+                   for key, next_key in zip(keys, keys[1:]))
+
+    def _step_cost(self, a: int, b: int, map: Map) -> float:
+        if map.is_known_obstacle_key(a) or map.is_known_obstacle_key(b):
+            return self.obstacle_cost
+        return self._free_cost
+
+    def _cluster_portals(self, cluster: ChunkCoord, map: Map) \
+            -> Dict[int, int]:
+        portals = self._portals.get(cluster)
+        if portals is not None:
+            return portals
+
+        portals = {}
+        for unit in _UNIT_VECTORS:
+            inside, outside = self._face_portal(cluster, unit, map)
+            portals[inside] = outside
+            neighbor = tuple(c - u for c, u in zip(cluster, unit))
+            outside, inside = self._face_portal(neighbor, unit, map)
+            portals[inside] = outside
+        self._portals[cluster] = portals
+        return portals
+
+    def _face_portal(self, cluster: ChunkCoord, unit: Tuple[int, int, int],
+                     map: Map) -> Tuple[int, int]:
+        """Pick the portal across the face between cluster and the cluster
+        in the direction of unit. Returns (the block on the cluster's side,
+        the block across the face). The free pair of blocks closest to the
+        center of the face is picked, if there is one."""
+        axis = unit.index(1)
+        other_axes = [a for a in range(3) if a != axis]
+        origin = [c * self.CLUSTER_SIZE for c in cluster]
+        origin[axis] += self.CLUSTER_SIZE - 1
+
+        is_obstacle = map.obstacle_key_lookup()
+        pair = None
+        for u, v in _face_order(self.CLUSTER_SIZE):
+            inside = list(origin)
+            inside[other_axes[0]] += u
+            inside[other_axes[1]] += v
+            outside = list(inside)
+            outside[axis] += 1
+            candidate = (pack_position(inside), pack_position(outside))
+            if pair is None:
+                pair = candidate
+            if not (is_obstacle(candidate[0]) or is_obstacle(candidate[1])):
+                return candidate
+        return pair
+
+    def _catch_up(self, map: Map):
+        """Evict every cluster whose portals or costs might be stale"""
+        if self._map_version == map.version:
+            return
+        changes = (None if self._map_version is None
+                   else map.changes_since(self._map_version))
+        self._map_version = map.version
+        if changes is None:
+            self._portals.clear()
+            self._costs.clear()
+            return
+
+        for cluster in {self._cluster_of_key(key) for key in changes}:
+            # Portals on a cluster's faces also depend on the blocks in the
+            # neighboring clusters
+            for offset in ((0, 0, 0),) + _UNIT_VECTORS + tuple(
+                    tuple(-c for c in unit) for unit in _UNIT_VECTORS):
+                stale = tuple(c + o for c, o in zip(cluster, offset))
+                self._portals.pop(stale, None)
+                self._costs.pop(stale, None)
+
+    def _astar(self, from_pos, to_pos, map: Map, bounds=None) -> PathResult:
+        return astar(from_pos=from_pos,
+                     to_pos=to_pos,
+                     map=map,
+                     e_admissibility=self.e_admissibility,
+                     obstacle_cost=self.obstacle_cost,
+                     bounds=bounds)
+
+    def _cluster_bounds(self, cluster: ChunkCoord):
+        low = tuple(c * self.CLUSTER_SIZE for c in cluster)
+        return low, tuple(c + self.CLUSTER_SIZE - 1 for c in low)
+
+    def _cluster_of(self, position: Sequence[int]) -> ChunkCoord:
+        return tuple(int(axis) >> self.CLUSTER_BITS for axis in position)
+
+    def _cluster_of_key(self, key: int) -> ChunkCoord:
+        return self._cluster_of(unpack_position(key))
+
+
+@lru_cache(maxsize=None)
+def _face_order(size: int) -> List[Tuple[int, int]]:
+    """Every (u, v) on a face, closest to the face's center first"""
+    center = (size - 1) / 2
+    return sorted(((u, v) for u in range(size) for v in range(size)),
+                  key=lambda uv: (abs(uv[0] - center) + abs(uv[1] - center),
+                                  uv))
+
+
+__all__ = ["HierarchicalPlanner"]
@@ -0,0 +1,224 @@
+from heapq import heappush, heappop
+from math import inf
+from typing import Sequence, List, Tuple, Optional
+
+from fleet.math_utils import (
+    NEIGHBOR_KEY_OFFSETS,
+    KEY_BITS,
+    pack_position,
+    unpack_position
+)
+from fleet import Map
+
+_MASK = (1 << KEY_BITS) - 1
+
+
+class IncrementalPlanner:
+    """Plans a path to a single goal using D* Lite, which searches backwards
+    from the goal and keeps its search tree between calls. When the turtle
+    moves, or when obstacles are added to or removed from the map, only the
+    part of the tree that the change affects is repaired, instead of
+    searching from scratch.
+
+    Costs are the same as in astar(). Unlike astar(), the heuristic is never
+    inflated past the cheapest move, because D* Lite can only repair its tree
+    cheaply as the turtle moves if the heuristic is consistent. Paths are
+    therefore always the cheapest ones, and e_admissibility only sets the
+    cost of free moves relative to obstacle_cost.
+
+    Usage:
+        planner = IncrementalPlanner(map.position, to_pos, map, 1.1, 10)
+        # Then, every step
+        if planner.update(map):
+            next_pos = planner.next_position()
+    """
+
+    def __init__(self, from_pos: Sequence[int],
+                 to_pos: Sequence[int],
+                 map: Map,
+                 e_admissibility: float,
+                 obstacle_cost: float):
+        self.to_pos = tuple(int(axis) for axis in to_pos)
+        self.e_admissibility = e_admissibility
+        self.obstacle_cost = obstacle_cost
+
+        self.expansions = 0
+        """How many nodes have been expanded, over the planner's lifetime"""
+
+        self._free_cost = 1 / e_admissibility
+        self._h_scale = min(self._free_cost, obstacle_cost)
+        self._goal = pack_position(to_pos)
+        self._start = self._last_start = pack_position(from_pos)
+        self._start_axes = _axes(self._start)
+        self._is_obstacle = map.obstacle_key_lookup()
+        self._map_version = map.version
+
+        self._blocked = {}
+        """A cache of whether each voxel the search touched is an obstacle.
+        Voxels that change in the map are evicted upon update()."""
+
+        self._km = 0
+        """Accumulated heuristic offset from the start moving, which keeps
+        old queue keys valid lower bounds without re-keying the queue"""
+
+        self._g = {}
+        self._rhs = {self._goal: 0}
+        self._queue = []
+        self._queued = {}
+        """The current key of every node in the queue. Heap entries that
+        don't match it are stale and are skipped when popped."""
+        self._push(self._goal)
+
+    def is_planning(self, to_pos: Sequence[int], e_admissibility: float,
+                    obstacle_cost: float) -> bool:
+        """Returns True if this planner can be reused for the given search"""
+        return (self.to_pos == tuple(int(axis) for axis in to_pos)
+                and self.e_admissibility == e_admissibility
+                and self.obstacle_cost == obstacle_cost)
+
+    def update(self, map: Map) -> bool:
+        """Catch up with the turtle's position and with any obstacle changes
+        in the map. Returns False if the map has changed too much since the
+        last update to be repaired, in which case a new planner is needed."""
+        changes = map.changes_since(self._map_version)
+        if changes is None:
+            return False
+        self._is_obstacle = map.obstacle_key_lookup()
+        self._map_version = map.version
+
+        start = pack_position(map.position)
+        if start != self._start:
+            self._km += self._h(self._last_start, start)
+            self._last_start = self._start = start
+            self._start_axes = _axes(start)
+
+        # A changed voxel changes the cost of every edge touching it
+        for key in set(changes):
+            self._blocked.pop(key, None)
+        for key in set(changes):
+            self._update_vertex(key)
+            for offset in NEIGHBOR_KEY_OFFSETS:
+                self._update_vertex(key + offset)
+        return True
+
+    def next_position(self) -> Optional[Tuple[int, int, int]]:
+        """Return the next position along the cheapest path from the turtle's
+        position, or None if it's already at the goal"""
+        if self._start == self._goal:
+            return None
+        self._compute_shortest_path()
+        return unpack_position(self._best_neighbor(self._start))
+
+    def path(self) -> List[Tuple[int, int, int]]:
+        """Return the whole path from the turtle's position to the goal"""
+        self._compute_shortest_path()
+        path = [self._start]
+        seen = {self._start}
+        while path[-1] != self._goal:
+            node = self._best_neighbor(path[-1])
+            if node in seen:
+                raise RuntimeError("The search tree has a loop in it!")
+            seen.add(node)
+            path.append(node)
+        return [unpack_position(key) for key in path]
+
+    def _best_neighbor(self, node: int) -> int:
+        g = self._g
+        cost = self._cost
+        return min((node + offset for offset in NEIGHBOR_KEY_OFFSETS),
+                   key=lambda neighbor: cost(node, neighbor)
+                   + g.get(neighbor, inf))
+
+    def _h(self, a: int, b: int) -> int:
+        """The manhattan distance between two keys"""
+        return self._h_scale * sum(
+            abs(i - j) for i, j in zip(_axes(a), _axes(b)))
+
+    def _is_blocked(self, node: int) -> bool:
+        blocked = self._blocked.get(node)
+        if blocked is None:
+            blocked = self._blocked[node] = self._is_obstacle(node)
+        return blocked
+
+    def _cost(self, a: int, b: int) -> float:
+        if self._is_blocked(a) or self._is_blocked(b):
+            return self.obstacle_cost
+        return self._free_cost
+
+    def _key(self, node: int) -> Tuple[float, float]:
+        g = min(self._g.get(node, inf), self._rhs.get(node, inf))
+        start_x, start_y, start_z = self._start_axes
+        h = (abs((node >> (KEY_BITS * 2)) - start_x)
+             + abs((node >> KEY_BITS & _MASK) - start_y)
+             + abs((node & _MASK) - start_z))
+        return g + h * self._h_scale + self._km, g
+
+    def _push(self, node: int):
+        key = self._key(node)
+        self._queued[node] = key
+        heappush(self._queue, (key, node))
+
+    def _update_vertex(self, node: int):
+        g = self._g
+        if node != self._goal:
+            is_blocked = self._is_blocked
+            if is_blocked(node):
+                self._rhs[node] = self.obstacle_cost + min(
+                    g.get(node + offset, inf)
+                    for offset in NEIGHBOR_KEY_OFFSETS)
+            else:
+                obstacle_cost, free_cost = self.obstacle_cost, self._free_cost
+                self._rhs[node] = min(
+                    (obstacle_cost if is_blocked(node + offset)
+                     else free_cost) + g.get(node + offset, inf)
+                    for offset in NEIGHBOR_KEY_OFFSETS)
+
+        if g.get(node, inf) != self._rhs.get(node, inf):
+            self._push(node)
+        else:
+            self._queued.pop(node, None)
+
+    def _compute_shortest_path(self):
+        queue, queued, g, rhs = self._queue, self._queued, self._g, self._rhs
+        start = self._start
+        update_vertex = self._update_vertex
+
+        while queue:
+            key, node = queue[0]
+            if queued.get(node) != key:
+                heappop(queue)
+                continue
+
+            # The start's heuristic to itself is 0, so its key is simple
+            start_g, start_rhs = g.get(start, inf), rhs.get(start, inf)
+            start_g_min = min(start_g, start_rhs)
+            if (key >= (start_g_min + self._km, start_g_min)
+                    and start_g == start_rhs):
+                break
+
+            heappop(queue)
+            self.expansions += 1
+            new_key = self._key(node)
+            if key < new_key:
+                queued[node] = new_key
+                heappush(queue, (new_key, node))
+                continue
+            del queued[node]
+
+            node_rhs = rhs.get(node, inf)
+            if g.get(node, inf) > node_rhs:
+                g[node] = node_rhs
+            else:
+                g.pop(node, None)
+                update_vertex(node)
+            for offset in NEIGHBOR_KEY_OFFSETS:
+                update_vertex(node + offset)
+
+
+def _axes(key: int) -> Tuple[int, int, int]:
+    """Unpack a key into its axes, without shifting them back into world
+    coordinates, which is fine for distances"""
+    return key >> (KEY_BITS * 2), key >> KEY_BITS & _MASK, key & _MASK
+
+
+__all__ = ["IncrementalPlanner"]
@@ -2,8 +2,6 @@ from typing import Dict, List, Optional
 
 from dataclasses import dataclass
 
-from cc import turtle
-
 from fleet import lua_errors
 
 @dataclass
@@ -25,14 +23,25 @@ class InventorySlot:
     name: Optional[str] = None
     """The block name"""
 
-    def refresh(self):
-        """Refresh information for this slot"""
+    def refresh(self, batch: Optional[lua_errors.Batch] = None):
+        """Refresh information for this slot, in a single round trip. If a
+        batch is given, the refresh is queued on it instead, and happens once
+        the batch runs."""
+        if batch is None:
+            with lua_errors.Batch() as batch:
+                self.refresh(batch)
+            return
+
+        block_info = batch.call("getItemDetail", self.slot_id)
+        count = batch.call("getItemCount", self.slot_id)
 
-        block_info = lua_errors.run(turtle.getItemDetail, self.slot_id)
-        self.name = (str(block_info[b"name"], encoding="ascii")
-                     if block_info else None)
-        self.count = lua_errors.run(turtle.getItemCount, self.slot_id)
-        self.confirmed = True
+        def update():
+            self.name = (str(block_info.result[b"name"], encoding="ascii")
+                         if block_info.result else None)
+            self.count = count.result
+            self.confirmed = True
+
+        batch.after(update)
 
 
 class Inventory:
@@ -55,17 +64,26 @@ class Inventory:
 
     @classmethod
     def from_turtle(cls, selected_slot) -> "Inventory":
-        lua_errors.run(turtle.select, selected_slot)
-        return cls(slots=cls.generate_slots(), selected_slot=selected_slot)
+        with lua_errors.Batch() as batch:
+            batch.call("select", selected_slot)
+            slots = cls.generate_slots(batch)
+        return cls(slots=slots, selected_slot=selected_slot)
 
     @classmethod
-    def generate_slots(cls):
+    def generate_slots(cls, batch: Optional[lua_errors.Batch] = None):
+        """Create every slot, refreshed with the correct values in a single
+        round trip. If a batch is given, the refreshes are queued on it
+        instead, and the slots are only filled in once the batch runs."""
+        if batch is None:
+            with lua_errors.Batch() as batch:
+                slots = cls.generate_slots(batch)
+            return slots
+
         slots = []
         for slot_id in range(1, 17):
             slot = InventorySlot(slot_id=slot_id)
             slots.append(slot)
-            # Initialize the slot with correct values
-            slot.refresh()
+            slot.refresh(batch)
         return slots
 
     def __iter__(self):
@@ -78,7 +96,29 @@ class Inventory:
 
     def mark_all_slots_unconfirmed(self):
         """This should be done after any digging or 'suck' operation, since the
-        item could have gone anywhere in the inventory
+        item could have gone anywhere in the inventory. Use confirmed_slot()
+        to re-sync once an exact count is actually needed.
         """
         for slot in self:
             slot.confirmed = False
+
+    def refresh_all(self, batch: Optional[lua_errors.Batch] = None):
+        """Refresh every slot in a single round trip. If a batch is given, the
+        refreshes are queued on it instead, and happen once the batch runs."""
+        if batch is None:
+            with lua_errors.Batch() as batch:
+                self.refresh_all(batch)
+            return
+
+        for slot in self:
+            slot.refresh(batch)
+
+    def confirmed_slot(self, slot_id) -> InventorySlot:
+        """Return the slot, making sure that its count is exact. If it isn't
+        confirmed, every slot is refreshed, since that takes the same single
+        round trip as refreshing one slot, and after a dig or suck every slot
+        is unconfirmed anyway."""
+        slot = self.slot(slot_id)
+        if not slot.confirmed:
+            self.refresh_all()
+        return slot
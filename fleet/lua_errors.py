@@ -1,5 +1,6 @@
-from typing import Dict, Any, TYPE_CHECKING, Callable
+from typing import Dict, Any, TYPE_CHECKING, Callable, List, Optional, Union
 
+from cc import eval_lua
 from computercraft.errors import LuaException
 
 if TYPE_CHECKING:
@@ -84,6 +85,156 @@ def run(fn: Callable, *args, **kwargs):
         raise map_error(e, message=e.message)
 
 
+BATCH_LUA = b"""
+local calls = ...
+local unpack = table.unpack or unpack
+local results = {}
+for i, call in ipairs(calls) do
+    local name, check, n_args = call[1], call[2], call[3]
+    local result = {turtle[name](unpack(call, 4, 3 + n_args))}
+    results[i] = result
+    if check and result[1] == false and result[2] ~= check then
+        break
+    end
+end
+return results
+""".strip()
+"""Runs a list of {name, check, n_args, args...} turtle calls in order, and
+returns every call's return values. If `check` isn't false, a call that
+returns false with any message other than `check` is a failure, and no
+further calls are run."""
+
+_NO_CHECK = False
+_ERROR_ON_FALSE = ""
+
+_BATCH_CHECKS: Dict[str, Union[bool, str]] = {
+    **{name: _ERROR_ON_FALSE for name in (
+        "forward", "back", "up", "down", "turnLeft", "turnRight", "select",
+        "place", "placeUp", "placeDown", "refuel", "equipLeft",
+        "equipRight", "transferTo", "craft")},
+    **{name: _NO_CHECK for name in (
+        "getSelectedSlot", "getItemCount", "getItemSpace", "getItemDetail",
+        "getFuelLevel", "getFuelLimit", "detect", "detectUp", "detectDown",
+        "compare", "compareUp", "compareDown", "compareTo")},
+    **{name: "Nothing to dig here" for name in ("dig", "digUp", "digDown")},
+    **{name: "No items to take" for name in ("suck", "suckUp", "suckDown")},
+    **{name: "No items to drop" for name in ("drop", "dropUp", "dropDown")},
+    **{name: "No block to inspect" for name in (
+        "inspect", "inspectUp", "inspectDown")},
+}
+"""How each batchable turtle function reports failure. Functions with a
+message return False (or None, for inspect*) when they fail with it, instead
+of raising."""
+
+
+class BatchCall:
+    """A turtle call queued in a Batch. Its result is set once the batch has
+    run."""
+
+    def __init__(self, name: str, args: tuple):
+        self.name = name
+        self.args = args
+        self.ran = False
+        """True once the call has run without failing"""
+        self._result = None
+
+    def __repr__(self):
+        return f"BatchCall({self.name}{self.args}, ran={self.ran})"
+
+    @property
+    def result(self) -> Any:
+        """What calling the turtle function directly would have returned"""
+        if not self.ran:
+            raise RuntimeError(f"{self} hasn't run!")
+        return self._result
+
+    def _request(self) -> list:
+        return [self.name, _BATCH_CHECKS[self.name], len(self.args),
+                *self.args]
+
+    def _finish(self, returned: Dict[int, Any]) -> Optional[LuaException]:
+        """Set the result from the Lua return values, or return the error"""
+        check = _BATCH_CHECKS[self.name]
+        first = returned.get(1)
+        if check is _NO_CHECK:
+            self._result = first
+        elif first is False:
+            message = returned.get(2)
+            if isinstance(message, bytes):
+                message = message.decode("latin1")
+            if message != check:
+                return map_error(LuaException(message), message=message)
+            self._result = None if self.name.startswith("inspect") else False
+        elif self.name.startswith("inspect"):
+            self._result = returned.get(2)
+        elif check == _ERROR_ON_FALSE:
+            self._result = None
+        else:
+            self._result = True
+        self.ran = True
+        return None
+
+
+class Batch:
+    """Queues calls to turtle functions, and runs all of them on the turtle
+    in a single round trip, instead of one round trip per call. Calls run in
+    the order they were queued. Like lua_errors.run(), the first call that
+    fails raises its error (converted with FROM_LUA), and no calls after it
+    are run.
+
+    Unlike calling them directly, turtle.drop*() returns False instead of
+    raising if the slot is empty, like turtle.suck*() does.
+
+    Usage:
+        with lua_errors.Batch() as batch:
+            counts = [batch.call("getItemCount", slot_id)
+                      for slot_id in range(1, 17)]
+        counts = [count.result for count in counts]
+    """
+
+    def __init__(self):
+        self.calls: List[BatchCall] = []
+        self._callbacks: List[Callable[[], None]] = []
+
+    def __enter__(self) -> 'Batch':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.run()
+
+    def call(self, name: str, *args) -> BatchCall:
+        """Queue a call to a function of the turtle API, by its name (such as
+        "select" for turtle.select)"""
+        if name not in _BATCH_CHECKS:
+            raise ValueError(f"{name} can't be batched!")
+        call = BatchCall(name, args)
+        self.calls.append(call)
+        return call
+
+    def after(self, callback: Callable[[], None]):
+        """Call the callback once every call queued so far has run, such as
+        to put their results to use"""
+        self._callbacks.append(callback)
+
+    def run(self):
+        """Run every queued call, and clear the queue"""
+        calls, self.calls = self.calls, []
+        callbacks, self._callbacks = self._callbacks, []
+        if calls:
+            results = eval_lua(BATCH_LUA,
+                               [call._request() for call in calls]).take()
+            for i, call in enumerate(calls, start=1):
+                if i not in results:
+                    break
+                error = call._finish(results[i])
+                if error is not None:
+                    raise error
+        for callback in callbacks:
+            callback()
+
+
 __all__ = ["FROM_LUA",
            "TO_LUA",
-           "TurtleBlockedError"]
+           "TurtleBlockedError",
+           "Batch"]
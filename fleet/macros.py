@@ -0,0 +1,115 @@
+from dataclasses import dataclass
+from enum import Enum, auto
+from typing import Optional, List
+
+from cc import eval_lua
+
+from fleet import block_info, Direction
+
+DIG_COLUMN_LUA = b"""
+local dig, move, inspect, max_moves, stop_slot, do_not_mine = ...
+local moves, dug = 0, 0
+while moves < max_moves do
+    if stop_slot and turtle.getItemCount(stop_slot) > 0 then
+        return moves, dug, "inventory_full"
+    end
+    local found, block = turtle[inspect]()
+    if found then
+        for _, pattern in ipairs(do_not_mine) do
+            if string.find(block.name, pattern) then
+                return moves, dug, "blacklisted", block.name
+            end
+        end
+        local ok, message = turtle[dig]()
+        if ok then
+            dug = dug + 1
+        elseif message ~= "Nothing to dig here" then
+            return moves, dug, "unbreakable", message
+        end
+    end
+    local ok, message = turtle[move]()
+    if not ok then
+        return moves, dug, "blocked", message
+    end
+    moves = moves + 1
+end
+return moves, dug, "finished"
+""".strip()
+"""Digs and moves up or down, one block at a time, until it has moved
+`max_moves` times or has to stop. Returns how many times it moved, how many
+blocks it dug, why it stopped, and a message to go with the reason."""
+
+_COLUMN_FUNCTIONS = {
+    Direction.up: ("digUp", "up", "inspectUp"),
+    Direction.down: ("digDown", "down", "inspectDown"),
+}
+
+
+class ColumnStop(Enum):
+    finished = auto()
+    """The turtle moved as far as it was asked to"""
+
+    inventory_full = auto()
+    """The stop slot had items in it before the next block was dug"""
+
+    unbreakable = auto()
+    """The next block couldn't be dug"""
+
+    blacklisted = auto()
+    """The next block is in block_info.do_not_mine, so it wasn't dug"""
+
+    blocked = auto()
+    """The turtle couldn't move after digging, such as when it's out of fuel
+    or a mob is in the way"""
+
+
+@dataclass
+class ColumnResult:
+    """What dig_column() reports back once the macro is done"""
+
+    moves: int
+    """How many blocks the turtle moved"""
+
+    dug: int
+    """How many blocks the turtle dug"""
+
+    stop: ColumnStop
+
+    message: Optional[str] = None
+    """The Lua error message for unbreakable and blocked stops, or the block
+    name for blacklisted ones"""
+
+
+def dig_column(direction: Direction, max_moves: int,
+               stop_slot: Optional[int] = None,
+               do_not_mine: Optional[List[str]] = None) -> ColumnResult:
+    """Dig and move straight up or down for up to max_moves blocks, all in a
+    single round trip to the turtle. Before each block, the turtle stops if
+    stop_slot has any items in it, and it never digs a block whose name
+    matches one of the do_not_mine regexes (by default,
+    block_info.do_not_mine).
+
+    Nothing is tracked here: the caller is responsible for reconciling its
+    map and inventory with the result.
+    """
+    if direction not in _COLUMN_FUNCTIONS:
+        raise ValueError(f"You can't dig a column in the direction: "
+                         f"{direction}")
+    if do_not_mine is None:
+        do_not_mine = block_info.do_not_mine
+
+    rp = eval_lua(DIG_COLUMN_LUA,
+                  *_COLUMN_FUNCTIONS[direction],
+                  max_moves,
+                  stop_slot,
+                  block_info.as_lua_patterns(do_not_mine))
+    moves, dug, stop, message = rp.take(), rp.take(), rp.take(), rp.take()
+    if isinstance(message, bytes):
+        message = message.decode("latin1")
+    return ColumnResult(moves=int(moves),
+                        dug=int(dug),
+                        stop=ColumnStop[stop.decode()],
+                        message=message)
+
+
+__all__ = ["ColumnStop", "ColumnResult", "dig_column"]
@@ -1,5 +1,5 @@
 from math import atan2, degrees, cos, sin, radians
-from typing import Sequence
+from typing import Sequence, Tuple, List
 
 import numpy as np
 
@@ -19,6 +19,45 @@ VECTOR_TO_ANGLE = {
 """Vectors representing the directions a turtle can face to their angle 
 representation"""
 
+KEY_BITS = 26
+"""How many bits each axis gets when a position is packed into a single int.
+This comfortably covers the minecraft world border (+-30 million blocks)"""
+_KEY_OFFSET = 1 << (KEY_BITS - 1)
+_KEY_MASK = (1 << KEY_BITS) - 1
+
+
+def pack_position(pos: Sequence) -> int:
+    """Pack an (x, y, z) position into a single int, useful as a cheap
+    hashable key for sets and dicts of voxels"""
+    x, y, z = pos
+    return ((int(x) + _KEY_OFFSET) << (KEY_BITS * 2)
+            | (int(y) + _KEY_OFFSET) << KEY_BITS
+            | (int(z) + _KEY_OFFSET))
+
+
+def pack_positions(positions: np.ndarray) -> List[int]:
+    """A vectorized pack_position, for an (n, 3) array of positions"""
+    offset = (np.asarray(positions, dtype=np.int64).reshape(-1, 3)
+              + _KEY_OFFSET)
+    # Keys are wider than int64, but y and z fit in one, so only x is
+    # shifted as a python int
+    xs = offset[:, 0].tolist()
+    yzs = ((offset[:, 1] << KEY_BITS) | offset[:, 2]).tolist()
+    return [x << (KEY_BITS * 2) | yz for x, yz in zip(xs, yzs)]
+
+
+def unpack_position(key: int) -> Tuple[int, int, int]:
+    """The inverse of pack_position"""
+    return ((key >> (KEY_BITS * 2)) - _KEY_OFFSET,
+            ((key >> KEY_BITS) & _KEY_MASK) - _KEY_OFFSET,
+            (key & _KEY_MASK) - _KEY_OFFSET)
+
+
+NEIGHBOR_KEY_OFFSETS = tuple(
+    pack_position(neighbor) - pack_position((0, 0, 0))
+    for neighbor in NEIGHBOR_COORDS)
+"""NEIGHBOR_COORDS, as offsets that can be added directly to packed keys"""
+
 
 def get_coordinate_neighbors(pos: Sequence):
     pos = np.array(pos)
@@ -96,6 +135,15 @@ def within_bounding_points(point: Sequence, bp1: Sequence, bp2: Sequence):
     return within_xy and min_z <= point[2] <= max_z
 
 
+def bounding_box(points: Sequence[Sequence[int]], padding: int = 0) \
+        -> Tuple[Tuple[int, int, int], Tuple[int, int, int]]:
+    """Return the inclusive ((min_x, min_y, min_z), (max_x, max_y, max_z))
+    box around some (x, y, z) points, grown by `padding` on every side"""
+    points = np.array(points, dtype=np.int64).reshape(-1, 3)
+    return (tuple((points.min(axis=0) - padding).tolist()),
+            tuple((points.max(axis=0) + padding).tolist()))
+
+
 def coordinate_in_turtle_direction(curr_pos: np.ndarray,
                                    curr_angle: float,
                                    direction: Direction) -> np.ndarray:
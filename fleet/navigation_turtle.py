@@ -1,22 +1,186 @@
-from typing import List, Union
+from concurrent.futures import Future
+from time import time
+from typing import List, Union, Optional, Tuple, Dict, Sequence, Callable
 
 import numpy as np
 
 from fleet import (
     astar,
+    Bounds,
+    PathResult,
+    PathStatus,
+    UnreachableCache,
+    IncrementalPlanner,
+    HierarchicalPlanner,
+    DistanceField,
+    MapSnapshot,
+    PlannerService,
     StatefulTurtle,
+    StateAttr,
+    PathCache,
+    Map,
     Direction,
-    lua_errors)
+    lua_errors,
+    runtime)
 from fleet.math_utils import sign, angle_between
+from fleet.planner_service import greedy_step
+
+
+class UnreachableGoalError(Exception):
+    """Raised by move_toward when no path to the target can be found"""
+
+
+class PathBudgetExhaustedError(Exception):
+    """Raised by move_toward when a search ran out of PATH_MAX_EXPANSIONS
+    before it found any step toward the target. Unlike UnreachableGoalError,
+    the target may well be reachable, so this is worth retrying (with a larger
+    PATH_MAX_EXPANSIONS, for instance)."""
 
 
 class NavigationTurtle(StatefulTurtle):
     """Adds high-level methods helpful for moving around"""
 
+    INCREMENTAL_PLANNING = False
+    """If True, move_toward keeps a D* Lite search tree in memory and repairs
+    it as obstacles are discovered, instead of running a new A* search every
+    time an obstacle turns up on its path. This is much cheaper on long
+    routes through unexplored terrain, at the cost of holding the search tree
+    in memory for the duration of the trip."""
+
+    PATH_E_ADMISSIBILITY = 1.1
+    """The e_admissibility that move_toward plans paths with"""
+
+    HEADING_AWARE_PLANNING = False
+    """If True, move_toward plans paths that minimize turns as well as moves.
+    Every turn costs a whole step, so this avoids zig-zagging paths that are
+    just as short on the grid but much slower to follow. This is ignored if
+    INCREMENTAL_PLANNING is on."""
+
+    HIERARCHICAL_PLANNING = False
+    """If True, move_toward plans long trips over chunk-sized clusters with a
+    HierarchicalPlanner, and only plans individual blocks within the turtle's
+    own cluster. Costs between cluster portals are cached for as long as the
+    obstacles around them don't change. Short trips, and trips with
+    path_bounds, are still planned with astar(). This is ignored if
+    INCREMENTAL_PLANNING is on, and doesn't take HEADING_AWARE_PLANNING into
+    account."""
+
+    PLANNER_SERVICE: Optional[PlannerService] = None
+    """If set, move_toward runs its A* searches in this service's worker
+    processes instead of in the turtle's own step. Every turtle is served
+    from the same thread, so the turtle waits for the search with
+    runtime.wait(), which lets the other turtles carry on. This is ignored if
+    INCREMENTAL_PLANNING is on, and for the trips that HIERARCHICAL_PLANNING
+    plans."""
+
+    PLANNER_TIMEOUT = 2
+    """How many seconds move_toward waits for a search in the PLANNER_SERVICE
+    before taking a greedy step instead. The search keeps running, and once
+    its path is ready the turtle heads to the closest point on the path,
+    instead of backtracking along its greedy steps. Greedy steps stay within
+    the path_bounds given to move_toward."""
+
+    PLANNER_DETOUR_EXPANSIONS = 1000
+    """How many positions the search from the turtle's greedy steps back
+    onto a path from the PLANNER_SERVICE may expand. If the search fails, the
+    turtle backtracks along its greedy steps instead."""
+
+    PATH_MAX_EXPANSIONS = 50000
+    """How many positions a single A* search may expand before move_toward
+    settles for a partial path toward the target. The rest of the path is
+    planned once the turtle reaches the end of the partial path."""
+
+    def __init__(self):
+        super().__init__()
+        self.state.path_cache = StateAttr(self.state, "path_cache",
+                                          PathCache())
+        """The path that move_toward is currently following, so that it
+        doesn't have to be replanned on every step"""
+
+        self._planner: Optional[IncrementalPlanner] = None
+        """The planner for the current trip, if INCREMENTAL_PLANNING is on"""
+
+        self._hierarchical_planner: Optional[HierarchicalPlanner] = None
+        """Kept between trips if HIERARCHICAL_PLANNING is on, since its caches
+        stay useful"""
+
+        self._search: Optional[_PendingSearch] = None
+        """The search running in the PLANNER_SERVICE, if there is one"""
+        self._map_snapshot: Optional[MapSnapshot] = None
+        """The latest map snapshot sent to the PLANNER_SERVICE, which is
+        reused until the map changes"""
+
+        self._unreachable = UnreachableCache()
+        """Targets that were proven unreachable, so move_toward can give up on
+        them without searching again"""
+
+        self._depots: Dict[Tuple[int, int, int], Tuple[Bounds, float]] = {}
+        """The bounds and obstacle cost of every registered depot"""
+        self._distance_fields: Dict[Tuple[int, int, int], DistanceField] = {}
+        """Distance fields for registered depots, built upon first use"""
+
+    def register_depot(self, position: Sequence[int], bounds: Bounds,
+                       path_obstacle_cost=10):
+        """Register a position that the turtle keeps going back to, such as a
+        fuel chest. Within the bounds, move_toward then heads there by looking
+        up a distance field instead of searching for a path, and
+        depot_distance() becomes a lookup. Outside of the bounds, or with a
+        different path_obstacle_cost, move_toward plans paths as usual.
+
+        :param position: The depot's position
+        :param bounds: The inclusive ((min_x, min_y, min_z), (max_x, max_y,
+        max_z)) box that the distance field covers. Every position within it
+        is kept track of, so keep it as small as is practical.
+        :param path_obstacle_cost: The path_obstacle_cost the depot is usually
+        traveled to with
+        """
+        position = tuple(int(axis) for axis in position)
+        self._depots[position] = (bounds, path_obstacle_cost)
+        self._distance_fields.pop(position, None)
+
+    def depot_distance(self, position: Sequence[int]) -> float:
+        """Return the cost of the cheapest path from the turtle to a registered
+        depot, or inf if the turtle is outside the depot's bounds or there is
+        no path within them"""
+        map = self.state.map.read()
+        field = self._distance_field(map, position)
+        if field is None:
+            raise KeyError(f"No depot was registered at {position}!")
+        return field.distance(map.position)
+
+    def _distance_field(self, map: Map, position: Sequence[int]) \
+            -> Optional[DistanceField]:
+        """Return the up to date distance field of a registered depot"""
+        position = tuple(int(axis) for axis in position)
+        if position not in self._depots:
+            return None
+
+        field = self._distance_fields.get(position)
+        if field is None:
+            bounds, obstacle_cost = self._depots[position]
+            field = self._distance_fields[position] = DistanceField(
+                to_pos=position,
+                bounds=bounds,
+                map=map,
+                obstacle_cost=obstacle_cost)
+        else:
+            field.update(map)
+        return field
+
     def move_toward(self, to_pos: Union[List[int], np.ndarray],
                     destructive=False,
-                    path_obstacle_cost=10):
-        """Make a move in one of these directions, turning automatically"""
+                    path_obstacle_cost=10,
+                    path_bounds: Optional[Bounds] = None):
+        """Make a move in one of these directions, turning automatically
+
+        :param path_bounds: If set, the path must stay within this inclusive
+        ((min_x, min_y, min_z), (max_x, max_y, max_z)) box. This is ignored if
+        INCREMENTAL_PLANNING is on.
+        :raises UnreachableGoalError: If no path can be found. With a finite
+        path_obstacle_cost this only happens if to_pos is out of path_bounds.
+        :raises PathBudgetExhaustedError: If the search gave up before
+        finding any step toward to_pos
+        """
         if isinstance(to_pos, np.ndarray):
             to_pos = to_pos.tolist()
         elif isinstance(to_pos, tuple):
@@ -32,14 +196,20 @@ class NavigationTurtle(StatefulTurtle):
             # Already at position!
             return
 
-        path, path_obstructed = astar(
-            from_pos=curr_pos,
-            to_pos=to_pos,
-            map=map,
-            obstacle_cost=path_obstacle_cost,
-            e_admissibility=1.1
-        )
-        next_pos = np.array(path[1:][0])
+        # Registered depots can be headed to without planning a path, as
+        # long as the turtle is within their bounds
+        field = self._distance_field(map, to_pos)
+        next_pos = None
+        if field is not None and field.is_for(to_pos, path_obstacle_cost):
+            next_pos = field.next_position(curr_pos)
+
+        if next_pos is None and self.INCREMENTAL_PLANNING:
+            next_pos = self._next_position_incremental(
+                map, to_pos, path_obstacle_cost)
+        elif next_pos is None:
+            next_pos = self._next_position_cached(
+                map, to_pos, path_obstacle_cost, path_bounds)
+        next_pos = np.array(next_pos)
 
         ##### Move to the next position in the path
         # Try to move toward that direction
@@ -61,6 +231,167 @@ class NavigationTurtle(StatefulTurtle):
             else:
                 raise
 
+    def _next_position_cached(self, map: Map, to_pos: List[int],
+                              obstacle_cost: float,
+                              bounds: Optional[Bounds]) -> np.ndarray:
+        """Follow the path in the path cache, replanning if it's stale or if
+        a partial path has been used up"""
+        path_cache = self.state.path_cache.read()
+        next_pos = path_cache.next_position(
+            map=map, to_pos=to_pos, obstacle_cost=obstacle_cost)
+        if next_pos is None:
+            if self.HIERARCHICAL_PLANNING and bounds is None:
+                result = self._plan_hierarchically(map, to_pos, obstacle_cost)
+            elif self.PLANNER_SERVICE is not None:
+                result = self._plan_offloaded(
+                    map, to_pos, obstacle_cost, bounds)
+                if result is None:
+                    step = greedy_step(from_pos=map.position,
+                                       to_pos=to_pos,
+                                       map=map,
+                                       avoid=self._search.trail,
+                                       bounds=bounds)
+                    if step is not None:
+                        return step
+                    # There's nowhere to step within the bounds
+                    runtime.wait(self._search.future)
+                    result = self._plan_offloaded(
+                        map, to_pos, obstacle_cost, bounds)
+            else:
+                result = astar(
+                    from_pos=map.position,
+                    to_pos=to_pos,
+                    map=map,
+                    obstacle_cost=obstacle_cost,
+                    e_admissibility=self.PATH_E_ADMISSIBILITY,
+                    bounds=bounds,
+                    max_expansions=self.PATH_MAX_EXPANSIONS,
+                    unreachable_cache=self._unreachable,
+                    direction=(map.direction if self.HEADING_AWARE_PLANNING
+                               else None)
+                )
+            if (result.status is PathStatus.budget_exhausted
+                    and len(result.path) < 2):
+                raise PathBudgetExhaustedError(
+                    f"No step from {map.position.tolist()} toward {to_pos} "
+                    f"was found within {self.PATH_MAX_EXPANSIONS} "
+                    f"expansions")
+            if result.status is PathStatus.unreachable \
+                    or len(result.path) < 2:
+                raise UnreachableGoalError(
+                    f"No path from {map.position.tolist()} to {to_pos} "
+                    f"({result.status.name})")
+            path_cache = PathCache.plan(
+                to_pos=to_pos,
+                obstacle_cost=obstacle_cost,
+                path=result.path,
+                map=map)
+            next_pos = path_cache.path[1]
+        self.state.path_cache.write(path_cache)
+        return next_pos
+
+    def _plan_hierarchically(self, map: Map, to_pos: List[int],
+                             obstacle_cost: float) -> PathResult:
+        planner = self._hierarchical_planner
+        if planner is None or not planner.is_planning(
+                e_admissibility=self.PATH_E_ADMISSIBILITY,
+                obstacle_cost=obstacle_cost):
+            planner = self._hierarchical_planner = HierarchicalPlanner(
+                e_admissibility=self.PATH_E_ADMISSIBILITY,
+                obstacle_cost=obstacle_cost)
+        return planner.plan(from_pos=map.position, to_pos=to_pos, map=map)
+
+    def _plan_offloaded(self, map: Map, to_pos: List[int],
+                        obstacle_cost: float,
+                        bounds: Optional[Bounds]) -> Optional[PathResult]:
+        """Wait for the search in the PLANNER_SERVICE, starting one if there
+        isn't one for this trip yet. Returns None if the search isn't done
+        within PLANNER_TIMEOUT of when it started."""
+        position = tuple(map.position.tolist())
+        search = self._search
+        if search is None or not search.is_for(to_pos, obstacle_cost, bounds):
+            if search is not None:
+                search.future.cancel()
+            future = self.PLANNER_SERVICE.submit(
+                self._snapshot(map),
+                from_pos=position,
+                to_pos=to_pos,
+                e_admissibility=self.PATH_E_ADMISSIBILITY,
+                obstacle_cost=obstacle_cost,
+                bounds=bounds,
+                max_expansions=self.PATH_MAX_EXPANSIONS,
+                direction=(map.direction if self.HEADING_AWARE_PLANNING
+                           else None))
+            search = self._search = _PendingSearch(
+                future=future,
+                to_pos=to_pos,
+                obstacle_cost=obstacle_cost,
+                bounds=bounds)
+        search.visit(position)
+
+        deadline = search.started + self.PLANNER_TIMEOUT
+        if not runtime.wait(search.future, timeout=max(deadline - time(), 0)):
+            return None
+
+        self._search = None
+        result = search.future.result()
+
+        def detour(from_pos: Tuple[int, int, int],
+                   to_pos: Tuple[int, int, int]) \
+                -> Optional[List[Tuple[int, int, int]]]:
+            found = astar(from_pos=from_pos,
+                          to_pos=to_pos,
+                          map=map,
+                          obstacle_cost=obstacle_cost,
+                          e_admissibility=self.PATH_E_ADMISSIBILITY,
+                          bounds=bounds,
+                          max_expansions=self.PLANNER_DETOUR_EXPANSIONS)
+            return found.path if found.status is PathStatus.found else None
+
+        return PathResult(path=search.join(result.path, detour),
+                          obstructed=result.obstructed,
+                          status=result.status,
+                          expansions=result.expansions)
+
+    def close(self):
+        """Cancel the search running in the PLANNER_SERVICE, and release the
+        last map snapshot, so its shared memory is freed"""
+        super().close()
+        if self._search is not None:
+            self._search.future.cancel()
+            self._search = None
+        if self._map_snapshot is not None:
+            self._map_snapshot.release()
+            self._map_snapshot = None
+
+    def _snapshot(self, map: Map) -> MapSnapshot:
+        snapshot = self._map_snapshot
+        if snapshot is None or snapshot.version != map.version:
+            if snapshot is not None:
+                snapshot.release()
+            snapshot = self._map_snapshot = self.PLANNER_SERVICE.snapshot(map)
+        return snapshot
+
+    def _next_position_incremental(self, map: Map, to_pos: List[int],
+                                   obstacle_cost: float) \
+            -> Tuple[int, int, int]:
+        """Repair the incremental planner with any map changes, creating a new
+        one if the target changed or the map changed too much to repair"""
+        planner = self._planner
+        if (planner is None
+                or not planner.is_planning(
+                    to_pos=to_pos,
+                    e_admissibility=self.PATH_E_ADMISSIBILITY,
+                    obstacle_cost=obstacle_cost)
+                or not planner.update(map)):
+            planner = self._planner = IncrementalPlanner(
+                from_pos=map.position,
+                to_pos=to_pos,
+                map=map,
+                e_admissibility=self.PATH_E_ADMISSIBILITY,
+                obstacle_cost=obstacle_cost)
+        return planner.next_position()
+
     def turn_toward(self, to_pos):
         """Turn toward the target_position
         """
@@ -81,3 +412,59 @@ class NavigationTurtle(StatefulTurtle):
                 self.turn_right()
             elif turn_direction < 0:
                 self.turn_left()
+
+
+class _PendingSearch:
+    """A search running in a PlannerService, along with every position the
+    turtle took greedy steps through while waiting for it"""
+
+    def __init__(self, future: 'Future[PathResult]', to_pos: List[int],
+                 obstacle_cost: float, bounds: Optional[Bounds]):
+        self.future = future
+        self.to_pos = to_pos
+        self.obstacle_cost = obstacle_cost
+        self.bounds = bounds
+        self.started = time()
+        self.trail: List[Tuple[int, int, int]] = []
+        """Where the turtle has been since the search started, starting with
+        the position the search started from"""
+
+    def is_for(self, to_pos: List[int], obstacle_cost: float,
+               bounds: Optional[Bounds]) -> bool:
+        return (self.to_pos == to_pos
+                and self.obstacle_cost == obstacle_cost
+                and self.bounds == bounds)
+
+    def visit(self, position: Tuple[int, int, int]):
+        if not self.trail or self.trail[-1] != position:
+            self.trail.append(position)
+
+    def join(self, path: List[Tuple[int, int, int]],
+             detour: Callable[[Tuple[int, int, int], Tuple[int, int, int]],
+                              Optional[List[Tuple[int, int, int]]]]) \
+            -> List[Tuple[int, int, int]]:
+        """Lead from the turtle's latest position onto the path, and along
+        the rest of it. If the turtle isn't on the path, it heads to the
+        position on the path that makes for the shortest trip, using the path
+        from detour(from_pos, to_pos). Only if there is no detour does it
+        backtrack along its trail, up to the last position it visited that's
+        on the path."""
+        position = self.trail[-1]
+        indices = {position: i for i, position in enumerate(path)}
+        if position in indices:
+            return path[indices[position]:]
+
+        def trip_length(index: int) -> int:
+            distance = sum(abs(a - b) for a, b in zip(position, path[index]))
+            return distance + len(path) - index
+
+        closest = min(range(len(path)), key=trip_length)
+        detour_path = detour(position, path[closest])
+        if detour_path is not None:
+            return detour_path + path[closest + 1:]
+
+        backtrack = self.trail[::-1]
+        for steps, position in enumerate(backtrack):
+            if position in indices:
+                return backtrack[:steps] + path[indices[position]:]
+        raise ValueError("The path doesn't start where the search did!")
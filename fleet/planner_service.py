@@ -0,0 +1,266 @@
+import sys
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from threading import Lock
+from typing import Sequence, Optional, Tuple, Iterable, Set
+
+import numpy as np
+
+from fleet.math_utils import NEIGHBOR_COORDS
+from fleet.serializable.obstacles import ChunkedObstacles
+from fleet.turtle_astar import astar, Bounds, PathResult
+from fleet import Map
+
+
+class MapSnapshot:
+    """A read-only copy of a map's obstacles in shared memory. Worker
+    processes copy the obstacle chunks straight out of it, instead of having
+    the whole map pickled and piped to them with every search.
+
+    The shared memory holds an (n_chunks, 4) int64 array of every chunk's
+    coordinates and obstacle count, followed by the occupancy bits of every
+    chunk in the same order.
+
+    A snapshot is reference counted, since searches may still be waiting to
+    read it after its owner has moved on to a newer one. The shared memory is
+    freed once every reference is released.
+    """
+
+    def __init__(self, map: Map):
+        chunk_coords, counts, data = map.to_chunk_buffers()
+        self.version = map.version
+        """The map version the snapshot was taken at"""
+        self.n_chunks = len(chunk_coords)
+
+        self._memory = SharedMemory(create=True,
+                                    size=max(self._index_bytes + len(data), 1))
+        index = self._index(self._memory)
+        index[:, :3] = chunk_coords
+        index[:, 3] = counts
+        self._memory.buf[self._index_bytes:self._index_bytes + len(data)] = \
+            data
+        self._references = 1
+        self._lock = Lock()
+
+    def __repr__(self):
+        return f"MapSnapshot(version={self.version}, n_chunks={self.n_chunks})"
+
+    def __reduce__(self):
+        # Only what a worker needs to find the obstacles is sent over
+        return _RemoteSnapshot, (self.version, self.n_chunks, self.name)
+
+    @property
+    def name(self) -> str:
+        """The name of the shared memory block"""
+        return self._memory.name
+
+    @property
+    def is_released(self) -> bool:
+        with self._lock:
+            return self._references == 0
+
+    def acquire(self) -> 'MapSnapshot':
+        with self._lock:
+            if self._references == 0:
+                raise RuntimeError("The snapshot was already released!")
+            self._references += 1
+        return self
+
+    def release(self):
+        with self._lock:
+            self._references -= 1
+            if self._references == 0:
+                self._memory.close()
+                self._memory.unlink()
+
+    @property
+    def _index_bytes(self) -> int:
+        return self.n_chunks * 4 * 8
+
+    def _index(self, memory: SharedMemory) -> np.ndarray:
+        return np.ndarray(shape=(self.n_chunks, 4), dtype=np.int64,
+                          buffer=memory.buf)
+
+    def _load(self) -> Map:
+        """Rebuild the map from shared memory, in a worker process"""
+        memory = _attach(self.name)
+        try:
+            index = self._index(memory).copy()
+            data = bytes(memory.buf[
+                self._index_bytes:
+                self._index_bytes
+                + self.n_chunks * ChunkedObstacles.CHUNK_BYTES])
+        finally:
+            memory.close()
+        return Map.from_chunk_buffers(position=(0, 0, 0),
+                                      direction=0,
+                                      chunk_coords=index[:, :3],
+                                      counts=index[:, 3],
+                                      data=data,
+                                      version=self.version)
+
+
+class _RemoteSnapshot(MapSnapshot):
+    """A MapSnapshot as it's seen from within a worker process, which
+    doesn't own the shared memory"""
+
+    def __init__(self, version: int, n_chunks: int, name: str):
+        self.version = version
+        self.n_chunks = n_chunks
+        self._name = name
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+
+class PlannerService:
+    """Runs astar() searches in a pool of worker processes, so that a slow
+    search for one turtle doesn't hold up every other turtle being served by
+    the same process.
+
+    Usage:
+        service = PlannerService()
+        snapshot = service.snapshot(map)
+        future = service.submit(snapshot, from_pos, to_pos, 1.1)
+        snapshot.release()
+        # Then, once future.done()
+        path, obstructed = future.result()
+    """
+
+    def __init__(self, max_workers: Optional[int] = None):
+        self._executor = ProcessPoolExecutor(max_workers=max_workers)
+        self._pending: Set[Future] = set()
+        """Searches that haven't finished yet, to cancel on shutdown"""
+        self._pending_lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+    def snapshot(self, map: Map) -> MapSnapshot:
+        """Copy the map's obstacles into shared memory. The snapshot can be
+        reused for as long as map.version doesn't change, and has to be
+        released once it's no longer needed."""
+        return MapSnapshot(map)
+
+    def submit(self, snapshot: MapSnapshot,
+               from_pos: Sequence[int],
+               to_pos: Sequence[int],
+               e_admissibility: float,
+               obstacle_cost=10,
+               bounds: Optional[Bounds] = None,
+               max_expansions: Optional[int] = None,
+               direction: Optional[int] = None) -> 'Future[PathResult]':
+        """Start an astar() search on the snapshot. The snapshot is kept
+        alive until the search is done with it. Arguments are the same as
+        for astar()."""
+        snapshot.acquire()
+        try:
+            future = self._executor.submit(
+                _search,
+                snapshot,
+                from_pos=_ints(from_pos),
+                to_pos=_ints(to_pos),
+                e_admissibility=e_admissibility,
+                obstacle_cost=obstacle_cost,
+                bounds=None if bounds is None else tuple(
+                    _ints(corner) for corner in bounds),
+                max_expansions=max_expansions,
+                direction=direction)
+        except BaseException:
+            snapshot.release()
+            raise
+        with self._pending_lock:
+            self._pending.add(future)
+        future.add_done_callback(lambda _: snapshot.release())
+        future.add_done_callback(self._forget)
+        return future
+
+    def shutdown(self, wait=True):
+        # Executor.shutdown(cancel_futures=True) only exists since python 3.9
+        with self._pending_lock:
+            pending = list(self._pending)
+        for future in pending:
+            future.cancel()
+        self._executor.shutdown(wait=wait)
+
+    def _forget(self, future: Future):
+        with self._pending_lock:
+            self._pending.discard(future)
+
+
+def greedy_step(from_pos: Sequence[int], to_pos: Sequence[int], map: Map,
+                avoid: Iterable[Sequence[int]] = (),
+                bounds: Optional[Bounds] = None) \
+        -> Optional[Tuple[int, int, int]]:
+    """Pick a neighbor of from_pos to move to without searching, for when a
+    path isn't ready in time. Free neighbors are preferred over known
+    obstacles, and neighbors that aren't in `avoid` (such as positions that
+    were just visited) are preferred over ones that are. Ties are broken by
+    the manhattan distance to to_pos. Neighbors outside of `bounds` are never
+    picked, and if there are none left, None is returned.
+    """
+    avoid = {_ints(position) for position in avoid}
+    to_pos = np.array(to_pos)
+    neighbors = np.array(from_pos) + NEIGHBOR_COORDS
+    if bounds is not None:
+        bounds_min, bounds_max = np.array(bounds[0]), np.array(bounds[1])
+        neighbors = neighbors[((neighbors >= bounds_min)
+                               & (neighbors <= bounds_max)).all(axis=1)]
+        if len(neighbors) == 0:
+            return None
+
+    def rank(neighbor: np.ndarray):
+        return (map.is_known_obstacle(neighbor),
+                _ints(neighbor) in avoid,
+                int(np.abs(to_pos - neighbor).sum()))
+
+    return _ints(min(neighbors, key=rank))
+
+
+_MAX_WORKER_MAPS = 4
+_worker_maps: 'OrderedDict[str, Map]' = OrderedDict()
+"""The most recently used maps in a worker process, by snapshot name. A
+turtle often searches more than once before its map changes."""
+
+
+def _search(snapshot: MapSnapshot, **astar_kwargs) -> PathResult:
+    """Run a search, within a worker process"""
+    map = _worker_maps.get(snapshot.name)
+    if map is None:
+        map = _worker_maps[snapshot.name] = snapshot._load()
+        while len(_worker_maps) > _MAX_WORKER_MAPS:
+            _worker_maps.popitem(last=False)
+    _worker_maps.move_to_end(snapshot.name)
+    return astar(map=map, **astar_kwargs)
+
+
+def _attach(name: str) -> SharedMemory:
+    """Attach to shared memory that's owned by another process, without
+    registering it with the resource tracker. Otherwise, the tracker would
+    warn about a leak (or unlink it early) once the attaching process exits.
+    Unregistering after attaching isn't an option, since worker processes
+    share their tracker with the owner, whose registration would go too."""
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name=name, track=False)
+
+    # Worker processes only run one search at a time, so nothing else can
+    # register in the meantime
+    register = resource_tracker.register
+    resource_tracker.register = lambda *args, **kwargs: None
+    try:
+        return SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def _ints(position: Sequence[int]) -> Tuple[int, int, int]:
+    return tuple(int(axis) for axis in position)
+
+
+__all__ = ["MapSnapshot", "PlannerService", "greedy_step"]
@@ -1,6 +1,4 @@
-from cc import turtle
-
-from fleet.navigation_turtle import NavigationTurtle, Direction, lua_errors
+from fleet.navigation_turtle import NavigationTurtle, Direction
 
 
 def dump_if_full(nav_turtle: NavigationTurtle, dump_spot, dump_slots,
@@ -15,24 +13,20 @@ def dump_if_full(nav_turtle: NavigationTurtle, dump_spot, dump_slots,
     """
     # Try to get the item count without making any API calls
     item_count_at_least = nav_turtle.inventory.slot(trigger_slot).count
-    if (nav_turtle.inventory.slot(trigger_slot).confirmed or
-            item_count_at_least > 0):
+    if item_count_at_least > 0:
         trigger_slot_item_count = item_count_at_least
     else:
-        # Make the API call if necessary
-        trigger_slot_item_count = lua_errors.run(turtle.getItemCount,
-                                                 trigger_slot)
+        # Re-sync the inventory if necessary
+        trigger_slot_item_count = nav_turtle.inventory.confirmed_slot(
+            trigger_slot).count
 
     if trigger_slot_item_count > 0:
         nav_turtle.move_toward(to_pos=dump_spot, destructive=destructive)
-        for slot_id in dump_slots:
-            item_count = lua_errors.run(turtle.getItemCount, slot_id)
-            nav_turtle.select(slot_id)
-            # Don't end the step here so in one fell swoop all slots can be
-            # cleared. Otherwise we'd have to keep state as to which slot has
-            # been cleared thus far.
-            nav_turtle.drop_in_direction(Direction.down, item_count,
-                                         end_step=False)
+        # Don't end the step here so in one fell swoop all slots can be
+        # cleared. Otherwise we'd have to keep state as to which slot has
+        # been cleared thus far.
+        nav_turtle.drop_slots_in_direction(Direction.down, dump_slots,
+                                           end_step=False)
 
         # Always default to selecting 1, because any 'suck' or 'dig' operation
         # after this will go right into the trigger slot
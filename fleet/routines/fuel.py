@@ -1,6 +1,4 @@
-from cc import turtle
-
-from fleet import NavigationTurtle, Direction, lua_errors
+from fleet import NavigationTurtle, Direction
 
 FUEL_SLOT = 1
 TURTLE_FUEL_LIMIT = 100000
@@ -9,9 +7,11 @@ TURTLE_FUEL_LIMIT = 100000
 def maybe_refuel(nav_turtle: NavigationTurtle, refuel_spot, destructive=False):
     """Top off fuel if necessary. This function roughly predicts the distance to
     refuel and decides if it's necessary to refuel"""
-    fuel_level = lua_errors.run(turtle.getFuelLevel)
+    threshold = TURTLE_FUEL_LIMIT * 0.5
 
-    if fuel_level < TURTLE_FUEL_LIMIT * 0.5:
+    # The turtle's own estimate is used, which only asks the turtle once in
+    # a while, or when the estimate gets close to the threshold
+    if nav_turtle.fuel_level(threshold) < threshold:
         # Whether we are consuming fuel or getting it from a chest, we always
         # want to do so from the fuel slot
         nav_turtle.select(FUEL_SLOT)
@@ -0,0 +1,123 @@
+"""The computercraft server runs every turtle's program as a greenlet on a
+single asyncio event loop, switching away from a turtle's greenlet whenever it
+waits on a round trip to its turtle. Hundreds of turtles can share that loop,
+as long as none of them blocks it.
+
+These functions wait without blocking the loop. Instead of sleeping on the
+turtle (which costs a round trip) or blocking the server's thread, they park
+the turtle's greenlet and have the event loop switch back to it once it's
+done waiting, so every other turtle keeps running in the meantime.
+
+Parking relies on internals of computercraft's CCGreenlet and CCSession, so
+the computercraft version is pinned in pyproject.toml. Outside of a
+computercraft session (such as in tests) they fall back to regular blocking
+waits. They also fall back if computercraft's internals don't match, but warn
+about it, since every turtle then blocks the server while it waits.
+"""
+import asyncio
+import warnings
+from concurrent.futures import Future, ThreadPoolExecutor, wait as wait_all
+from typing import Callable, Optional, Any
+
+from greenlet import getcurrent
+from cc import os
+
+_blocking_executor = ThreadPoolExecutor(thread_name_prefix="fleet-blocking")
+"""Runs blocking calls, such as writing state files, off of the event loop"""
+
+
+def sleep(seconds: float):
+    """Sleep without blocking any other turtle"""
+    if _current_task() is None:
+        os.sleep(seconds)
+        return
+    _park(lambda loop, resume: loop.call_later(seconds, resume))
+
+
+def wait(future: Future, timeout: Optional[float] = None) -> bool:
+    """Wait for a concurrent.futures.Future to finish, or for the timeout to
+    run out, without blocking any other turtle. Returns future.done()."""
+    if future.done():
+        return True
+    if _current_task() is None:
+        wait_all([future], timeout=timeout)
+        return future.done()
+
+    def schedule(loop: asyncio.AbstractEventLoop, resume: Callable):
+        timer = None
+        if timeout is not None:
+            timer = loop.call_later(timeout, resume)
+
+        def on_done(_):
+            if timer is not None:
+                timer.cancel()
+            resume()
+
+        # The future may be finished by another thread
+        future.add_done_callback(
+            lambda _: loop.call_soon_threadsafe(on_done, None))
+
+    _park(schedule)
+    return future.done()
+
+
+def run_blocking(fn: Callable, *args, **kwargs) -> Any:
+    """Call a function that blocks (on disk access, for example) in a
+    thread, without blocking any other turtle, and return its result"""
+    if _current_task() is None:
+        return fn(*args, **kwargs)
+    future = _blocking_executor.submit(fn, *args, **kwargs)
+    wait(future)
+    return future.result()
+
+
+_TASK_ATTRS = ("_sess", "_task_id", "switch")
+_SESSION_ATTRS = ("_greenlets", "_server_greenlet", "_run_new_greenlets")
+
+
+def _current_task():
+    """The computercraft greenlet of the turtle that's running, or None if
+    this isn't running in a computercraft session that greenlets can be
+    parked in"""
+    task = getattr(getcurrent(), "cc_greenlet", None)
+    if task is None:
+        return None
+    missing = [a for a in _TASK_ATTRS if not hasattr(task, a)]
+    if not missing:
+        missing = [a for a in _SESSION_ATTRS if not hasattr(task._sess, a)]
+    if missing:
+        warnings.warn(
+            f"computercraft is missing {', '.join(missing)}, which "
+            f"fleet.runtime needs to park turtles. Turtles will block the "
+            f"server while they wait. Is the pinned computercraft version "
+            f"installed?", RuntimeWarning)
+        return None
+    return task
+
+
+def _park(schedule: Callable[[asyncio.AbstractEventLoop, Callable], None]):
+    """Switch to the server's greenlet, which runs the event loop, after
+    calling schedule(loop, resume) to arrange for resume() to be called once
+    the turtle is done waiting. Only the first call to resume() switches back
+    to the turtle."""
+    task = _current_task()
+    session = task._sess
+    resumed = False
+
+    def resume(*_):
+        nonlocal resumed
+        # The turtle may have disconnected while it was waiting
+        if resumed or task._task_id not in session._greenlets:
+            return
+        resumed = True
+        task.switch(None)
+        # Like CCSession.on_task_result, start any greenlets the turtle
+        # spawned since it was resumed
+        session._run_new_greenlets()
+
+    schedule(asyncio.get_running_loop(), resume)
+    # Returning to the server without a request leaves the turtle idle
+    session._server_greenlet.switch(None)
+
+
+__all__ = ["sleep", "wait", "run_blocking"]
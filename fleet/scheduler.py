@@ -0,0 +1,126 @@
+from time import time
+from typing import Dict, Optional, Type
+
+from fleet import lua_errors
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average, with bursts of up to
+    `burst` events after being idle.
+
+    Events are reserved rather than waited for, so that when many callers
+    share a bucket (such as every turtle on a server), each is told how long
+    to wait for its own turn instead of all of them waking up at once.
+    """
+
+    def __init__(self, rate: float, burst: float = 1):
+        if rate <= 0 or burst < 1:
+            raise ValueError(f"Invalid rate {rate} or burst {burst}!")
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated: Optional[float] = None
+
+    def __repr__(self):
+        return f"TokenBucket(rate={self.rate}, burst={self.burst})"
+
+    def reserve(self, now: Optional[float] = None) -> float:
+        """Reserve an event, and return how many seconds to wait before it
+        can happen"""
+        now = time() if now is None else now
+        if self._updated is not None:
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+        self._tokens -= 1
+        if self._tokens >= 0:
+            return 0
+        return -self._tokens / self.rate
+
+
+class Backoff:
+    """Exponential backoff, counted separately for every exception class.
+    The nth failure in a row of a class waits base * factor ** (n - 1)
+    seconds, up to max_delay. Classes (and their subclasses) can be given
+    their own base, such as 0 for errors that are part of normal operation.
+    """
+
+    def __init__(self, base: float = 0.5,
+                 factor: float = 2,
+                 max_delay: float = 30,
+                 bases: Optional[Dict[Type[BaseException], float]] = None):
+        self.base = base
+        self.factor = factor
+        self.max_delay = max_delay
+        self.bases = bases or {}
+        self._failures: Dict[Type[BaseException], int] = {}
+
+    def failed(self, exc: BaseException) -> float:
+        """Record a failure, and return how many seconds to wait"""
+        exc_type = type(exc)
+        failures = self._failures[exc_type] = \
+            self._failures.get(exc_type, 0) + 1
+        return min(self.max_delay,
+                   self._base(exc_type) * self.factor ** (failures - 1))
+
+    def succeeded(self):
+        """Start counting failures from scratch"""
+        self._failures.clear()
+
+    def _base(self, exc_type: Type[BaseException]) -> float:
+        for cls in exc_type.__mro__:
+            if cls in self.bases:
+                return self.bases[cls]
+        return self.base
+
+
+SERVER_BUDGET = TokenBucket(rate=100, burst=20)
+"""Steps per second shared by every turtle served by this process"""
+
+
+class Scheduler:
+    """Decides when a turtle runs its next step. A step has to wait for both
+    the turtle's own token bucket and the server's, which is shared by every
+    turtle. After a failed step, the turtle also backs off for a while,
+    depending on how often that kind of error happened in a row.
+
+    Usage:
+        scheduler = Scheduler(TokenBucket(rate=20, burst=10))
+        while True:
+            runtime.sleep(scheduler.before_step())
+            try:
+                step()
+            except Exception as e:
+                runtime.sleep(scheduler.failed(e))
+            else:
+                scheduler.succeeded()
+    """
+
+    def __init__(self, bucket: TokenBucket,
+                 server_budget: Optional[TokenBucket] = SERVER_BUDGET,
+                 backoff: Optional[Backoff] = None):
+        self.bucket = bucket
+        self.server_budget = server_budget
+        self.backoff = backoff or Backoff(
+            # Being blocked is part of navigating, so retry right away
+            bases={lua_errors.TurtleBlockedError: 0})
+
+    def before_step(self, now: Optional[float] = None) -> float:
+        """Reserve the next step, and return how many seconds to wait before
+        running it"""
+        now = time() if now is None else now
+        wait = self.bucket.reserve(now)
+        if self.server_budget is not None:
+            wait = max(wait, self.server_budget.reserve(now))
+        return wait
+
+    def failed(self, exc: BaseException) -> float:
+        """Return how many seconds to back off for after a failed step"""
+        return self.backoff.failed(exc)
+
+    def succeeded(self):
+        self.backoff.succeeded()
+
+
+__all__ = ["TokenBucket", "Backoff", "Scheduler", "SERVER_BUDGET"]
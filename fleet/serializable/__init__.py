@@ -1,2 +1,4 @@
-from .base import BaseSerializable
+from .base import BaseSerializable, BinarySerializable
 from .map import Map
+from .path_cache import PathCache
+from .codecs import Codec, JsonCodec, BinaryCodec
@@ -1,4 +1,4 @@
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Callable
 
 from abc import ABC, abstractmethod, abstractclassmethod
 
@@ -11,4 +11,47 @@ class BaseSerializable(ABC):
     @classmethod
     @abstractmethod
     def from_dict(cls, obj: Dict[str, Any]) -> 'BaseSerializable':
-        """Get the class from a serializable object"""
+        """Get the class from a serializable object. This must accept either
+        the output of to_dict() or of to_native_dict()"""
+
+    def to_native_dict(self) -> Dict[str, Any]:
+        """Like to_dict(), but numpy arrays may be left as-is, for codecs that
+        can store them natively"""
+        return self.to_dict()
+
+    def transient_state(self) -> Any:
+        """Return anything that isn't worth persisting, but that should carry
+        over to the next time the object is read back within this process,
+        such as caches. The StateAttr the object is written to keeps it in
+        memory and passes it to restore_transient_state()."""
+        return None
+
+    def restore_transient_state(self, state: Any):
+        """Restore what transient_state() returned, if it still applies"""
+
+
+class BinarySerializable(BaseSerializable):
+    """A serializable that can keep its bulk data in binary 'parts' stored
+    outside of the state file. The state file then only holds the small header
+    returned by to_header(), and only parts that changed need to be rewritten.
+    """
+
+    @abstractmethod
+    def to_header(self) -> Dict[str, Any]:
+        """Return a small serializable python object describing this object.
+        It must contain a "parts" key, listing the names of every part."""
+
+    @abstractmethod
+    def dump_parts(self, only_dirty: bool = True) \
+            -> Dict[str, Optional[bytes]]:
+        """Return {part name: bytes} for parts that changed since the last
+        dump, and mark them as clean. A value of None means the part should be
+        deleted.
+        :param only_dirty: If False, dump every part regardless of changes
+        """
+
+    @classmethod
+    @abstractmethod
+    def from_parts(cls, header: Dict[str, Any],
+                   load_part: Callable[[str], bytes]) -> 'BinarySerializable':
+        """Get the class from a header and a function to load each part"""
@@ -0,0 +1,200 @@
+"""Codecs convert the state dict to and from bytes, for StateFile"""
+import json
+import struct
+from abc import ABC, abstractmethod
+from typing import Any, Tuple
+
+import numpy as np
+
+
+class Codec(ABC):
+    extension: str
+    """The file extension used for state files written with this codec"""
+
+    native_arrays: bool
+    """If True, numpy arrays can be passed to dumps() as-is, and loads() will
+    return them as (read-only) numpy arrays. Otherwise, arrays must first be
+    converted to lists."""
+
+    @abstractmethod
+    def dumps(self, obj: Any) -> bytes:
+        """Serialize an object"""
+
+    @abstractmethod
+    def loads(self, data: bytes) -> Any:
+        """Deserialize an object"""
+
+
+class JsonCodec(Codec):
+    """Human readable, which is great for debugging, but slow for anything
+    large"""
+    extension = "json"
+    native_arrays = False
+
+    def dumps(self, obj: Any) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+
+    def loads(self, data: bytes) -> Any:
+        return json.loads(data)
+
+
+_INT64 = struct.Struct("<q")
+_FLOAT64 = struct.Struct("<d")
+_LENGTH = struct.Struct("<I")
+_ARRAY_HEADER = struct.Struct("<BB")
+"""(length of the dtype string, number of dimensions)"""
+_ARRAY_ALIGNMENT = 16
+
+
+class BinaryCodec(Codec):
+    """A compact, msgpack-style binary encoding. Every value is a single tag
+    byte followed by a fixed layout:
+
+        N, T, F     None, True, False
+        i           int64
+        I           <u32 length> arbitrary sized signed little-endian int
+        d           float64
+        s, b        <u32 length> utf-8 string or raw bytes
+        l           <u32 count> items (tuples are encoded as lists)
+        m           <u32 count> key, value pairs
+        a           <u8 dtype length> <u8 ndim> dtype string, <i64> * ndim
+                    shape, padding up to 16 bytes, then the raw C-ordered
+                    array buffer
+
+    Numpy arrays keep their dtype, and are decoded without copying the
+    underlying buffer.
+    """
+    extension = "bin"
+    native_arrays = True
+
+    def dumps(self, obj: Any) -> bytes:
+        buffer = bytearray()
+        self._encode(obj, buffer)
+        return bytes(buffer)
+
+    def loads(self, data: bytes) -> Any:
+        view = memoryview(data)
+        obj, offset = self._decode(view, 0)
+        if offset != len(view):
+            raise ValueError(f"Found {len(view) - offset} trailing bytes!")
+        return obj
+
+    def _encode(self, obj: Any, buffer: bytearray):
+        if obj is None:
+            buffer += b"N"
+        elif obj is True:
+            buffer += b"T"
+        elif obj is False:
+            buffer += b"F"
+        elif isinstance(obj, np.ndarray):
+            self._encode_array(obj, buffer)
+        elif isinstance(obj, np.generic):
+            self._encode(obj.item(), buffer)
+        elif isinstance(obj, int):
+            if -2 ** 63 <= obj < 2 ** 63:
+                buffer += b"i"
+                buffer += _INT64.pack(obj)
+            else:
+                raw = obj.to_bytes((obj.bit_length() + 8) // 8, "little",
+                                   signed=True)
+                buffer += b"I"
+                buffer += _LENGTH.pack(len(raw))
+                buffer += raw
+        elif isinstance(obj, float):
+            buffer += b"d"
+            buffer += _FLOAT64.pack(obj)
+        elif isinstance(obj, str):
+            raw = obj.encode("utf-8")
+            buffer += b"s"
+            buffer += _LENGTH.pack(len(raw))
+            buffer += raw
+        elif isinstance(obj, (bytes, bytearray)):
+            buffer += b"b"
+            buffer += _LENGTH.pack(len(obj))
+            buffer += obj
+        elif isinstance(obj, (list, tuple)):
+            buffer += b"l"
+            buffer += _LENGTH.pack(len(obj))
+            for item in obj:
+                self._encode(item, buffer)
+        elif isinstance(obj, dict):
+            buffer += b"m"
+            buffer += _LENGTH.pack(len(obj))
+            for key, value in obj.items():
+                self._encode(key, buffer)
+                self._encode(value, buffer)
+        else:
+            raise TypeError(f"Unable to encode type {type(obj)}: {obj}")
+
+    @staticmethod
+    def _encode_array(array: np.ndarray, buffer: bytearray):
+        if array.dtype.hasobject:
+            raise TypeError("Arrays of python objects can't be encoded!")
+
+        dtype = array.dtype.str.encode("ascii")
+        buffer += b"a"
+        buffer += _ARRAY_HEADER.pack(len(dtype), array.ndim)
+        buffer += dtype
+        for dim in array.shape:
+            buffer += _INT64.pack(dim)
+        buffer += bytes(-len(buffer) % _ARRAY_ALIGNMENT)
+        buffer += np.ascontiguousarray(array).tobytes()
+
+    def _decode(self, view: memoryview, offset: int) -> Tuple[Any, int]:
+        tag = view[offset:offset + 1].tobytes()
+        offset += 1
+
+        if tag == b"N":
+            return None, offset
+        if tag == b"T":
+            return True, offset
+        if tag == b"F":
+            return False, offset
+        if tag == b"i":
+            return _INT64.unpack_from(view, offset)[0], offset + _INT64.size
+        if tag == b"d":
+            return (_FLOAT64.unpack_from(view, offset)[0],
+                    offset + _FLOAT64.size)
+        if tag == b"a":
+            return self._decode_array(view, offset)
+
+        length = _LENGTH.unpack_from(view, offset)[0]
+        offset += _LENGTH.size
+        if tag == b"I":
+            return (int.from_bytes(view[offset:offset + length], "little",
+                                   signed=True),
+                    offset + length)
+        if tag == b"s":
+            return (str(view[offset:offset + length], encoding="utf-8"),
+                    offset + length)
+        if tag == b"b":
+            return view[offset:offset + length].tobytes(), offset + length
+        if tag == b"l":
+            items = []
+            for _ in range(length):
+                item, offset = self._decode(view, offset)
+                items.append(item)
+            return items, offset
+        if tag == b"m":
+            obj = {}
+            for _ in range(length):
+                key, offset = self._decode(view, offset)
+                obj[key], offset = self._decode(view, offset)
+            return obj, offset
+
+        raise ValueError(f"Unknown tag {tag} at offset {offset - 1}")
+
+    @staticmethod
+    def _decode_array(view: memoryview, offset: int) -> Tuple[np.ndarray, int]:
+        dtype_length, ndim = _ARRAY_HEADER.unpack_from(view, offset)
+        offset += _ARRAY_HEADER.size
+        dtype = np.dtype(view[offset:offset + dtype_length].tobytes()
+                         .decode("ascii"))
+        offset += dtype_length
+        shape = struct.unpack_from(f"<{ndim}q", view, offset)
+        offset += _INT64.size * ndim
+        offset += -offset % _ARRAY_ALIGNMENT
+
+        count = int(np.prod(shape, dtype=np.int64))
+        array = np.frombuffer(view, dtype=dtype, count=count, offset=offset)
+        return array.reshape(shape), offset + count * dtype.itemsize
@@ -1,32 +1,70 @@
-from typing import Dict, Any, Union, Tuple, List
+from collections import deque
+from typing import Dict, Any, Union, Tuple, List, Optional, Callable
 
 import numpy as np
 
-from fleet import math_utils
-from fleet.serializable.base import BaseSerializable
+from fleet.math_utils import pack_position
+from fleet.serializable.base import BinarySerializable
+from fleet.serializable.obstacles import ArrayObstacles, ChunkedObstacles
 
+ARRAY_PART = "obstacles.npy"
+"""The part name that array obstacle storage is kept in"""
 
-class Map(BaseSerializable):
+CHANGE_LOG_LENGTH = 64
+"""How many of the most recent obstacle changes a Map remembers"""
+
+
+def _chunk_part(chunk_coord: Tuple[int, int, int]) -> str:
+    return "chunk.{}.{}.{}.bin".format(*chunk_coord)
+
+
+def _part_chunk(part: str) -> Tuple[int, int, int]:
+    _, x, y, z, _ = part.split(".")
+    return int(x), int(y), int(z)
+
+
+class Map(BinarySerializable):
     def __init__(self, position: Union[Tuple[int], List[int]],
                  direction: int,
-                 obstacles: Union[np.ndarray, List[List[int]]] = None):
+                 obstacles: Union[np.ndarray, List[List[int]]] = None,
+                 chunked: bool = False,
+                 version: int = 0):
         """
         :param position: The current position in the map
         :param direction: The direction the turtle is facing in the map
         :param obstacles: The point cloud of all obstacles ever encountered
+        :param chunked: If True, obstacles are stored in sparse bit-packed
+        chunks instead of a single array. This is much cheaper to mutate for
+        large maps, but `obstacles` will no longer be in insertion order.
+        :param version: How many times obstacles have been added or removed
         """
         self.position: np.ndarray = np.array(position)
-        self.obstacles: np.ndarray = (
-            np.zeros(shape=(0, 3), dtype=np.int8)
-            if obstacles is None or len(obstacles) == 0 else
-            np.array(obstacles))
         self.direction: int = direction
+        self.chunked = chunked
+        self._obstacles: Union[ArrayObstacles, ChunkedObstacles] = (
+            ChunkedObstacles(obstacles) if chunked else
+            ArrayObstacles(obstacles))
+
+        self.version = version
+        """Incremented on every change to the obstacles, so that anything
+        derived from the map (such as a path) can tell whether it's stale"""
+
+        self._changes = deque(maxlen=CHANGE_LOG_LENGTH)
+        """The keys of the most recent obstacle changes, oldest first. This
+        is transient state rather than persisted, since everything that reads
+        it lives in memory and is rebuilt after a restart anyway."""
 
     def __repr__(self):
-        return f"Map(n_obstacles={len(self.obstacles)}, " \
+        return f"Map(n_obstacles={len(self._obstacles)}, " \
                f"position={self.position}," \
                f"direction={self.direction})"
 
+    @property
+    def obstacles(self) -> np.ndarray:
+        """The point cloud of all obstacles ever encountered, as an (n, 3)
+        array"""
+        return self._obstacles.to_array()
+
     def move_to(self, position: Union[np.ndarray, Tuple]):
         """Move to an adjacent block relative to the current position"""
         position = np.array(position)
@@ -34,27 +72,129 @@ class Map(BaseSerializable):
         self.position = position
 
     def remove_obstacle(self, position):
-        """Clear an obstacle if it exists in the array"""
-        delete_row = np.where((self.obstacles == position).all(axis=1))
-        self.obstacles = np.delete(self.obstacles, delete_row, axis=0)
+        """Clear an obstacle if it exists in the map"""
+        if self._obstacles.remove(position):
+            self._record_change(position)
 
     def add_obstacle(self, position: Union[np.ndarray, List]):
-        if self.is_known_obstacle(position):
-            # This obstacle is already registered. No need to register it!
-            return
-        self.obstacles = np.vstack((self.obstacles, position))
+        if self._obstacles.add(position):
+            self._record_change(position)
+
+    def _record_change(self, position):
+        self.version += 1
+        self._changes.append(pack_position(position))
+
+    def changes_since(self, version: int) -> Optional[List[int]]:
+        """Return the math_utils.pack_position keys of every obstacle that was
+        added or removed since `version`, oldest first. A position may appear
+        more than once. Returns None if the map no longer remembers that far
+        back, in which case everything should be considered changed."""
+        n_changes = self.version - version
+        if n_changes < 0 or n_changes > len(self._changes):
+            return None
+        if n_changes == 0:
+            return []
+        return list(self._changes)[-n_changes:]
+
+    def transient_state(self) -> Tuple[int, Tuple[int, ...]]:
+        return self.version, tuple(self._changes)
+
+    def restore_transient_state(self, state: Tuple[int, Tuple[int, ...]]):
+        version, changes = state
+        if version == self.version:
+            self._changes.extend(changes)
 
     def is_known_obstacle(self, position: np.ndarray):
         """Returns whether this is a known obstacle"""
-        return any((self.obstacles == position).all(axis=1))
+        return position in self._obstacles
+
+    def is_known_obstacle_key(self, key: int) -> bool:
+        """Like is_known_obstacle, but for a math_utils.pack_position key"""
+        return self._obstacles.contains_key(key)
+
+    def obstacle_key_lookup(self) -> Callable[[int], bool]:
+        """Return the fastest available function for is_known_obstacle_key,
+        for hot loops such as path planning. It stays valid as the map is
+        mutated."""
+        return self._obstacles.key_lookup()
+
+    def to_chunk_buffers(self) -> Tuple[np.ndarray, np.ndarray, bytes]:
+        """Return the obstacles as ChunkedObstacles.to_buffers() does, whether
+        or not the map is chunked"""
+        obstacles = (self._obstacles if self.chunked
+                     else ChunkedObstacles(self.obstacles))
+        return obstacles.to_buffers()
+
+    @classmethod
+    def from_chunk_buffers(cls, position: Union[Tuple[int], List[int]],
+                           direction: int,
+                           chunk_coords: np.ndarray,
+                           counts: np.ndarray,
+                           data: bytes,
+                           version: int = 0) -> 'Map':
+        """Create a chunked map from the output of to_chunk_buffers()"""
+        map = cls(position=position, direction=direction, chunked=True,
+                  version=version)
+        map._obstacles = ChunkedObstacles.from_buffers(
+            chunk_coords, counts, data)
+        return map
 
     def to_dict(self) -> Dict[str, Any]:
         return {"position": self.position.tolist(),
                 "direction": self.direction,
-                "obstacles": self.obstacles.tolist()}
+                "obstacles": self.obstacles.tolist(),
+                "chunked": self.chunked,
+                "version": self.version}
+
+    def to_native_dict(self) -> Dict[str, Any]:
+        return {"position": self.position.tolist(),
+                "direction": self.direction,
+                "obstacles": self.obstacles,
+                "chunked": self.chunked,
+                "version": self.version}
 
     @classmethod
     def from_dict(cls, obj: Dict[str, Any]) -> 'Map':
-        return cls(obstacles=np.array(obj["obstacles"]),
+        return cls(obstacles=np.asarray(obj["obstacles"]),
                    position=obj["position"],
-                   direction=obj["direction"])
+                   direction=obj["direction"],
+                   chunked=obj.get("chunked", False),
+                   version=obj.get("version", 0))
+
+    def to_header(self) -> Dict[str, Any]:
+        parts = ([_chunk_part(c) for c in self._obstacles.chunks]
+                 if self.chunked else [ARRAY_PART])
+        return {"position": self.position.tolist(),
+                "direction": self.direction,
+                "chunked": self.chunked,
+                "parts": sorted(parts),
+                "version": self.version}
+
+    def dump_parts(self, only_dirty: bool = True) \
+            -> Dict[str, Optional[bytes]]:
+        if not self.chunked:
+            if only_dirty and not self._obstacles.dirty:
+                return {}
+            return {ARRAY_PART: self._obstacles.to_bytes()}
+
+        dirty = self._obstacles.pop_dirty_chunks()
+        if not only_dirty:
+            dirty.update({chunk_coord: bytes(chunk) for chunk_coord, chunk
+                          in self._obstacles.chunks.items()})
+        return {_chunk_part(chunk_coord): data
+                for chunk_coord, data in dirty.items()}
+
+    @classmethod
+    def from_parts(cls, header: Dict[str, Any],
+                   load_part: Callable[[str], bytes]) -> 'Map':
+        map = cls(position=header["position"],
+                  direction=header["direction"],
+                  chunked=header["chunked"],
+                  version=header.get("version", 0))
+        if header["chunked"]:
+            map._obstacles = ChunkedObstacles.from_chunks(
+                {_part_chunk(part): load_part(part)
+                 for part in header["parts"]})
+        else:
+            map._obstacles = ArrayObstacles.from_bytes(load_part(ARRAY_PART))
+        return map
@@ -0,0 +1,334 @@
+"""Storage backends for the obstacles in a Map. Both backends expose the same
+small interface, so Map doesn't need to care which one it's using."""
+from io import BytesIO
+from typing import Dict, Set, Tuple, Sequence, Optional, Iterable, Callable
+
+import numpy as np
+
+from fleet import math_utils
+
+ChunkCoord = Tuple[int, int, int]
+
+
+class ArrayObstacles:
+    """Keeps obstacles as rows in a single (n, 3) array, in insertion order.
+    Every mutation copies the array, but it's simple and cheap for small maps.
+    """
+
+    SCANS_BEFORE_INDEX = 16
+    """How many lookups scan the whole array before an index of keys is built.
+    A scan is a single vectorized comparison, which is far cheaper than
+    building the index when only a few positions are ever looked up, such as
+    when a map is loaded for a single step."""
+
+    def __init__(self, obstacles: Optional[Iterable[Sequence[int]]] = None):
+        self.array: np.ndarray = (
+            np.zeros(shape=(0, 3), dtype=np.int64)
+            if obstacles is None or len(obstacles) == 0 else
+            np.asarray(obstacles, dtype=np.int64))
+
+        self._keys: Optional[Set[int]] = None
+        """An index of math_utils.pack_position keys for every row in
+        self.array, so that lookups don't have to scan the whole array. It's
+        built once SCANS_BEFORE_INDEX lookups were made, since many reads
+        only look at a few obstacles, if any."""
+        self._scans = 0
+
+        self.dirty = True
+        """True if the array changed since it was last converted to_bytes()"""
+
+    @property
+    def keys(self) -> Set[int]:
+        if self._keys is None:
+            self._keys = set(math_utils.pack_positions(self.array))
+        return self._keys
+
+    def __len__(self):
+        return len(self.array)
+
+    def __contains__(self, position: Sequence[int]) -> bool:
+        if self._keys is None and self._scans < self.SCANS_BEFORE_INDEX:
+            self._scans += 1
+            return bool(self._rows(position).any())
+        return math_utils.pack_position(position) in self.keys
+
+    def contains_key(self, key: int) -> bool:
+        """Like __contains__, but for a math_utils.pack_position key"""
+        return key in self.keys
+
+    def key_lookup(self) -> Callable[[int], bool]:
+        return self.keys.__contains__
+
+    def add(self, position: Sequence[int]) -> bool:
+        """Returns True if the obstacle wasn't already stored"""
+        if position in self:
+            return False
+        self.array = np.vstack((self.array, position))
+        if self._keys is not None:
+            self._keys.add(math_utils.pack_position(position))
+        self.dirty = True
+        return True
+
+    def remove(self, position: Sequence[int]) -> bool:
+        """Returns True if there was an obstacle to remove"""
+        if position not in self:
+            return False
+        self.array = self.array[~self._rows(position)]
+        if self._keys is not None:
+            self._keys.remove(math_utils.pack_position(position))
+        self.dirty = True
+        return True
+
+    def _rows(self, position: Sequence[int]) -> np.ndarray:
+        """A mask of the rows that hold the position. Comparing each column on
+        its own is much faster than comparing whole rows."""
+        x, y, z = position
+        return ((self.array[:, 0] == x)
+                & (self.array[:, 1] == y)
+                & (self.array[:, 2] == z))
+
+    def to_array(self) -> np.ndarray:
+        return self.array
+
+    def to_bytes(self) -> bytes:
+        """Serialize the array in the .npy format, and mark it as clean"""
+        buffer = BytesIO()
+        np.save(buffer, self.array, allow_pickle=False)
+        self.dirty = False
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'ArrayObstacles':
+        obstacles = cls(np.load(BytesIO(data), allow_pickle=False))
+        obstacles.dirty = False
+        return obstacles
+
+
+class ChunkedObstacles:
+    """Keeps obstacles in CHUNK_SIZE**3 chunks, where each chunk is a bit-packed
+    occupancy grid. Chunks are only allocated once they hold an obstacle, and
+    are freed again once empty, so memory follows the explored area and every
+    mutation is O(1).
+
+    Within a chunk, the voxel at local (lx, ly, lz) is bit `i % 8` of byte
+    `i // 8`, where i = (lx * CHUNK_SIZE + ly) * CHUNK_SIZE + lz.
+    """
+    CHUNK_BITS = 4
+    CHUNK_SIZE = 1 << CHUNK_BITS
+    CHUNK_BYTES = CHUNK_SIZE ** 3 // 8
+
+    def __init__(self, obstacles: Optional[Iterable[Sequence[int]]] = None):
+        self.chunks: Dict[ChunkCoord, bytearray] = {}
+        """Maps chunk coordinates to the occupancy bits of that chunk"""
+
+        self._chunk_counts: Dict[ChunkCoord, int] = {}
+        """How many obstacles each chunk holds, so empty chunks can be freed"""
+
+        self._n_obstacles = 0
+
+        self.dirty_chunks: Set[ChunkCoord] = set()
+        """Chunks that changed (or were freed) since they were last converted
+        with pop_dirty_chunks()"""
+
+        if obstacles is not None and len(obstacles):
+            self._load(np.asarray(obstacles, dtype=np.int64).reshape(-1, 3))
+
+    def __len__(self):
+        return self._n_obstacles
+
+    def _load(self, positions: np.ndarray):
+        """A vectorized equivalent of calling add() for each position, for
+        when the store is empty"""
+        bits, mask = self.CHUNK_BITS, self.CHUNK_SIZE - 1
+        chunk_coords = positions >> bits
+        local = positions & mask
+        indices = ((local[:, 0] << (bits * 2))
+                   | (local[:, 1] << bits)
+                   | local[:, 2])
+
+        # Sort by chunk then by bit index, and drop duplicate obstacles so
+        # that the per-chunk counts are right
+        order = np.lexsort((indices, chunk_coords[:, 2], chunk_coords[:, 1],
+                            chunk_coords[:, 0]))
+        chunk_coords, indices = chunk_coords[order], indices[order]
+        new_chunk = np.ones(len(order), dtype=bool)
+        new_chunk[1:] = (chunk_coords[1:] != chunk_coords[:-1]).any(axis=1)
+        unique = new_chunk.copy()
+        unique[1:] |= indices[1:] != indices[:-1]
+        chunk_ids = (np.cumsum(new_chunk) - 1)[unique]
+        indices = indices[unique]
+        chunk_coords = chunk_coords[new_chunk]
+
+        occupancy = np.zeros((len(chunk_coords), self.CHUNK_BYTES),
+                             dtype=np.uint8)
+        np.bitwise_or.at(occupancy, (chunk_ids, indices >> 3),
+                         (1 << (indices & 7)).astype(np.uint8))
+        counts = np.bincount(chunk_ids, minlength=len(chunk_coords))
+
+        data = memoryview(occupancy.tobytes())
+        for i, (chunk_coord, count) in enumerate(
+                zip(map(tuple, chunk_coords.tolist()), counts.tolist())):
+            self.chunks[chunk_coord] = bytearray(
+                data[i * self.CHUNK_BYTES:(i + 1) * self.CHUNK_BYTES])
+            self._chunk_counts[chunk_coord] = count
+            self.dirty_chunks.add(chunk_coord)
+        self._n_obstacles = len(indices)
+
+    def _locate(self, position: Sequence[int]) -> Tuple[ChunkCoord, int]:
+        """Return the chunk coordinate and the bit index within that chunk"""
+        x, y, z = int(position[0]), int(position[1]), int(position[2])
+        bits, mask = self.CHUNK_BITS, self.CHUNK_SIZE - 1
+        chunk = (x >> bits, y >> bits, z >> bits)
+        index = (((x & mask) << bits | (y & mask)) << bits) | (z & mask)
+        return chunk, index
+
+    def __contains__(self, position: Sequence[int]) -> bool:
+        chunk_coord, index = self._locate(position)
+        chunk = self.chunks.get(chunk_coord)
+        if chunk is None:
+            return False
+        return bool(chunk[index >> 3] >> (index & 7) & 1)
+
+    def contains_key(self, key: int) -> bool:
+        """Like __contains__, but for a math_utils.pack_position key"""
+        # Packed axes are offset by a multiple of CHUNK_SIZE, so the chunk and
+        # local coordinates can be read straight from the offset axes
+        bits, mask = self.CHUNK_BITS, self.CHUNK_SIZE - 1
+        key_bits = math_utils.KEY_BITS
+        key_mask = (1 << key_bits) - 1
+        offset = (1 << (key_bits - 1)) >> bits
+        x, y, z = key >> (key_bits * 2), key >> key_bits & key_mask, \
+            key & key_mask
+        chunk = self.chunks.get((
+            (x >> bits) - offset,
+            (y >> bits) - offset,
+            (z >> bits) - offset))
+        if chunk is None:
+            return False
+        index = (((x & mask) << bits | (y & mask)) << bits) | (z & mask)
+        return bool(chunk[index >> 3] >> (index & 7) & 1)
+
+    def key_lookup(self) -> Callable[[int], bool]:
+        return self.contains_key
+
+    def add(self, position: Sequence[int]) -> bool:
+        """Returns True if the obstacle wasn't already stored"""
+        chunk_coord, index = self._locate(position)
+        chunk = self.chunks.get(chunk_coord)
+        if chunk is None:
+            chunk = self.chunks[chunk_coord] = bytearray(self.CHUNK_BYTES)
+            self._chunk_counts[chunk_coord] = 0
+
+        bit = 1 << (index & 7)
+        if chunk[index >> 3] & bit:
+            return False
+        chunk[index >> 3] |= bit
+        self._chunk_counts[chunk_coord] += 1
+        self._n_obstacles += 1
+        self.dirty_chunks.add(chunk_coord)
+        return True
+
+    def remove(self, position: Sequence[int]) -> bool:
+        """Returns True if there was an obstacle to remove"""
+        chunk_coord, index = self._locate(position)
+        chunk = self.chunks.get(chunk_coord)
+        bit = 1 << (index & 7)
+        if chunk is None or not chunk[index >> 3] & bit:
+            return False
+
+        chunk[index >> 3] &= ~bit
+        self._n_obstacles -= 1
+        self.dirty_chunks.add(chunk_coord)
+        self._chunk_counts[chunk_coord] -= 1
+        if self._chunk_counts[chunk_coord] == 0:
+            del self.chunks[chunk_coord]
+            del self._chunk_counts[chunk_coord]
+        return True
+
+    def chunk_positions(self, chunk_coord: ChunkCoord) -> np.ndarray:
+        """Return an (n, 3) array of the obstacles within a single chunk"""
+        chunk = self.chunks.get(chunk_coord)
+        if chunk is None:
+            return np.zeros(shape=(0, 3), dtype=np.int64)
+
+        bits, mask = self.CHUNK_BITS, self.CHUNK_SIZE - 1
+        occupied = np.unpackbits(
+            np.frombuffer(chunk, dtype=np.uint8), bitorder="little")
+        indices = np.flatnonzero(occupied)
+        local = np.stack((indices >> (bits * 2),
+                          (indices >> bits) & mask,
+                          indices & mask), axis=1)
+        return local + np.array(chunk_coord, dtype=np.int64) * self.CHUNK_SIZE
+
+    def to_array(self) -> np.ndarray:
+        if not self.chunks:
+            return np.zeros(shape=(0, 3), dtype=np.int64)
+
+        chunk_coords = np.array(list(self.chunks), dtype=np.int64)
+        occupancy = np.frombuffer(b"".join(self.chunks.values()),
+                                  dtype="<u8").reshape(len(chunk_coords), -1)
+
+        # Only unpack the words that hold anything, since maps are sparse
+        chunk_ids, word_ids = np.nonzero(occupancy)
+        words = occupancy[chunk_ids, word_ids].view(np.uint8).reshape(-1, 8)
+        rows, bit_ids = np.nonzero(
+            np.unpackbits(words, axis=1, bitorder="little"))
+        indices = word_ids[rows] * 64 + bit_ids
+        chunk_ids = chunk_ids[rows]
+
+        bits, mask = self.CHUNK_BITS, self.CHUNK_SIZE - 1
+        local = np.stack((indices >> (bits * 2),
+                          (indices >> bits) & mask,
+                          indices & mask), axis=1)
+        return local + chunk_coords[chunk_ids] * self.CHUNK_SIZE
+
+    def pop_dirty_chunks(self) -> Dict[ChunkCoord, Optional[bytes]]:
+        """Return the bytes of every chunk that changed since the last call,
+        and mark them as clean. Chunks that were freed map to None."""
+        dirty = {chunk_coord: (bytes(self.chunks[chunk_coord])
+                               if chunk_coord in self.chunks else None)
+                 for chunk_coord in self.dirty_chunks}
+        self.dirty_chunks.clear()
+        return dirty
+
+    def to_buffers(self) -> Tuple[np.ndarray, np.ndarray, bytes]:
+        """Return the (m, 3) coordinates and the (m,) obstacle counts of every
+        chunk, along with the occupancy bits of every chunk joined in the same
+        order. This is the cheapest way to copy the whole store."""
+        chunk_coords = np.array(list(self.chunks), dtype=np.int64)
+        counts = np.array([self._chunk_counts[chunk_coord]
+                           for chunk_coord in self.chunks], dtype=np.int64)
+        return (chunk_coords.reshape(-1, 3), counts,
+                b"".join(self.chunks.values()))
+
+    @classmethod
+    def from_buffers(cls, chunk_coords: np.ndarray, counts: np.ndarray,
+                     data: bytes) -> 'ChunkedObstacles':
+        """The inverse of to_buffers()"""
+        assert len(data) == len(chunk_coords) * cls.CHUNK_BYTES, \
+            "The chunk buffers are corrupted!"
+        obstacles = cls()
+        data = memoryview(data)
+        for i, (chunk_coord, count) in enumerate(
+                zip(map(tuple, chunk_coords.tolist()), counts.tolist())):
+            obstacles.chunks[chunk_coord] = bytearray(
+                data[i * cls.CHUNK_BYTES:(i + 1) * cls.CHUNK_BYTES])
+            obstacles._chunk_counts[chunk_coord] = count
+        obstacles._n_obstacles = int(counts.sum())
+        return obstacles
+
+    @classmethod
+    def from_chunks(cls, chunks: Dict[ChunkCoord, bytes]) \
+            -> 'ChunkedObstacles':
+        obstacles = cls()
+        for chunk_coord, data in chunks.items():
+            assert len(data) == cls.CHUNK_BYTES, \
+                f"Chunk {chunk_coord} is corrupted!"
+            count = int(np.unpackbits(
+                np.frombuffer(data, dtype=np.uint8)).sum())
+            if count == 0:
+                continue
+            obstacles.chunks[chunk_coord] = bytearray(data)
+            obstacles._chunk_counts[chunk_coord] = count
+            obstacles._n_obstacles += count
+        return obstacles
@@ -0,0 +1,98 @@
+from typing import Dict, Any, Optional, Sequence
+
+import numpy as np
+
+from fleet.math_utils import pack_positions
+from fleet.serializable.base import BaseSerializable
+from fleet.serializable.map import Map
+
+
+class PathCache(BaseSerializable):
+    def __init__(self, to_pos: Optional[Sequence[int]] = None,
+                 obstacle_cost: Optional[float] = None,
+                 path: Optional[np.ndarray] = None,
+                 path_obstacles: Optional[np.ndarray] = None):
+        """A planned path, which is consumed one step at a time as the turtle
+        moves along it.
+
+        :param to_pos: The target the path was planned toward
+        :param obstacle_cost: The obstacle cost the path was planned with
+        :param path: An (n, 3) array of the remaining path. The first position
+        is where the turtle was last known to be along the path.
+        :param path_obstacles: An (n,) bool array of whether each position in
+        the path was a known obstacle when the path was planned
+        """
+        self.to_pos = None if to_pos is None else list(to_pos)
+        self.obstacle_cost = obstacle_cost
+        self.path: np.ndarray = (
+            np.zeros(shape=(0, 3), dtype=np.int64) if path is None
+            else np.asarray(path, dtype=np.int64).reshape(-1, 3))
+        self.path_obstacles: np.ndarray = (
+            np.zeros(shape=(len(self.path),), dtype=bool)
+            if path_obstacles is None
+            else np.asarray(path_obstacles, dtype=bool))
+
+    def __repr__(self):
+        return f"PathCache(to_pos={self.to_pos}, " \
+               f"remaining={len(self.path)})"
+
+    @classmethod
+    def plan(cls, to_pos: Sequence[int], obstacle_cost: float,
+             path: Sequence[Sequence[int]], map: Map) -> 'PathCache':
+        """Cache a freshly planned path"""
+        path = np.asarray(path, dtype=np.int64).reshape(-1, 3)
+        lookup = map.obstacle_key_lookup()
+        return cls(to_pos=to_pos,
+                   obstacle_cost=obstacle_cost,
+                   path=path,
+                   path_obstacles=[lookup(key)
+                                   for key in pack_positions(path)])
+
+    def next_position(self, map: Map, to_pos: Sequence[int],
+                      obstacle_cost: float) -> Optional[np.ndarray]:
+        """Return the next position to move to, or None if the path has to be
+        replanned. Steps that the turtle has taken since the last call are
+        consumed from the path.
+
+        The path is considered stale if it was planned for a different target
+        or obstacle cost, if the turtle isn't where the path expects it to be,
+        or if an obstacle was added or removed anywhere on the remaining path
+        ahead of the turtle.
+        """
+        if (self.to_pos != list(to_pos)
+                or self.obstacle_cost != obstacle_cost):
+            return None
+
+        # The turtle has either not moved yet, or it moved one step along the
+        # path since the last call
+        position = map.position
+        if len(self.path) >= 2 and (self.path[1] == position).all():
+            self.path = self.path[1:]
+            self.path_obstacles = self.path_obstacles[1:]
+        if len(self.path) < 2 or not (self.path[0] == position).all():
+            return None
+
+        # The position the turtle is in can't be an obstacle anymore, even if
+        # it was one that the turtle dug through
+        lookup = map.obstacle_key_lookup()
+        obstacles = [lookup(key) for key in pack_positions(self.path[1:])]
+        if (obstacles != self.path_obstacles[1:]).any():
+            return None
+
+        return self.path[1]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"to_pos": self.to_pos,
+                "obstacle_cost": self.obstacle_cost,
+                "path": self.path.tolist(),
+                "path_obstacles": self.path_obstacles.tolist()}
+
+    def to_native_dict(self) -> Dict[str, Any]:
+        return {"to_pos": self.to_pos,
+                "obstacle_cost": self.obstacle_cost,
+                "path": self.path,
+                "path_obstacles": self.path_obstacles}
+
+    @classmethod
+    def from_dict(cls, obj: Dict[str, Any]) -> 'PathCache':
+        return cls(**obj)
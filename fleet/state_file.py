@@ -1,23 +1,61 @@
-import json
-import copy
+import struct
+import zlib
+from os import fsync
 from pathlib import Path
-from typing import Any, Callable
+from typing import Any, Callable, Dict, List, Optional, Set
 
 from atomicwrites import atomic_write
 import numpy as np
 from cc import fs, os
 
-from fleet.serializable import BaseSerializable
-from fleet import lua_errors
-
-STATE_FILE = "state_file.json"
+from fleet.serializable import (
+    BaseSerializable,
+    BinarySerializable,
+    Codec,
+    JsonCodec,
+    BinaryCodec
+)
+from fleet import lua_errors, runtime
+
+STATE_FILE = "state_file.{extension}"
+JOURNAL_FILE = STATE_FILE + ".journal"
 STATE_DIR = Path(".statefiles")
 
+CODECS = [JsonCodec, BinaryCodec]
+"""Every codec a state file might have been written with"""
+
+_RECORD_HEADER = struct.Struct("<II")
+"""Each journal record is prefixed with (payload length, payload crc32)"""
+
 
 class StateNotAcquiredError(Exception):
     """Raised when an action is performed that requires the statefile"""
 
 
+def _arrays_to_lists(obj):
+    """Recursively convert numpy arrays to lists, for codecs that can't store
+    arrays natively"""
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, dict):
+        return {key: _arrays_to_lists(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_arrays_to_lists(item) for item in obj]
+    return obj
+
+
+def _snapshot(obj):
+    """Recursively copy containers and numpy arrays, so that the copy shares
+    nothing mutable with the original"""
+    if isinstance(obj, np.ndarray):
+        return obj.copy()
+    if isinstance(obj, dict):
+        return {key: _snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(item) for item in obj)
+    return obj
+
+
 class StateAttr:
     def __init__(self, state_file: 'StateFile',
                  key_name: str,
@@ -25,8 +63,21 @@ class StateAttr:
         self.key_name = key_name
         self.default = default
         self.state_file = state_file
+        self._transient_state = None
+        """What the last BaseSerializable written returned from
+        transient_state(), kept in memory only"""
 
     def read(self):
+        """Read the value. Deserialized objects (BaseSerializables and numpy
+        arrays) are cached until the state file is released or the value is
+        written, so repeated reads within a step are free. Because of this,
+        mutations to a read object are seen by later reads within the step,
+        even if they aren't written.
+
+        Read values never share anything mutable with the state file, so
+        mutations are only ever saved once the value is written, whether or
+        not the state file is journaled.
+        """
         if self.state_file.being_held == 0:
             raise StateNotAcquiredError(
                 "You must run this action within a statefile context manager!")
@@ -34,9 +85,27 @@ class StateAttr:
         if self.key_name not in self.state_file.dict:
             """This must be a new addition"""
             return self.default
-        else:
-            value = self.state_file.dict[self.key_name]
 
+        cache = self.state_file.read_cache
+        if self.key_name in cache:
+            return cache[self.key_name]
+
+        value = self._load(self.state_file.dict[self.key_name])
+        if isinstance(value, (BaseSerializable, np.ndarray)):
+            cache[self.key_name] = value
+        return value
+
+    def _load(self, value):
+        """Deserialize a value from the state file dict, restoring whatever
+        transient state was kept for it"""
+        value = self._deserialize(_snapshot(value))
+        if (isinstance(value, BaseSerializable)
+                and self._transient_state is not None):
+            value.restore_transient_state(self._transient_state)
+        return value
+
+    def _deserialize(self, value):
+        """Convert a value from the state file dict to the type of default"""
         if isinstance(self.default, BaseSerializable):
             value = type(self.default).from_dict(value)
         elif isinstance(self.default, np.ndarray):
@@ -50,12 +119,129 @@ class StateAttr:
                 "You must run this action within a statefile context manager!")
         assert isinstance(value, type(self.default))
 
+        native_arrays = self.state_file.codec.native_arrays
         if isinstance(value, np.ndarray):
-            value = value.tolist()
+            value = value if native_arrays else value.tolist()
         elif isinstance(value, BaseSerializable):
-            value = value.to_dict()
+            self._transient_state = value.transient_state()
+            value = (value.to_native_dict() if native_arrays
+                     else value.to_dict())
+
+        # Snapshot the value, so that mutating it after it's written doesn't
+        # change what's saved
+        self.state_file.dict[self.key_name] = _snapshot(value)
+        self.state_file.mark_dirty(self.key_name)
+
+
+class SideFileStateAttr(StateAttr):
+    """This is a StateAttr for large BinarySerializable objects, such as Map.
+    The bulk of the object is stored in binary side-files next to the state
+    file, one file per part, and only parts that changed get rewritten. The
+    state file itself only holds the object's (small) header.
+
+    Side-files are never overwritten. Every write gets a new generation, and
+    changed parts are written to new files named after it. The header maps
+    each part to its file, so the new files only take effect once the header
+    is committed, and the files they replace are deleted after that.
+
+    The loaded object is also kept across steps, so that each step doesn't
+    re-read every side-file. It's reused for as long as its header matches
+    the stored one, which includes the object's version.
+    """
+
+    def __init__(self, state_file: 'StateFile',
+                 key_name: str,
+                 default: BinarySerializable):
+        assert isinstance(default, BinarySerializable)
+        self._loaded: Optional[BinarySerializable] = None
+        """The object that was last read or written"""
+        self._swept = False
+        """Whether side-files left over by an interrupted save were deleted"""
+        super().__init__(state_file, key_name, default)
+
+    @property
+    def side_file_dir(self) -> Path:
+        return self.state_file.side_file_dir(self.key_name)
+
+    def _load(self, value):
+        if (self._loaded is not None
+                and self._stored_header(self._loaded) == value):
+            return self._loaded
+        self._loaded = super()._load(value)
+        self._sweep(value)
+        return self._loaded
+
+    def _deserialize(self, value):
+        if "parts" not in value:
+            # This was written by a regular StateAttr, before it was moved to
+            # a side-file. It will be converted upon the next write.
+            return type(self.default).from_dict(value)
+
+        files = self._files(value)
+        return type(self.default).from_parts(
+            value,
+            lambda part: self.state_file.read_side_file(
+                self.side_file_dir / files[part]))
+
+    def write(self, value: BinarySerializable):
+        if self.state_file.being_held == 0:
+            raise StateNotAcquiredError(
+                "You must run this action within a statefile context manager!")
+        assert isinstance(value, type(self.default))
 
-        self.state_file.dict[self.key_name] = value
+        # If the side-files don't exist yet, every part must be written
+        previous = self.state_file.dict.get(self.key_name)
+        only_dirty = previous is not None and "parts" in previous
+        files = self._files(previous) if only_dirty else {}
+        generation = previous.get("generation", 0) + 1 if only_dirty else 1
+
+        self._transient_state = value.transient_state()
+        for part, data in value.dump_parts(only_dirty=only_dirty).items():
+            if part in files:
+                # Replaced files are deleted once the new header is saved
+                self.state_file.write_side_file(
+                    self.side_file_dir / files.pop(part), None)
+            if data is not None:
+                files[part] = f"{generation}.{part}"
+                self.state_file.write_side_file(
+                    self.side_file_dir / files[part], data)
+
+        header = value.to_header()
+        header["files"] = {part: files[part] for part in header["parts"]}
+        header["generation"] = generation
+        self.state_file.dict[self.key_name] = header
+        self.state_file.mark_dirty(self.key_name)
+        self._loaded = value
+
+    @staticmethod
+    def _files(header: Dict[str, Any]) -> Dict[str, str]:
+        """Return {part name: file name}. Headers written before parts were
+        versioned stored each part in a file named after the part."""
+        return dict(header.get("files") or
+                    {part: part for part in header["parts"]})
+
+    def _stored_header(self, value: BinarySerializable) -> Dict[str, Any]:
+        """What the state file would hold for the value, if it was written
+        and nothing has changed since"""
+        header = value.to_header()
+        stored = self.state_file.dict.get(self.key_name) or {}
+        for key in ("files", "generation"):
+            if key in stored:
+                header[key] = stored[key]
+        return header
+
+    def _sweep(self, header: Dict[str, Any]):
+        """Delete side-files that aren't referenced by the header, which a
+        program that died mid-save can leave behind"""
+        if self._swept or "parts" not in header:
+            return
+        self._swept = True
+        if not self.side_file_dir.is_dir():
+            return
+        referenced = set(self._files(header).values())
+        for path in self.side_file_dir.iterdir():
+            if path.name not in referenced and path.is_file():
+                self.state_file.write_side_file(path, None)
 
 
 class PromptStateAttr(StateAttr):
@@ -79,24 +265,74 @@ class PromptStateAttr(StateAttr):
 
 
 class StateFile:
-    """Read and write to the state file in as-safe a way as possible"""
-
-    def __init__(self, computer_id: int = None):
+    """Read and write to the state file in as-safe a way as possible
+
+    By default the whole state file is atomically rewritten whenever the state
+    changes. In journaled mode, only the keys that changed are appended (and
+    fsync'd) to a journal next to the state file, and the journal is compacted
+    into a fresh state file every SNAPSHOT_EVERY_N_RECORDS records or
+    SNAPSHOT_EVERY_N_BYTES bytes. Reading the state replays the journal on top
+    of the last snapshot. A record that was only partially written when the
+    program died fails its checksum, and is discarded along with anything
+    after it.
+
+    In journaled mode, intents can also be recorded with record_intent(), for
+    when several actions are performed before the state is saved. An intent
+    is a short description of an action that's about to be performed, and it
+    stays pending until the state is next saved. If the program dies first,
+    the pending intents are in `intents` once the state is read again, so
+    that whatever the actions changed can be recovered.
+    """
+    SNAPSHOT_EVERY_N_RECORDS = 500
+    SNAPSHOT_EVERY_N_BYTES = 1024 * 1024
+
+    def __init__(self, computer_id: int = None, journaled: bool = False,
+                 codec: Codec = None):
         self.dict = None
         """When being held, this shows all the key/value pairs of state"""
 
-        self._last_saved_dict = None
-        """Used to prevent saving to the StateFile when it's deemed unnecessary
-        """
+        self.read_cache: Dict[str, Any] = {}
+        """Deserialized values that StateAttr.read() has already produced
+        while the state file is being held"""
+
+        self._dirty_keys: Set[str] = set()
+        """Keys that were written since the last save. Values must always be
+        saved with StateAttr.write(), mutating a value returned by
+        StateAttr.read() is not enough. This holds in both modes: journaled
+        state files only save these keys, and since StateAttr never shares
+        mutable values with `dict`, a full rewrite only saves written values
+        too."""
 
         self.being_held = 0
         """When this hits 0 on __exit__, all things are saved to the file"""
 
-        computer_id = computer_id or lua_errors.run(os.getComputerID)
-        self._state_path = STATE_DIR / str(computer_id) / STATE_FILE
+        self._pending_side_files: Dict[Path, Optional[bytes]] = {}
+        """Side-file writes that will be flushed upon __exit__. None values
+        represent files that will be deleted."""
+
+        self.codec = codec or JsonCodec()
+        """Converts the state to and from bytes. JSON is the default since it's
+        easy to read and debug, but BinaryCodec is much faster for large
+        state."""
+
+        self.journaled = journaled
+        """If True, changes are appended to the journal instead of rewriting
+        the whole state file"""
+
+        self._journal_records = 0
+        self._journal_bytes = 0
+        """The size of the journal, used to decide when to compact it"""
+
+        self.intents: List[Any] = []
+        """Intents that were recorded since the state was last saved"""
+
+        self.computer_id = computer_id or lua_errors.run(os.getComputerID)
+        self._state_path = self._get_state_path(self.computer_id, self.codec)
         """The location to cache all the turtles states. The reason the 
         CC filesystem isn't used is because it's unreliable during program 
         startup and shutdown, leading to inconsistent states."""
+        self._journal_path = self._state_path.parent / JOURNAL_FILE.format(
+            extension=self.codec.extension)
         self._state_path.parent.mkdir(exist_ok=True, parents=True)
 
     def __repr__(self):
@@ -109,7 +345,6 @@ class StateFile:
         if self.dict is None:
             # Only refresh state if no one is currently 'holding' state
             self.dict = self.read_dict()
-            self._last_saved_dict = copy.deepcopy(self.dict)
 
         # Keep track of state holders
         self.being_held += 1
@@ -121,9 +356,25 @@ class StateFile:
         assert self.being_held >= 0
 
         if self.being_held == 0:
-            if self.dict != self._last_saved_dict:
+            self.read_cache.clear()
+            if (self._dirty_keys or self.intents
+                    or self._pending_side_files):
+                # Other turtles served by this process keep running while
+                # this one waits on the disk
+                runtime.run_blocking(self._save)
+
+    def _save(self):
+        # New side-files are written before the state file and stale ones
+        # are deleted after it, so that the state file never references a
+        # part that doesn't exist
+        self._flush_side_files(deletions=False)
+        if self._dirty_keys or self.intents:
+            if self.journaled:
+                self._append_journal(self.dict, self._dirty_keys)
+            else:
                 self.write_dict(self.dict)
-                self._last_saved_dict = copy.deepcopy(self.dict)
+            self._dirty_keys.clear()
+        self._flush_side_files(deletions=True)
 
     def __setattr__(self, key, value):
         super().__setattr__(key, value)
@@ -136,18 +387,154 @@ class StateFile:
     def read_dict(self):
         self._create_state_if_nonexistent()
 
-        with self._state_path.open("r") as file:
-            text = file.read()
-        return json.loads(text)
+        state_dict = self.codec.loads(self._state_path.read_bytes())
+        self._replay_journal(state_dict)
+        return state_dict
 
     def write_dict(self, state_dict):
-        as_json = json.dumps(state_dict)
-        with atomic_write(self._state_path, overwrite=True) as file:
-            file.write(as_json)
+        """Write a full snapshot of the state, which makes the journal (if
+        there is one) redundant"""
+        data = self.codec.dumps(state_dict)
+        with atomic_write(self._state_path, mode="wb", overwrite=True) as file:
+            file.write(data)
+
+        # The snapshot has been safely written, so it's okay to drop the
+        # journal. If the program dies before this, replaying the journal on
+        # top of the new snapshot results in the same state anyways.
+        if self._journal_records or self._journal_path.is_file():
+            self._journal_path.unlink()
+        self._journal_records = 0
+        self._journal_bytes = 0
+        self.intents = []
+
+    def record_intent(self, intent: Any):
+        """Durably record an action that's about to be performed, before the
+        state that the action changes is saved. Only journaled state files
+        can record intents."""
+        assert self.journaled, "Only journaled state files record intents!"
+        runtime.run_blocking(self._write_record, {"intent": intent})
+        self.intents.append(intent)
+
+    def mark_dirty(self, key_name: str):
+        """Mark a key as changed, so it gets saved upon __exit__"""
+        self._dirty_keys.add(key_name)
+        self.read_cache.pop(key_name, None)
+
+    def _append_journal(self, state_dict, dirty_keys: Set[str]):
+        """Append a record of every key that changed since the last save"""
+        self._write_record({
+            "set": {key: state_dict[key] for key in dirty_keys
+                    if key in state_dict},
+            "del": [key for key in dirty_keys if key not in state_dict]
+        })
+        self.intents = []
+
+        if (self._journal_records >= self.SNAPSHOT_EVERY_N_RECORDS
+                or self._journal_bytes >= self.SNAPSHOT_EVERY_N_BYTES):
+            self.write_dict(state_dict)
+
+    def _write_record(self, record: Dict[str, Any]):
+        payload = self.codec.dumps(record)
+        frame = _RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+        with self._journal_path.open("ab") as file:
+            file.write(frame)
+            file.flush()
+            fsync(file.fileno())
+        self._journal_records += 1
+        self._journal_bytes += len(frame)
+
+    def _replay_journal(self, state_dict):
+        """Apply every intact journal record to state_dict, and cut off any
+        partially written record at the end of the journal"""
+        self._journal_records = 0
+        self._journal_bytes = 0
+        self.intents = []
+        if not self._journal_path.is_file():
+            return
+
+        data = self._journal_path.read_bytes()
+        offset = 0
+        while offset + _RECORD_HEADER.size <= len(data):
+            length, crc = _RECORD_HEADER.unpack_from(data, offset)
+            start = offset + _RECORD_HEADER.size
+            payload = data[start:start + length]
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                break
+
+            record = self.codec.loads(payload)
+            if "intent" in record:
+                self.intents.append(record["intent"])
+            else:
+                state_dict.update(record["set"])
+                for key in record["del"]:
+                    state_dict.pop(key, None)
+                self.intents = []
+            offset = start + length
+            self._journal_records += 1
+
+        if offset != len(data):
+            with self._journal_path.open("r+b") as file:
+                file.truncate(offset)
+                file.flush()
+                fsync(file.fileno())
+        self._journal_bytes = offset
+
+    def side_file_dir(self, key_name: str) -> Path:
+        """The directory that side-files for a given key are stored in"""
+        return self._state_path.parent / key_name
+
+    def read_side_file(self, path: Path) -> bytes:
+        if path in self._pending_side_files:
+            data = self._pending_side_files[path]
+            if data is None:
+                raise FileNotFoundError(f"Side-file {path} was deleted!")
+            return data
+        return path.read_bytes()
+
+    def write_side_file(self, path: Path, data: Optional[bytes]):
+        """Stage a side-file to be written (or deleted, if data is None) when
+        the state file is saved"""
+        self._pending_side_files[path] = data
+
+    def _flush_side_files(self, deletions: bool):
+        """Write (or, if deletions is True, delete) any staged side-files"""
+        for path, data in list(self._pending_side_files.items()):
+            if (data is None) != deletions:
+                continue
+
+            if data is None:
+                if path.is_file():
+                    path.unlink()
+            else:
+                path.parent.mkdir(exist_ok=True, parents=True)
+                with atomic_write(path, mode="wb", overwrite=True) as file:
+                    file.write(data)
+            del self._pending_side_files[path]
+
+    @staticmethod
+    def _get_state_path(computer_id: int, codec: Codec) -> Path:
+        return (STATE_DIR / str(computer_id) /
+                STATE_FILE.format(extension=codec.extension))
 
     def _create_state_if_nonexistent(self):
         if self._state_path.is_file():
             return
 
+        # If the state was saved with a different codec, carry it over
+        for codec_type in CODECS:
+            if isinstance(self.codec, codec_type):
+                continue
+            if self._get_state_path(self.computer_id, codec_type()).is_file():
+                old_state = StateFile(self.computer_id, codec=codec_type())
+                state_dict = old_state.read_dict()
+                if not self.codec.native_arrays:
+                    state_dict = _arrays_to_lists(state_dict)
+                self.write_dict(state_dict)
+                old_state._state_path.unlink()
+                if old_state._journal_path.is_file():
+                    old_state._journal_path.unlink()
+                return
+
         # Create a clean-slate statefile
         self.write_dict({})
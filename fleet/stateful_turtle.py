@@ -1,10 +1,15 @@
-from typing import Tuple, Optional, Dict
-from time import time
+from enum import Enum
+from inspect import isgeneratorfunction
+from math import inf
+from typing import Tuple, Optional, Dict, Iterable, List, Callable, \
+    Generator, Type
 
+import numpy as np
 from cc import turtle, os, gps
 from computercraft.sess import debug
-from fleet import StateFile, StateAttr, Map, math_utils, lua_errors, block_info, \
-    Direction, Inventory
+from fleet import StateFile, StateAttr, SideFileStateAttr, Map, Codec, \
+    BinaryCodec, math_utils, lua_errors, block_info, Direction, Inventory, \
+    macros, runtime, Scheduler, TokenBucket
 
 
 class StepFinished(Exception):
@@ -23,8 +28,9 @@ class MinedBlacklistedBlockError(Exception):
 
 
 def ends_step(fn):
-    def wrapper(*args, end_step=True, **kwargs):
-        result = fn(*args, **kwargs)
+    def wrapper(self, *args, end_step=True, **kwargs):
+        self._record_intent(fn.__name__, *args, **kwargs)
+        result = fn(self, *args, **kwargs)
         assert result is None, \
             "This wrapper should not be used on functions that return values!"
         if end_step:
@@ -59,7 +65,46 @@ class StatefulTurtle:
 
 
     """
+    STATE_JOURNALED = True
+    """If True, each save appends only the state that changed to a journal
+    next to the state file, instead of rewriting the whole file. Multi-action
+    steps (ACTIONS_PER_STEP > 1) can only recover their actions after a crash
+    if this is on."""
+    STATE_CODEC: Type[Codec] = BinaryCodec
+    """The format the state file is written in. JsonCodec is slower and
+    bigger, but easy to read when debugging. A state file that was written in
+    another format is converted on first use."""
+    MAP_CHUNKED = True
+    """If True, new maps store obstacles in bit-packed chunks, which are much
+    cheaper to change and save than a single array for large maps"""
+    MAP_SIDE_FILES = True
+    """If True, the map is saved in binary side-files next to the state file,
+    and only the parts that changed get rewritten. Otherwise it's saved in the
+    state file itself."""
     RUNS_PER_SECOND = 5
+    """The most steps per second a turtle runs on average, if the server's
+    budget (scheduler.SERVER_BUDGET) allows it"""
+    RUNS_BURST = 1
+    """How many steps a turtle can run back to back after being idle"""
+    ACTIONS_PER_STEP = 1
+    """How many actions (each of which ends a step() call) can be performed
+    before the state is saved and the turtle throttles itself. When it's more
+    than 1, step() is called again right after each action, and each action
+    records an intent in the state file, so that a crash before the state is
+    saved can be recovered from."""
+    FUEL_CHECK_INTERVAL = 500
+    """How many moves the fuel estimate is trusted for, before it's checked
+    against turtle.getFuelLevel() again"""
+    FUEL_CHECK_MARGIN = 50
+    """How close the fuel estimate can get to a threshold before it's checked
+    against turtle.getFuelLevel(), for decisions made around the threshold"""
+    GPS_CHECK_INTERVAL: Optional[int] = 250
+    """How many moves the dead reckoned position in the map is trusted for,
+    before it's checked against GPS. None disables periodic checks."""
+    GPS_BLOCKED_LIMIT: Optional[int] = 5
+    """How many moves in a row can be blocked before the position is checked
+    against GPS, since a turtle that isn't where it thinks it is keeps
+    running into things. None disables these checks."""
 
     def __init__(self):
         # First, ensure state is retrieved via GPS initially
@@ -70,12 +115,43 @@ class StatefulTurtle:
                 "within range of GPS satellites!")
 
         self.computer_id = lua_errors.run(os.getComputerID)
-        self.state = StateFile(computer_id=self.computer_id)
-        """Representing (x, y, z) positions"""
-        """Direction on the XZ plane in degrees. A value between 0-360 """
-        self.state.map = StateAttr(self.state, "map",
-                                   Map(position=gps_loc,
-                                       direction=0))
+        self.state = StateFile(computer_id=self.computer_id,
+                               journaled=self.STATE_JOURNALED,
+                               codec=self.STATE_CODEC())
+        with self.state:
+            # Actions that were performed after the state was last saved
+            unsaved_intents = self.state.intents
+
+            """Representing (x, y, z) positions"""
+            """Direction on the XZ plane in degrees. A value between 0-360 """
+            map_attr = (SideFileStateAttr if self.MAP_SIDE_FILES
+                        else StateAttr)
+            self.state.map = map_attr(self.state, "map",
+                                      Map(position=gps_loc,
+                                          direction=0,
+                                          chunked=self.MAP_CHUNKED))
+            self.state.fuel = StateAttr(self.state, "fuel", default=-1)
+            """An estimate of the turtle's fuel level, kept up to date as the
+            turtle moves and refuels. It's -1 until the fuel level is first
+            checked."""
+            self.state.resume_point = StateAttr(self.state, "resume_point",
+                                                default={})
+            """The last resume point that a generator step() yielded"""
+            self._recover_intents(unsaved_intents)
+        self._moves_since_fuel_check = 0
+        self._unlimited_fuel = False
+        self._moves_since_gps_check = 0
+        self._blocked_moves = 0
+        self._blocked_obstacles: List[np.ndarray] = []
+        """Obstacles added while the turtle was blocked in a row. If GPS then
+        shows that the turtle wasn't where it thought it was, they were added
+        in the wrong place and are removed again."""
+        self.gps_checks = 0
+        """How many times the position has been verified with GPS"""
+        self.drifts = []
+        """The drift (GPS position minus the map's position) found by every
+        GPS check that disagreed with the map"""
+        self._step_generator: Optional[Generator] = None
         self.direction_verified = False
         """This is set to True if the Turtle ever moves and is able to verify 
         that the angle it thinks is pointing is actually the angle it is 
@@ -88,6 +164,33 @@ class StatefulTurtle:
 
         self._maybe_recover_location(gps_loc)
 
+    def _recover_intents(self, intents: List[list]):
+        """Catch the state up with actions that were performed after it was
+        last saved. Every action but the last one is known to have finished,
+        so their turns are replayed. The position is recovered afterwards by
+        _maybe_recover_location(), and the direction is verified by the next
+        horizontal move either way."""
+        if not intents:
+            return
+        self.debug(f"Recovering {len(intents)} unsaved actions: "
+                   f"{[intent[0] for intent in intents]}")
+        with self.state as state:
+            map = state.map.read()
+            for name, args, kwargs in intents[:-1]:
+                if name == "turn_degrees":
+                    map.direction = (map.direction + args[0]) % 360
+            state.map.write(map)
+            # The estimate missed any fuel that was used or gained
+            state.fuel.write(-1)
+
+    def _record_intent(self, name: str, *args, **kwargs):
+        """Record an action in the state file before performing it, if the
+        state won't be saved right after it"""
+        if (self.ACTIONS_PER_STEP > 1 and self.state.being_held
+                and self.state.journaled):
+            self.state.record_intent(
+                [name, _intent_value(args), _intent_value(kwargs)])
+
     def _maybe_recover_location(self, gps_loc: Tuple[int, int, int]):
         """Validate state based on GPS data"""
         with self.state as state:
@@ -99,30 +202,108 @@ class StatefulTurtle:
                 map.move_to(gps_loc)
                 state.map.write(map)
 
+    def make_scheduler(self) -> Scheduler:
+        """Create the scheduler that throttles steps and backs off after
+        errors. Override this to schedule a turtle differently."""
+        return Scheduler(TokenBucket(rate=self.RUNS_PER_SECOND,
+                                     burst=self.RUNS_BURST))
+
     def run(self):
         self.debug("Starting loop!")
-        while True:
-            start_time = time()
-            try:
-                with self.state as state:
+        scheduler = self.make_scheduler()
+        try:
+            while True:
+                wait = scheduler.before_step()
+                if wait > 0:
+                    runtime.sleep(wait)
+                try:
+                    self.run_step()
+                except Exception as e:
+                    self.debug(f"Turtle fatal exception! "
+                          f"Turtle: {self.computer_id}", type(e), e)
+                    backoff = scheduler.failed(e)
+                    if backoff > 0:
+                        runtime.sleep(backoff)
+                else:
+                    scheduler.succeeded()
+        finally:
+            # The server kills the greenlet when the turtle disconnects
+            self.close()
+
+    def close(self):
+        """Release anything the turtle holds outside of its state file, once
+        it's done running"""
+
+    def run_step(self):
+        """Call step() until it has performed ACTIONS_PER_STEP actions, or
+        until it returns without performing one, and then save the state"""
+        with self.state as state:
+            for _ in range(self.ACTIONS_PER_STEP):
+                if isgeneratorfunction(type(self).step):
+                    if not self._resume_step(state):
+                        break
+                    continue
+                try:
                     self.step(state)
-            except StepFinished:
-                pass
-            except Exception as e:
-                self.debug(f"Turtle fatal exception! "
-                      f"Turtle: {self.computer_id}", type(e), e)
-                if not isinstance(e, lua_errors.TurtleBlockedError):
-                    os.sleep(5)
-            # Throttle the turtles maximum runs per second
-            throttle_time = 1 / self.RUNS_PER_SECOND - (time() - start_time)
-            if throttle_time > 0:
-                os.sleep(throttle_time)
+                except StepFinished:
+                    continue
+                break
+
+    def _resume_step(self, state: StateFile) -> bool:
+        """Run a generator step() up to its next yield, starting a new one if
+        there isn't one running. Returns False once the generator is done."""
+        if self._step_generator is None:
+            self._step_generator = self.step(state)
+        try:
+            resume_point = next(self._step_generator)
+        except StopIteration:
+            self._step_generator = None
+            if state.resume_point.read():
+                state.resume_point.write({})
+            return False
+        except StepFinished:
+            # An action ended the step instead of being yielded after, which
+            # ends the generator too
+            self._step_generator = None
+            return True
+        except BaseException:
+            # Start over from the last resume point, as if after a restart
+            self._step_generator = None
+            raise
+
+        if resume_point is not None:
+            state.resume_point.write(resume_point)
+        return True
 
     def step(self, state: StateFile):
         """This is the main logic of the turtle, to be implemented by a
-        subclass."""
+        subclass.
+
+        It can also be written as a generator, which keeps its local
+        variables between actions instead of starting over after each one.
+        A generator step calls actions with end_step=False and yields after
+        each of them, or uses `yield from self.until_done(...)` for methods
+        such as NavigationTurtle.move_toward() that perform an action per
+        call until they're done. It's started over once it returns or raises.
+
+        Generators can't be saved, so a generator step also starts over if
+        the program restarts. To pick up where it left off, it can yield a
+        dict as a resume point, which is saved along with the rest of the
+        state, and read it back from state.resume_point when it starts.
+        """
         raise NotImplementedError()
 
+    @staticmethod
+    def until_done(fn: Callable, *args, **kwargs) -> Generator:
+        """For generator steps. Call fn until it returns without ending the
+        step, yielding each time it does end the step, and return whatever
+        it returned."""
+        while True:
+            try:
+                return fn(*args, **kwargs)
+            except StepFinished:
+                yield
+
     @ends_step
     def turn_degrees(self, degrees: int):
         """Turn `degrees` amount. The direction is determined by the sign.
@@ -133,13 +314,13 @@ class StatefulTurtle:
         if degrees not in (90, -90):
             raise ValueError(f"Invalid value for degrees! {degrees}")
         map = self.state.map.read()
-        map.direction = (map.direction + degrees) % 360
 
         with self.state:
             if degrees == 90:
                 lua_errors.run(turtle.turnRight)
             elif degrees == -90:
                 lua_errors.run(turtle.turnLeft)
+            map.direction = (map.direction + degrees) % 360
             self.state.map.write(map)
 
     @ends_step
@@ -169,8 +350,16 @@ class StatefulTurtle:
             except lua_errors.TurtleBlockedError as e:
                 # TODO: Think of something smart to do when direction isn't
                 #   verified but the turtle is still blocked!
-                map.add_obstacle(new_position)
-                state.map.write(map)
+                if not map.is_known_obstacle(new_position):
+                    map.add_obstacle(new_position)
+                    state.map.write(map)
+                    self._blocked_obstacles.append(new_position)
+                self._blocked_moves += 1
+                if (self.GPS_BLOCKED_LIMIT is not None
+                        and self._blocked_moves >= self.GPS_BLOCKED_LIMIT):
+                    self.debug(f"Blocked {self._blocked_moves} times in a "
+                               f"row, verifying position")
+                    self.verify_position()
                 e.direction = direction
                 raise e
 
@@ -187,9 +376,13 @@ class StatefulTurtle:
 
                 # Flag the turtle as super verified and ready to roll
                 self.direction_verified = True
+                # The direction check doubles as a position check
+                self._moves_since_gps_check = 0
 
             map.move_to(new_position)
             state.map.write(map)
+            self._spend_fuel(1)
+            self._track_moves(1)
 
     @ends_step
     def dig_in_direction(self, direction: Direction):
@@ -227,6 +420,87 @@ class StatefulTurtle:
             map.remove_obstacle(obstacle_position)
             state.map.write(map)
 
+    def dig_column(self, direction: Direction, max_moves: int,
+                   stop_slot: Optional[int] = None) -> macros.ColumnResult:
+        """Dig and move straight up or down until the turtle has moved
+        max_moves blocks, the next block can't be dug (or is blacklisted), or
+        stop_slot has any items in it. The whole column is dug by a macro on
+        the turtle, in a single round trip, and the map is then brought up to
+        date with where the turtle ended up.
+
+        Unlike the other actions, this doesn't end the step, so that the
+        caller can act on the result.
+        """
+        map = self.state.map.read()
+        self._record_intent("dig_column", direction, max_moves)
+        result = macros.dig_column(direction, max_moves, stop_slot=stop_slot)
+
+        if result.dug:
+            # Mark all slots as unconfirmed, since we don't know where that
+            # material moved to
+            self.inventory.mark_all_slots_unconfirmed()
+
+        with self.state as state:
+            for _ in range(result.moves):
+                map.move_to(math_utils.coordinate_in_turtle_direction(
+                    curr_pos=map.position,
+                    curr_angle=map.direction,
+                    direction=direction))
+
+            next_position = math_utils.coordinate_in_turtle_direction(
+                curr_pos=map.position,
+                curr_angle=map.direction,
+                direction=direction)
+            if (result.stop in (macros.ColumnStop.unbreakable,
+                                macros.ColumnStop.blacklisted)
+                    or result.message == lua_errors.TO_LUA[
+                        lua_errors.TurtleBlockedError]):
+                map.add_obstacle(next_position)
+            state.map.write(map)
+            self._spend_fuel(result.moves)
+            self._track_moves(result.moves)
+        return result
+
+    def verify_position(self) -> Optional[np.ndarray]:
+        """Check the dead reckoned position in the map against GPS, and move
+        the map to the GPS position if they disagree. Returns the drift (the
+        GPS position minus the map's position), or None if GPS is
+        unavailable."""
+        blocked_obstacles = self._blocked_obstacles
+        self._moves_since_gps_check = 0
+        self._blocked_moves = 0
+        self._blocked_obstacles = []
+        gps_position = gps.locate()
+        if gps_position is None:
+            self.debug("GPS is unavailable, the position wasn't verified")
+            return None
+        self.gps_checks += 1
+
+        with self.state as state:
+            map = state.map.read()
+            drift = np.array(gps_position) - map.position
+            if drift.any():
+                self.debug(f"Warning! Position drifted by {drift.tolist()}, "
+                           f"moving to the GPS position {gps_position}")
+                self.drifts.append(drift)
+                for obstacle in blocked_obstacles:
+                    map.remove_obstacle(obstacle)
+                map.move_to(gps_position)
+                state.map.write(map)
+                # If the position was off, the direction may be too
+                self.direction_verified = False
+        return drift
+
+    def _track_moves(self, moves: int):
+        """Verify the position with GPS if it's been trusted for too long"""
+        self._moves_since_gps_check += moves
+        if moves:
+            self._blocked_moves = 0
+            self._blocked_obstacles = []
+        if (self.GPS_CHECK_INTERVAL is not None
+                and self._moves_since_gps_check >= self.GPS_CHECK_INTERVAL):
+            self.verify_position()
+
     def inspect_in_direction(self, direction: Direction) \
             -> Optional[Dict[bytes, bytes]]:
         inspect_mapping = {
@@ -240,6 +514,25 @@ class StatefulTurtle:
 
         return lua_errors.run(inspect_mapping[direction])
 
+    def inspect_all(self, directions: Iterable[Direction]) \
+            -> Dict[Direction, Optional[Dict[bytes, bytes]]]:
+        """Inspect every direction in a single round trip. Returns what
+        inspect_in_direction() would have returned for each direction."""
+        inspect_mapping = {
+            Direction.up: "inspectUp",
+            Direction.down: "inspectDown",
+            Direction.front: "inspect"
+        }
+
+        calls = {}
+        with lua_errors.Batch() as batch:
+            for direction in directions:
+                if direction not in inspect_mapping:
+                    raise ValueError(
+                        f"You can't inspect in the direction: {direction}")
+                calls[direction] = batch.call(inspect_mapping[direction])
+        return {direction: call.result for direction, call in calls.items()}
+
     @ends_step
     def suck_in_direction(self, direction: Direction, amount=None):
         suck_mapping = {
@@ -273,6 +566,36 @@ class StatefulTurtle:
         # Now that items have been potentially dropped, update the inventory:
         self.inventory.selected.refresh()
 
+    @ends_step
+    def drop_slots_in_direction(self, direction: Direction,
+                                slot_ids: Iterable[int]):
+        """Drop everything in each of the slots, and refresh them, all in a
+        single round trip. Slots that are already empty are left alone. The
+        slot that was selected beforehand is selected again afterwards."""
+        drop_mapping = {
+            Direction.up: "dropUp",
+            Direction.down: "dropDown",
+            Direction.front: "drop"
+        }
+
+        if direction not in drop_mapping:
+            raise ValueError(f"You can't drop in the direction: {direction}")
+
+        selects = []
+        try:
+            with lua_errors.Batch() as batch:
+                for slot_id in slot_ids:
+                    selects.append(batch.call("select", slot_id))
+                    batch.call(drop_mapping[direction])
+                    self.inventory.slot(slot_id).refresh(batch)
+                selects.append(
+                    batch.call("select", self.inventory.selected_id))
+        finally:
+            # Keep track of the selected slot, even if something failed
+            selected = [call for call in selects if call.ran]
+            if selected:
+                self.inventory.selected_id = selected[-1].args[0]
+
     @ends_step
     def place_in_direction(self, direction: Direction):
         place_mapping = {
@@ -288,11 +611,11 @@ class StatefulTurtle:
         # Track the change in inventory, since no errors occurred
         self.inventory.selected.refresh()
 
-    def turn_right(self):
-        self.turn_degrees(90)
+    def turn_right(self, end_step=True):
+        self.turn_degrees(90, end_step=end_step)
 
-    def turn_left(self):
-        self.turn_degrees(-90)
+    def turn_left(self, end_step=True):
+        self.turn_degrees(-90, end_step=end_step)
 
     def select(self, slot_id):
         if self.inventory.selected.slot_id is not slot_id:
@@ -301,8 +624,67 @@ class StatefulTurtle:
 
     @ends_step
     def refuel(self, fuel_amount):
-        lua_errors.run(turtle.refuel, fuel_amount)
-        self.inventory.selected.refresh()
+        with lua_errors.Batch() as batch:
+            batch.call("refuel", fuel_amount)
+            fuel_level = batch.call("getFuelLevel")
+            self.inventory.selected.refresh(batch)
+
+        with self.state:
+            self._record_fuel_level(fuel_level.result)
+
+    def fuel_level(self, threshold: float = 0) -> float:
+        """Return the turtle's fuel level, without calling
+        turtle.getFuelLevel() when the estimate can be trusted. It can't be
+        if it's unknown, if the turtle has moved FUEL_CHECK_INTERVAL times
+        since the last check, or if it's within FUEL_CHECK_MARGIN of
+        `threshold` on either side. Estimates far below the threshold are
+        trusted too, such as on the whole trip to refuel. If fuel is disabled
+        on the server, this returns inf.
+        """
+        if self._unlimited_fuel:
+            return inf
+
+        with self.state as state:
+            estimate = state.fuel.read()
+            if (estimate < 0
+                    or self._moves_since_fuel_check >= self.FUEL_CHECK_INTERVAL
+                    or abs(estimate - threshold) <= self.FUEL_CHECK_MARGIN):
+                # turtle.getFuelLevel() can't read "unlimited", but a Batch
+                # returns the raw value
+                with lua_errors.Batch() as batch:
+                    fuel_level = batch.call("getFuelLevel")
+                self._record_fuel_level(fuel_level.result)
+                estimate = state.fuel.read()
+        return inf if self._unlimited_fuel else estimate
+
+    def _record_fuel_level(self, fuel_level):
+        """Replace the fuel estimate with the level the turtle reported"""
+        self._moves_since_fuel_check = 0
+        if not isinstance(fuel_level, (int, float)):
+            # The turtle reports "unlimited" if fuel is disabled
+            self._unlimited_fuel = True
+            return
+        self.state.fuel.write(int(fuel_level))
+
+    def _spend_fuel(self, moves: int):
+        """Keep the fuel estimate up to date after moving"""
+        self._moves_since_fuel_check += moves
+        estimate = self.state.fuel.read()
+        if estimate >= 0:
+            self.state.fuel.write(max(estimate - moves, 0))
 
     def debug(self, *args):
         debug(f"Turtle({self.computer_id}):", *args)
+
+
+def _intent_value(value):
+    """Convert an action's arguments into something a state file can store"""
+    if isinstance(value, Enum):
+        return value.name
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, dict):
+        return {key: _intent_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, range)):
+        return [_intent_value(item) for item in value]
+    return value
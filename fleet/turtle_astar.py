@@ -1,59 +1,133 @@
-from typing import Sequence
+from collections import OrderedDict
+from enum import Enum, auto
+from heapq import heappush, heappop
+from itertools import permutations
+from math import inf
+from typing import Sequence, List, Tuple, Optional, Set, Dict
 
-from fleet.math_utils import NEIGHBOR_COORDS
+from fleet.math_utils import (
+    NEIGHBOR_KEY_OFFSETS,
+    KEY_BITS,
+    pack_position,
+    unpack_position
+)
 from fleet import Map
 
-import numpy as np
-from astar import AStar
-
-
-class TurtleAstar(AStar):
-    def __init__(self, map: Map, e_admissibility: float, obstacle_cost: int):
-        """
-        :param obstacles: A numpy array of obstacles. Obtained by map.obstacles
-        :param e_admissibility: A multiplier to significantly speed up A*.
-        A value of '1' guarantees the most optimal path, but has compute
-        implications. The larger the number, the more 'admissible' the path may
-        be to detours.
-        :param obstacle_cost: Think of this as "how many blocks would I rather
-        move around instead of breaking a block"
-        """
-        self.map = map
-        self.e_admissibility = e_admissibility
-        self.obstacle_cost = obstacle_cost
-        super().__init__()
-
-    def is_goal_reached(self, current, goal):
-        """ returns true when we can consider that 'current' is the goal"""
-        return current == goal
-
-    def heuristic_cost_estimate(self, current, goal):
-        """Computes the estimated (rough) distance between a node and the goal.
-        The second parameter is always the goal."""
-        return np.abs(np.array(goal) - current).sum()
-
-    def distance_between(self, n1, n2):
-        """Gives the real distance between two adjacent nodes n1 and n2
-        (i.e n2 belongs to the list of n1's neighbors).
-        n2 is guaranteed to belong to the list returned by the call to
-        neighbors(n1).
-        """
-        if self.map.is_known_obstacle(n1) or self.map.is_known_obstacle(n2):
-            return self.obstacle_cost
-        else:
-            return 1 / self.e_admissibility
-
-    def neighbors(self, node):
-        """For a given node, returns (or yields) the list of its neighbors."""
-        return ((node[0] + md[0], node[1] + md[1], node[2] + md[2])
-                for md in NEIGHBOR_COORDS)
+_MASK = (1 << KEY_BITS) - 1
+
+Bounds = Tuple[Sequence[int], Sequence[int]]
+"""An inclusive ((min_x, min_y, min_z), (max_x, max_y, max_z)) box"""
+
+
+class PathStatus(Enum):
+    found = auto()
+    """The path leads all the way to the goal"""
+
+    budget_exhausted = auto()
+    """The search ran out of max_expansions. The path is a best-effort partial
+    path, leading to the explored position closest to the goal."""
+
+    unreachable = auto()
+    """The goal can't be reached within the bounds. The path leads to the
+    explored position closest to the goal."""
+
+    partial = auto()
+    """The path is only the first leg of a longer route toward the goal, as
+    planned by a HierarchicalPlanner"""
+
+
+class PathResult(tuple):
+    """The (path, obstructed) pair returned by astar(). It unpacks just like a
+    regular tuple, and also says why the search ended."""
+
+    def __new__(cls, path: List[Tuple[int, int, int]], obstructed: bool,
+                status: PathStatus, expansions: int,
+                actions: Optional[int] = None):
+        result = super().__new__(cls, (path, obstructed))
+        result.status = status
+        result.expansions = expansions
+        """How many positions the search expanded"""
+        result.actions = actions
+        """The predicted number of moves and turns it takes to follow the
+        path, if astar() was given the turtle's direction"""
+        return result
+
+    def __getnewargs__(self):
+        return (self.path, self.obstructed, self.status, self.expansions,
+                self.actions)
+
+    @property
+    def path(self) -> List[Tuple[int, int, int]]:
+        return self[0]
+
+    @property
+    def obstructed(self) -> bool:
+        return self[1]
+
+
+class UnreachableCache:
+    """Remembers goals that astar() proved to be unreachable, so that the same
+    exhaustive search isn't repeated every step. A proof stays valid for as
+    long as none of the obstacles that walled in the search change, and the
+    search starts from somewhere within the area that was already explored.
+    """
+    MAX_ENTRIES = 32
+
+    def __init__(self):
+        self._proofs: 'OrderedDict[tuple, _UnreachableProof]' = OrderedDict()
+
+    def __len__(self):
+        return len(self._proofs)
+
+    def is_unreachable(self, start: int, goal: int, bounds: Optional[Bounds],
+                       obstacle_cost: float, map: Map) -> bool:
+        cache_key = (goal, _bounds_key(bounds), obstacle_cost)
+        proof = self._proofs.get(cache_key)
+        if proof is None or start not in proof.explored:
+            return False
+
+        changes = map.changes_since(proof.map_version)
+        if changes is None or not proof.walls.isdisjoint(changes):
+            del self._proofs[cache_key]
+            return False
+
+        # Anything else that changed could only have been a new obstacle
+        # within the explored area, which can only make things less
+        # reachable. Track those too, in case they're removed later.
+        proof.walls.update(changes)
+        proof.map_version = map.version
+        self._proofs.move_to_end(cache_key)
+        return True
+
+    def add(self, goal: int, bounds: Optional[Bounds], obstacle_cost: float,
+            map: Map, explored: Set[int], walls: Set[int]):
+        cache_key = (goal, _bounds_key(bounds), obstacle_cost)
+        self._proofs[cache_key] = _UnreachableProof(
+            map_version=map.version, explored=explored, walls=walls)
+        self._proofs.move_to_end(cache_key)
+        while len(self._proofs) > self.MAX_ENTRIES:
+            self._proofs.popitem(last=False)
+
+
+class _UnreachableProof:
+    def __init__(self, map_version: int, explored: Set[int], walls: Set[int]):
+        self.map_version = map_version
+        self.explored = explored
+        """Every position the search could reach"""
+        self.walls = walls
+        """The obstacles the search ran into"""
 
 
 def astar(from_pos: Sequence,
           to_pos: Sequence,
           map: Map,
           e_admissibility: float,
-          obstacle_cost=10):
+          obstacle_cost=10,
+          bounds: Optional[Bounds] = None,
+          max_expansions: Optional[int] = None,
+          unreachable_cache: Optional[UnreachableCache] = None,
+          direction: Optional[int] = None) \
+        -> PathResult:
     """
     :param from_pos: Where from
     :param to_pos: Where to
@@ -62,27 +136,395 @@ def astar(from_pos: Sequence,
     path but will be expensive to calculate.
     Anything over 1 will be substantially cheaper, but may lead to non-optimal
     paths.
-    :param obstacle_cost:
-    :return:
+    :param obstacle_cost: Think of this as "how many blocks would I rather
+    move around instead of breaking a block". If this is math.inf, obstacles
+    can't be passed through at all.
+    :param bounds: If set, the path must stay within this box. from_pos may
+    lie outside of it.
+    :param max_expansions: If set, the search gives up after expanding this
+    many positions, and returns a partial path.
+    :param unreachable_cache: If set, goals that are proven to be unreachable
+    are remembered here, and later searches for them return immediately.
+    :param direction: The direction the turtle faces at from_pos, as in
+    Map.direction. If set, the search also tracks which way the turtle faces,
+    and charges every 90 degree turn a horizontal move needs as much as a free
+    move. The path then minimizes actual turtle actions instead of just grid
+    moves, and the result's `actions` predicts how many actions it takes.
+    :return: (path, obstructed), where path is a list of positions starting at
+    from_pos and ending at to_pos, and obstructed is True if any position in
+    the path is a known obstacle. The result's `status` says if the path is
+    only partial.
     """
-    if isinstance(from_pos, np.ndarray):
-        from_pos = from_pos.tolist()
-    if isinstance(to_pos, np.ndarray):
-        to_pos = to_pos.tolist()
+    start = pack_position(from_pos)
+    goal = pack_position(to_pos)
+
+    if bounds is not None and not _in_bounds(goal, *_bounds_axes(bounds)):
+        status, keys, expansions = PathStatus.unreachable, [start], 0
+    elif (unreachable_cache is not None
+          and unreachable_cache.is_unreachable(
+              start=start, goal=goal, bounds=bounds,
+              obstacle_cost=obstacle_cost, map=map)):
+        status, keys, expansions = PathStatus.unreachable, [start], 0
+    else:
+        search = _Search(start=start,
+                         goal=goal,
+                         map=map,
+                         e_admissibility=e_admissibility,
+                         obstacle_cost=obstacle_cost,
+                         bounds=bounds,
+                         max_expansions=max_expansions,
+                         direction=direction)
+        status, keys = search.run()
+        expansions = search.expansions
+        if (status is PathStatus.unreachable
+                and unreachable_cache is not None):
+            unreachable_cache.add(
+                goal=goal, bounds=bounds, obstacle_cost=obstacle_cost,
+                map=map, explored=search.closed, walls=search.walls)
+
+    path = [unpack_position(key) for key in keys]
+    obstructed = any(map.is_known_obstacle_key(key) for key in keys)
+    actions = None if direction is None else _count_actions(keys, direction)
+    return PathResult(path=path, obstructed=obstructed, status=status,
+                      expansions=expansions, actions=actions)
+
+
+class _Search:
+    """A* over packed position keys. The heuristic is the manhattan distance,
+    while moving between two free blocks only costs 1 / e_admissibility, which
+    is what makes e_admissibility trade optimality for speed."""
+
+    def __init__(self, start: int,
+                 goal: int,
+                 map: Map,
+                 e_admissibility: float,
+                 obstacle_cost: float,
+                 bounds: Optional[Bounds],
+                 max_expansions: Optional[int],
+                 direction: Optional[int] = None):
+        self.start = start
+        self.goal = goal
+        self.map = map
+        self.e_admissibility = e_admissibility
+        self.obstacle_cost = obstacle_cost
+        self.bounds = bounds
+        self.max_expansions = max_expansions
+        self.direction = direction
+
+        self.expansions = 0
+        self.closed: Set[int] = set()
+        """Every position that was expanded"""
+        self.walls: Set[int] = set()
+        """Obstacles that couldn't be passed, if obstacle_cost is infinite"""
+        self.came_from: Dict[int, Optional[int]] = {start: None}
+
+    def run(self) -> Tuple[PathStatus, List[int]]:
+        if self.start == self.goal:
+            return PathStatus.found, [self.start]
+        if self.direction is not None:
+            return self._run_with_heading()
+        return self._run()
+
+    def _run(self) -> Tuple[PathStatus, List[int]]:
+        start, goal = self.start, self.goal
+
+        is_obstacle = self.map.obstacle_key_lookup()
+        obstacle_cost = self.obstacle_cost
+        impassable = obstacle_cost == inf
+        free_cost = 1 / self.e_admissibility
+        max_expansions = self.max_expansions or inf
+        goal_x, goal_y, goal_z = _axes(goal)
+        bounded = self.bounds is not None
+        if bounded:
+            bounds_min, bounds_max = _bounds_axes(self.bounds)
+            min_x, min_y, min_z = bounds_min
+            max_x, max_y, max_z = bounds_max
+
+        g_scores = {start: 0}
+        came_from = self.came_from
+        closed = self.closed
+        walls = self.walls
+
+        # The explored position closest to the goal, for partial paths
+        closest, closest_h, closest_g = start, inf, inf
+
+        # Ties are broken in favor of whichever node was queued first
+        counter = 0
+        queue = [(0, counter, start)]
+
+        while queue:
+            _, _, current = heappop(queue)
+            if current == goal:
+                return PathStatus.found, self._path_to(goal)
+            if current in closed:
+                continue
+            if self.expansions >= max_expansions:
+                return PathStatus.budget_exhausted, self._path_to(closest)
+            closed.add(current)
+            self.expansions += 1
+
+            current_g = g_scores[current]
+            # The turtle can always leave the position it's in
+            current_blocked = not impassable and is_obstacle(current)
+
+            # Each step changes the manhattan distance to the goal by exactly
+            # one, so the heuristic of every neighbor follows from the current
+            # one. These are in the same order as NEIGHBOR_COORDS.
+            x, y, z = _axes(current)
+            dx, dy, dz = goal_x - x, goal_y - y, goal_z - z
+            h = abs(dx) + abs(dy) + abs(dz)
+            if h < closest_h or (h == closest_h and current_g < closest_g):
+                closest, closest_h, closest_g = current, h, current_g
+            neighbor_hs = (h - 1 if dx > 0 else h + 1,
+                           h - 1 if dy > 0 else h + 1,
+                           h - 1 if dz > 0 else h + 1,
+                           h - 1 if dx < 0 else h + 1,
+                           h - 1 if dy < 0 else h + 1,
+                           h - 1 if dz < 0 else h + 1)
+
+            if not bounded:
+                allowed = _ALL_ALLOWED
+            elif (min_x <= x <= max_x and min_y <= y <= max_y
+                  and min_z <= z <= max_z):
+                allowed = (x < max_x, y < max_y, z < max_z,
+                           x > min_x, y > min_y, z > min_z)
+            else:
+                # Only the start may be out of bounds
+                allowed = tuple(_in_bounds(current + offset, bounds_min,
+                                           bounds_max)
+                                for offset in NEIGHBOR_KEY_OFFSETS)
+
+            for offset, neighbor_h, neighbor_allowed in zip(
+                    NEIGHBOR_KEY_OFFSETS, neighbor_hs, allowed):
+                if not neighbor_allowed:
+                    continue
+                neighbor = current + offset
+                if neighbor in closed:
+                    continue
+
+                if current_blocked or is_obstacle(neighbor):
+                    if impassable:
+                        walls.add(neighbor)
+                        continue
+                    g = current_g + obstacle_cost
+                else:
+                    g = current_g + free_cost
+                if g >= g_scores.get(neighbor, inf):
+                    continue
+
+                g_scores[neighbor] = g
+                came_from[neighbor] = current
+                counter += 1
+                heappush(queue, (g + neighbor_h, counter, neighbor))
+
+        return PathStatus.unreachable, self._path_to(closest)
+
+    def _path_to(self, node: int) -> List[int]:
+        path = []
+        while node is not None:
+            path.append(node)
+            node = self.came_from[node]
+        path.reverse()
+        return path
+
+    def _run_with_heading(self) -> Tuple[PathStatus, List[int]]:
+        """Like _run, but each search node is a position along with the
+        heading the turtle faces there, packed as (key << 2) | heading.
+        Horizontal moves first turn toward the move, which costs free_cost
+        per 90 degrees, while vertical moves keep the heading."""
+        start, goal = self.start, self.goal
+        is_obstacle = self.map.obstacle_key_lookup()
+        obstacle_cost = self.obstacle_cost
+        impassable = obstacle_cost == inf
+        free_cost = 1 / self.e_admissibility
+        max_expansions = self.max_expansions or inf
+        goal_x, goal_y, goal_z = _axes(goal)
+        bounded = self.bounds is not None
+        if bounded:
+            bounds_min, bounds_max = _bounds_axes(self.bounds)
+            min_x, min_y, min_z = bounds_min
+            max_x, max_y, max_z = bounds_max
+
+        start_state = start << 2 | _heading(self.direction)
+        g_scores = {start_state: 0}
+        came_from = {start_state: None}
+        closed_states = set()
+        closed = self.closed
+        walls = self.walls
+
+        closest, closest_h, closest_g = start_state, inf, inf
+        counter = 0
+        queue = [(0, counter, start_state)]
+
+        while queue:
+            _, _, current = heappop(queue)
+            current_key, heading = current >> 2, current & 3
+            if current_key == goal:
+                return PathStatus.found, self._keys_to(came_from, current)
+            if current in closed_states:
+                continue
+            if self.expansions >= max_expansions:
+                return (PathStatus.budget_exhausted,
+                        self._keys_to(came_from, closest))
+            closed_states.add(current)
+            closed.add(current_key)
+            self.expansions += 1
+
+            current_g = g_scores[current]
+            current_blocked = not impassable and is_obstacle(current_key)
+
+            x, y, z = _axes(current_key)
+            dx, dy, dz = goal_x - x, goal_y - y, goal_z - z
+            h = abs(dx) + abs(dy) + abs(dz)
+            if h < closest_h or (h == closest_h and current_g < closest_g):
+                closest, closest_h, closest_g = current, h, current_g
+            neighbor_hs = (h - 1 if dx > 0 else h + 1,
+                           h - 1 if dy > 0 else h + 1,
+                           h - 1 if dz > 0 else h + 1,
+                           h - 1 if dx < 0 else h + 1,
+                           h - 1 if dy < 0 else h + 1,
+                           h - 1 if dz < 0 else h + 1)
+            # The horizontal directions the goal lies in, each of which the
+            # turtle has to face at least once more
+            x_sign = (dx > 0) - (dx < 0)
+            z_sign = (dz > 0) - (dz < 0)
+
+            if not bounded:
+                allowed = _ALL_ALLOWED
+            elif (min_x <= x <= max_x and min_y <= y <= max_y
+                  and min_z <= z <= max_z):
+                allowed = (x < max_x, y < max_y, z < max_z,
+                           x > min_x, y > min_y, z > min_z)
+            else:
+                allowed = tuple(_in_bounds(current_key + offset, bounds_min,
+                                           bounds_max)
+                                for offset in NEIGHBOR_KEY_OFFSETS)
+
+            for offset, move_heading, neighbor_h, neighbor_allowed in zip(
+                    NEIGHBOR_KEY_OFFSETS, _OFFSET_HEADINGS, neighbor_hs,
+                    allowed):
+                if not neighbor_allowed:
+                    continue
+                neighbor_key = current_key + offset
+                if move_heading is None:
+                    move_heading, turns = heading, 0
+                else:
+                    turns = _TURNS[heading][move_heading]
+                neighbor = neighbor_key << 2 | move_heading
+                if neighbor in closed_states:
+                    continue
+
+                if current_blocked or is_obstacle(neighbor_key):
+                    if impassable:
+                        walls.add(neighbor_key)
+                        continue
+                    g = current_g + obstacle_cost
+                else:
+                    g = current_g + free_cost
+                g += turns * free_cost
+                if g >= g_scores.get(neighbor, inf):
+                    continue
+
+                # The move may have reached the goal's x or z, in which case
+                # the goal no longer needs that heading
+                if move_heading in (0, 2):
+                    neighbor_x_sign = x_sign if abs(dx) > 1 else 0
+                else:
+                    neighbor_x_sign = x_sign
+                if move_heading in (1, 3):
+                    neighbor_z_sign = z_sign if abs(dz) > 1 else 0
+                else:
+                    neighbor_z_sign = z_sign
+                neighbor_turns = _MIN_TURNS[
+                    move_heading, neighbor_x_sign, neighbor_z_sign]
+
+                g_scores[neighbor] = g
+                came_from[neighbor] = current
+                counter += 1
+                heappush(queue, (g + neighbor_h + neighbor_turns, counter,
+                                 neighbor))
+
+        return PathStatus.unreachable, self._keys_to(came_from, closest)
+
+    @staticmethod
+    def _keys_to(came_from: Dict[int, Optional[int]], state: int) \
+            -> List[int]:
+        path = []
+        while state is not None:
+            path.append(state >> 2)
+            state = came_from[state]
+        path.reverse()
+        return path
+
+
+_ALL_ALLOWED = (True,) * len(NEIGHBOR_KEY_OFFSETS)
+
+_OFFSET_HEADINGS = (0, None, 1, 2, None, 3)
+"""The heading a turtle must face to make each move in NEIGHBOR_KEY_OFFSETS,
+where heading = Map.direction // 90. Vertical moves can be made facing any
+way."""
+
+_TURNS = tuple(tuple((0, 1, 2, 1)[(to_heading - from_heading) % 4]
+                     for to_heading in range(4))
+               for from_heading in range(4))
+"""_TURNS[from_heading][to_heading] is how many 90 degree turns it takes"""
+
+
+def _min_turns(heading: int, x_sign: int, z_sign: int) -> int:
+    """The fewest turns it takes to face each way along x and z that the goal
+    lies in, starting from heading"""
+    needed = ([0] if x_sign > 0 else [2] if x_sign < 0 else []) + \
+             ([1] if z_sign > 0 else [3] if z_sign < 0 else [])
+    return min(sum(_TURNS[a][b] for a, b in zip((heading,) + order, order))
+               for order in permutations(needed))
+
+
+_MIN_TURNS = {(heading, x_sign, z_sign): _min_turns(heading, x_sign, z_sign)
+              for heading in range(4)
+              for x_sign in (-1, 0, 1)
+              for z_sign in (-1, 0, 1)}
+
+
+def _heading(direction: int) -> int:
+    return int(direction) % 360 // 90
+
+
+def _count_actions(keys: List[int], direction: int) -> int:
+    """Count the moves and turns it takes to follow a path of keys, starting
+    out facing direction"""
+    heading = _heading(direction)
+    actions = 0
+    for a, b in zip(keys, keys[1:]):
+        move_heading = _OFFSET_HEADINGS[NEIGHBOR_KEY_OFFSETS.index(b - a)]
+        if move_heading is not None:
+            actions += _TURNS[heading][move_heading]
+            heading = move_heading
+        actions += 1
+    return actions
+
+
+def _axes(key: int) -> Tuple[int, int, int]:
+    """Unpack a key into its axes, without shifting them back into world
+    coordinates. Axes still compare and subtract like world coordinates."""
+    return key >> (KEY_BITS * 2), key >> KEY_BITS & _MASK, key & _MASK
+
+
+def _bounds_axes(bounds: Bounds) \
+        -> Tuple[Tuple[int, int, int], Tuple[int, int, int]]:
+    bounds_min, bounds_max = bounds
+    return _axes(pack_position(bounds_min)), _axes(pack_position(bounds_max))
+
 
-    path = (TurtleAstar(map=map,
-                        e_admissibility=e_admissibility,
-                        obstacle_cost=obstacle_cost)
-        .astar(
-        start=tuple(from_pos),
-        goal=tuple(to_pos)))
+def _bounds_key(bounds: Optional[Bounds]) -> Optional[tuple]:
+    if bounds is None:
+        return None
+    return tuple(tuple(int(axis) for axis in corner) for corner in bounds)
 
-    path = list(path)
-    for pos in path:
-        if map.is_known_obstacle(pos):
-            return path, True
 
-    return path, False
+def _in_bounds(key: int, bounds_min: Tuple[int, int, int],
+               bounds_max: Tuple[int, int, int]) -> bool:
+    return all(low <= axis <= high for low, axis, high
+               in zip(bounds_min, _axes(key), bounds_max))
 
 
-__all__ = ["astar"]
+__all__ = ["astar", "Bounds", "PathResult", "PathStatus", "UnreachableCache"]
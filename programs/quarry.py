@@ -7,8 +7,9 @@ from fleet import (
     routines,
     StateAttr,
     PromptStateAttr,
-    lua_errors,
     NavigationTurtle,
+    Direction,
+    ColumnStop,
     StepFinished,
     math_utils,
     user_input,
@@ -64,6 +65,21 @@ class QuarryTurtle(NavigationTurtle):
             started = [c for c in started if c in finished]
             state.columns_started.write(started)
 
+        # The turtle keeps going back to the fuel and dump chests, so keep
+        # distance fields to them over the area just above the quarry
+        with self.state as state:
+            fuel_loc = state.fuel_loc.read()
+            dump_loc = state.dump_loc.read()
+            x1, z1 = state.mining_x1z1.read()
+            x2, z2 = state.mining_x2z2.read()
+            dig_height = state.dig_height.read()
+        depot_bounds = math_utils.bounding_box(
+            [fuel_loc, dump_loc,
+             (x1, dig_height, z1), (x2, dig_height + 1, z2)],
+            padding=1)
+        self.register_depot(fuel_loc, depot_bounds)
+        self.register_depot(dump_loc, depot_bounds)
+
     def step(self, state):
         fuel_loc = state.fuel_loc.read()
         columns_started = state.columns_started.read()
@@ -130,12 +146,14 @@ class QuarryTurtle(NavigationTurtle):
         if curr_pos[1] <= dig_depth:
             mark_column_finished()
 
-        try:
-            self.move_toward(
-                to_pos=[x, curr_pos[1] - 1, z],
-                destructive=within_dig_volume)
-        except lua_errors.UnbreakableBlockError:
+        # Dig the rest of the column in one go, stopping early if the
+        # inventory needs to be dumped
+        result = self.dig_column(Direction.down,
+                                 max_moves=int(curr_pos[1] - dig_depth),
+                                 stop_slot=16)
+        if result.stop in (ColumnStop.unbreakable, ColumnStop.blacklisted):
             mark_column_finished()
+        raise StepFinished()
 
     @staticmethod
     @lru_cache
@@ -4,7 +4,6 @@ from time import time
 from functools import lru_cache
 
 import numpy as np
-from cc import os
 
 from fleet import (
     NavigationTurtle,
@@ -17,7 +16,8 @@ from fleet import (
     user_input,
     PromptStateAttr,
     StepFinished,
-    lua_errors
+    lua_errors,
+    runtime
 )
 
 
@@ -98,6 +98,22 @@ class TreeFarmBot(NavigationTurtle):
             self.state, "last_checkup",
             default=time())
 
+        # Supply runs all start from within the farm, so keep distance fields
+        # to every chest over the farm, up to the height trees are scanned at
+        with self.state as state:
+            depots = [state.fuel_loc.read(),
+                      state.dump_loc.read(),
+                      state.sapling_loc.read(),
+                      state.dirt_loc.read()]
+            x1, z1 = state.farm_x1z1.read()
+            x2, z2 = state.farm_x2z2.read()
+            farm_height = state.farm_height.read()
+        depot_bounds = math_utils.bounding_box(
+            depots + [(x1, farm_height - 1, z1), (x2, farm_height + 4, z2)],
+            padding=1)
+        for depot in depots:
+            self.register_depot(depot, depot_bounds)
+
     @property
     def destructive(self):
         """If True, the turtle is safe to dig!"""
@@ -136,7 +152,7 @@ class TreeFarmBot(NavigationTurtle):
         if time() - last_checkup_time < check_every_n_seconds:
             self.move_toward(fuel_loc, destructive=self.destructive)
             self.debug("Waiting...")
-            os.sleep(30)
+            runtime.sleep(30)
             raise StepFinished
         else:
             self.debug("Writing tree nodes!")
@@ -285,6 +301,7 @@ class TreeFarmBot(NavigationTurtle):
             Direction.down,
         ]
 
+        block_positions = {}
         for direction in scan_directions:
             block_position = math_utils.coordinate_in_turtle_direction(
                 curr_pos=map.position,
@@ -305,8 +322,12 @@ class TreeFarmBot(NavigationTurtle):
                 # This block is already known to be a tree! No need to waste
                 # time running inspect()
                 continue
-            block = self.inspect_in_direction(direction)
+            block_positions[direction] = block_position
 
+        # Inspect every direction that's left in one round trip
+        blocks = self.inspect_all(block_positions.keys())
+        for direction, block in blocks.items():
+            block_position = block_positions[direction]
             if block is None:
                 # This block is air, and isn't known to be a tree
                 confirmed_not_tree.append(block_position)
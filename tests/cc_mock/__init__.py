@@ -1,5 +1,8 @@
+import re
 from copy import deepcopy
 
+from computercraft.errors import LuaException
+
 
 class FS:
     def __init__(self):
@@ -59,6 +62,9 @@ class Turtle:
     def refuel(self, amount):
         assert amount > 0
 
+    def getFuelLevel(self):
+        return 0
+
     def getItemCount(self, slot_id):
         assert 0 < slot_id < 17
         return 0
@@ -88,14 +94,14 @@ class Turtle:
     def suckDown(self, amount):
         assert amount > 0
 
-    def drop(self, amount):
-        assert amount > 0
+    def drop(self, amount=None):
+        assert amount is None or amount > 0
 
-    def dropUp(self, amount):
-        assert amount > 0
+    def dropUp(self, amount=None):
+        assert amount is None or amount > 0
 
-    def dropDown(self, amount):
-        assert amount > 0
+    def dropDown(self, amount=None):
+        assert amount is None or amount > 0
 
     def digUp(self):
         pass
@@ -138,6 +144,81 @@ class OS:
     def getComputerID(self):
         return 0
 
+    def sleep(self, seconds):
+        assert seconds >= 0
+
+
+class ResultProc:
+    def __init__(self, *values):
+        self._values = list(values)
+
+    def take(self):
+        return self._values.pop(0)
+
+
+def eval_lua(lua_code, *params):
+    """The mock only understands the chunks that fleet sends (from
+    lua_errors.Batch and fleet.macros), which it runs against the mock turtle
+    """
+    from fleet.lua_errors import BATCH_LUA
+    from fleet.macros import DIG_COLUMN_LUA
+    if lua_code == DIG_COLUMN_LUA:
+        return ResultProc(*_dig_column(*params))
+    assert lua_code == BATCH_LUA
+
+    calls, = params
+    results = {}
+    for i, (name, check, n_args, *args) in enumerate(calls, start=1):
+        result = results[i] = _call_as_lua(
+            getattr(turtle, name), name, check, args[:n_args])
+        if (check is not False and result.get(1) is False
+                and result.get(2) != check):
+            break
+    return ResultProc(results)
+
+
+def _dig_column(dig, move, inspect, max_moves, stop_slot, do_not_mine):
+    """Do what DIG_COLUMN_LUA does, with the mock turtle"""
+    moves, dug = 0, 0
+    while moves < max_moves:
+        if stop_slot and turtle.getItemCount(stop_slot) > 0:
+            return moves, dug, b"inventory_full", None
+        block = getattr(turtle, inspect)()
+        if block is not None:
+            for pattern in do_not_mine:
+                # The patterns are all simple enough to be regexes too
+                regex = pattern.replace("%", "\\")
+                if re.match(regex, block[b"name"].decode()):
+                    return moves, dug, b"blacklisted", block[b"name"]
+            try:
+                getattr(turtle, dig)()
+                dug += 1
+            except LuaException as e:
+                if e.message != "Nothing to dig here":
+                    return moves, dug, b"unbreakable", e.message.encode()
+        try:
+            getattr(turtle, move)()
+        except LuaException as e:
+            return moves, dug, b"blocked", e.message.encode()
+        moves += 1
+    return moves, dug, b"finished", None
+
+
+def _call_as_lua(fn, name, check, args):
+    """Return what the Lua function returns, as a table, given what the mock
+    function returns or raises"""
+    try:
+        value = fn(*args)
+    except LuaException as e:
+        return {1: False, 2: e.message}
+    if check is False:
+        return {} if value is None else {1: value}
+    if name.startswith("inspect"):
+        return {1: False, 2: check} if value is None else {1: True, 2: value}
+    if value is False:
+        return {1: False, 2: check}
+    return {1: True}
+
 
 class GPS:
     def locate(self):
@@ -1,11 +1,14 @@
+import math
 import random
+from heapq import heappush, heappop
 from typing import Tuple
 
 import numpy as np
 import pytest
 
-from fleet import astar
+from fleet import astar, PathStatus, UnreachableCache
 from fleet.serializable import Map
+from fleet.math_utils import NEIGHBOR_COORDS
 
 
 @pytest.mark.parametrize(
@@ -135,6 +138,219 @@ def test_obstacle_cost(
     assert expected_n_moves == len(path)
 
 
+@pytest.mark.parametrize("chunked", [False, True])
+@pytest.mark.parametrize("seed", range(10))
+def test_astar_finds_cheapest_path(seed: int, chunked: bool):
+    """With an e_admissibility of 1, the path should be exactly as cheap as
+    the one found by a plain dijkstra search"""
+    random.seed(seed)
+    obstacles = [[random.randint(-1, 8) for _ in range(3)]
+                 for _ in range(300)]
+    map = Map(position=(0, 0, 0), direction=0, obstacles=obstacles,
+              chunked=chunked)
+    obstacle_cost = random.choice([1.5, 3, 10])
+
+    def cost(a, b):
+        if map.is_known_obstacle(a) or map.is_known_obstacle(b):
+            return obstacle_cost
+        return 1
+
+    def path_cost(path):
+        return sum(cost(a, b) for a, b in zip(path, path[1:]))
+
+    # Dijkstra, bounded to a box around the obstacles
+    from_pos, to_pos = (0, 0, 0), (7, 7, 7)
+    costs = {from_pos: 0}
+    queue = [(0, from_pos)]
+    while queue:
+        current_cost, current = heappop(queue)
+        if current == to_pos:
+            break
+        if current_cost > costs[current]:
+            continue
+        for offset in NEIGHBOR_COORDS.tolist():
+            neighbor = tuple(c + o for c, o in zip(current, offset))
+            if not all(-2 <= c <= 9 for c in neighbor):
+                continue
+            neighbor_cost = current_cost + cost(current, neighbor)
+            if neighbor_cost < costs.get(neighbor, float("inf")):
+                costs[neighbor] = neighbor_cost
+                heappush(queue, (neighbor_cost, neighbor))
+
+    path, obstructed = astar(from_pos=from_pos, to_pos=to_pos, map=map,
+                             obstacle_cost=obstacle_cost, e_admissibility=1)
+
+    assert path[0] == from_pos and path[-1] == to_pos
+    for a, b in zip(path, path[1:]):
+        assert sum(abs(i - j) for i, j in zip(a, b)) == 1
+    assert path_cost(path) == pytest.approx(costs[to_pos])
+    assert obstructed == any(map.is_known_obstacle(p) for p in path)
+
+
+def test_heading_aware_path_minimizes_actions():
+    map = Map(position=(0, 0, 0), direction=0)
+
+    # Moving diagonally takes a single turn if the path doesn't zig-zag
+    result = astar(from_pos=(0, 0, 0), to_pos=(3, 0, 3), map=map,
+                   e_admissibility=1, direction=0)
+    assert result.status is PathStatus.found
+    assert len(result.path) == 7
+    assert result.actions == 7
+
+    # Turning around is two actions, and vertical moves need no turns
+    result = astar(from_pos=(0, 0, 0), to_pos=(-2, 2, 0), map=map,
+                   e_admissibility=1, direction=0)
+    assert result.actions == 6
+
+    # Without a direction, actions aren't predicted
+    assert astar(from_pos=(0, 0, 0), to_pos=(3, 0, 3), map=map,
+                 e_admissibility=1).actions is None
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_heading_aware_path_is_cheapest(seed: int):
+    """With an e_admissibility of 1, the number of actions should match a
+    plain dijkstra search over positions and headings"""
+    random.seed(seed)
+    obstacles = [[random.randint(-1, 6) for _ in range(3)]
+                 for _ in range(150)]
+    map = Map(position=(0, 0, 0), direction=0, obstacles=obstacles)
+    obstacle_cost = random.choice([1.5, 3, 10])
+    direction = random.choice([0, 90, 180, 270])
+    from_pos, to_pos = (0, 0, 0), (5, 5, 5)
+    headings = {(1, 0, 0): 0, (0, 0, 1): 1, (-1, 0, 0): 2, (0, 0, -1): 3}
+
+    start = (from_pos, direction // 90)
+    costs = {start: 0}
+    queue = [(0, start)]
+    while queue:
+        current_cost, (current, heading) = heappop(queue)
+        if current == to_pos:
+            break
+        if current_cost > costs[(current, heading)]:
+            continue
+        for offset in NEIGHBOR_COORDS.tolist():
+            neighbor = tuple(c + o for c, o in zip(current, offset))
+            if not all(-2 <= c <= 7 for c in neighbor):
+                continue
+            move_heading = headings.get(tuple(offset), heading)
+            turns = min((move_heading - heading) % 4,
+                        (heading - move_heading) % 4)
+            blocked = (map.is_known_obstacle(current)
+                       or map.is_known_obstacle(neighbor))
+            neighbor_cost = (current_cost + turns
+                             + (obstacle_cost if blocked else 1))
+            state = (neighbor, move_heading)
+            if neighbor_cost < costs.get(state, float("inf")):
+                costs[state] = neighbor_cost
+                heappush(queue, (neighbor_cost, state))
+
+    result = astar(from_pos=from_pos, to_pos=to_pos, map=map,
+                   obstacle_cost=obstacle_cost, e_admissibility=1,
+                   direction=direction)
+    path = result.path
+    n_obstructed_moves = sum(
+        map.is_known_obstacle(a) or map.is_known_obstacle(b)
+        for a, b in zip(path, path[1:]))
+    cost = result.actions + n_obstructed_moves * (obstacle_cost - 1)
+    assert path[0] == from_pos and path[-1] == to_pos
+    assert cost == pytest.approx(current_cost)
+
+
+def test_budget_exhausted_returns_partial_path():
+    map = Map(position=(0, 0, 0), direction=0)
+    result = astar(from_pos=(0, 0, 0), to_pos=(100, 0, 0), map=map,
+                   e_admissibility=1, max_expansions=20)
+    assert result.status is PathStatus.budget_exhausted
+    assert result.expansions == 20
+    assert result.path[0] == (0, 0, 0)
+    assert 1 < len(result.path) < 100
+    # The partial path should make progress toward the goal
+    assert result.path[-1][0] > 0
+
+    path, obstructed = astar(from_pos=(0, 0, 0), to_pos=(10, 0, 0), map=map,
+                             e_admissibility=1, max_expansions=20)
+    assert path[-1] == (10, 0, 0)
+    assert not obstructed
+
+
+def test_bounds():
+    # A wall at x=2 that can only be walked around at y=3
+    obstacles = [[2, y, z] for y in range(-5, 3) for z in range(-5, 6)]
+    map = Map(position=(0, 0, 0), direction=0, obstacles=obstacles)
+    bounds = ((-5, -5, -5), (5, 5, 5))
+
+    result = astar(from_pos=(0, 0, 0), to_pos=(4, 0, 0), map=map,
+                   e_admissibility=1, obstacle_cost=100, bounds=bounds)
+    assert result.status is PathStatus.found
+    assert not result.obstructed
+    assert max(y for _, y, _ in result.path) == 3
+
+    # Capping y below the gap leaves no way around the wall
+    low_bounds = ((-5, -5, -5), (5, 2, 5))
+    result = astar(from_pos=(0, 0, 0), to_pos=(4, 0, 0), map=map,
+                   e_admissibility=1, obstacle_cost=100, bounds=low_bounds)
+    assert result.status is PathStatus.found
+    assert result.obstructed
+    assert all(y <= 2 for _, y, _ in result.path)
+
+    # Goals outside of the bounds are unreachable
+    result = astar(from_pos=(0, 0, 0), to_pos=(6, 0, 0), map=map,
+                   e_admissibility=1, bounds=bounds)
+    assert result.status is PathStatus.unreachable
+    assert result.path == [(0, 0, 0)]
+
+    # But the start is allowed to be outside of them
+    result = astar(from_pos=(-6, 0, 0), to_pos=(0, 0, 0), map=map,
+                   e_admissibility=1, bounds=bounds)
+    assert result.status is PathStatus.found
+    assert len(result.path) == 7
+
+
+def test_unreachable_cache():
+    """Goals walled in by impassable obstacles are proven unreachable once,
+    until one of the walls is removed"""
+    shell = generate_obstacle_shell(center=(0, 0, 0), radius=2)
+    map = Map(position=(10, 0, 0), direction=0, obstacles=shell)
+    bounds = ((-12, -12, -12), (12, 12, 12))
+    cache = UnreachableCache()
+
+    def search():
+        return astar(from_pos=map.position, to_pos=(0, 0, 0), map=map,
+                     e_admissibility=1, obstacle_cost=math.inf,
+                     bounds=bounds, unreachable_cache=cache)
+
+    result = search()
+    assert result.status is PathStatus.unreachable
+    assert result.expansions > 0
+    assert len(cache) == 1
+    # The best effort path leads up to the shell
+    assert result.path[-1] == (3, 0, 0)
+
+    # Moving within the explored area, or adding obstacles, doesn't change
+    # whether the goal is reachable
+    map.move_to((9, 0, 0))
+    map.add_obstacle((5, 5, 5))
+    result = search()
+    assert result.status is PathStatus.unreachable
+    assert result.expansions == 0
+
+    # Opening a hole in the shell invalidates the proof
+    map.remove_obstacle((2, 0, 0))
+    result = search()
+    assert result.status is PathStatus.found
+    assert result.path[-1] == (0, 0, 0)
+    assert not result.obstructed
+
+
+def generate_obstacle_shell(center, radius):
+    """Generates the hollow surface of a block of obstacles"""
+    inside = {tuple(o) for o in
+              generate_obstacle_block(center=center, radius=radius - 1)}
+    return [o for o in generate_obstacle_block(center=center, radius=radius)
+            if tuple(o) not in inside]
+
+
 def generate_obstacle_block(center, radius):
     """Generates a block of obstacles surrounding a center, optionally
     excluding the center
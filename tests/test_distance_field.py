@@ -0,0 +1,106 @@
+import random
+from heapq import heappush, heappop
+from math import inf
+
+import pytest
+
+from fleet import Map, DistanceField
+from fleet.math_utils import NEIGHBOR_COORDS
+from fleet.serializable.map import CHANGE_LOG_LENGTH
+
+BOUNDS = ((-2, -2, -2), (6, 6, 6))
+
+
+def dijkstra(map: Map, to_pos, obstacle_cost: float):
+    """The cost of the cheapest path to to_pos from everywhere in BOUNDS"""
+    (min_x, min_y, min_z), (max_x, max_y, max_z) = BOUNDS
+    costs = {to_pos: 0}
+    queue = [(0, to_pos)]
+    while queue:
+        current_cost, current = heappop(queue)
+        if current_cost > costs[current]:
+            continue
+        for offset in NEIGHBOR_COORDS.tolist():
+            x, y, z = neighbor = tuple(c + o for c, o in zip(current, offset))
+            if not (min_x <= x <= max_x and min_y <= y <= max_y
+                    and min_z <= z <= max_z):
+                continue
+            blocked = (map.is_known_obstacle(current)
+                       or map.is_known_obstacle(neighbor))
+            neighbor_cost = current_cost + (obstacle_cost if blocked else 1)
+            if neighbor_cost < costs.get(neighbor, inf):
+                costs[neighbor] = neighbor_cost
+                heappush(queue, (neighbor_cost, neighbor))
+    return costs
+
+
+def random_position():
+    return [random.randint(-2, 6) for _ in range(3)]
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+@pytest.mark.parametrize("seed", range(5))
+def test_updated_field_matches_dijkstra(seed: int, chunked: bool):
+    """Add and remove obstacles, and make sure the updated field always
+    matches a fresh search"""
+    random.seed(seed)
+    to_pos = (3, 3, 3)
+    obstacle_cost = random.choice([1.5, 3, 10, inf])
+    map = Map(position=(0, 0, 0), direction=0, chunked=chunked,
+              obstacles=[random_position() for _ in range(200)])
+    field = DistanceField(to_pos=to_pos, bounds=BOUNDS, map=map,
+                          obstacle_cost=obstacle_cost)
+
+    for _ in range(15):
+        for _ in range(random.randint(1, 4)):
+            if random.random() < 0.5:
+                map.add_obstacle(random_position())
+            else:
+                map.remove_obstacle(random_position())
+        field.update(map)
+
+        expected = dijkstra(map, to_pos, obstacle_cost)
+        for position in expected:
+            assert field.distance(position) == pytest.approx(
+                expected[position])
+
+            next_pos = field.next_position(position)
+            if position == to_pos or expected[position] == inf:
+                assert next_pos is None
+                continue
+            blocked = (map.is_known_obstacle(position)
+                       or map.is_known_obstacle(next_pos))
+            step_cost = obstacle_cost if blocked else 1
+            assert field.distance(next_pos) + step_cost == pytest.approx(
+                expected[position])
+
+
+def test_updates_are_cheaper_than_rebuilding():
+    random.seed(0)
+    map = Map(position=(0, 0, 0), direction=0,
+              obstacles=[random_position() for _ in range(100)])
+    field = DistanceField(to_pos=(0, 0, 0), bounds=BOUNDS, map=map)
+    rebuild_expansions = field.expansions
+
+    map.add_obstacle((6, 6, 6))
+    field.update(map)
+    assert field.expansions - rebuild_expansions < rebuild_expansions / 10
+
+    # The field is rebuilt if the map changed too much to catch up with
+    for i in range(CHANGE_LOG_LENGTH + 1):
+        map.add_obstacle((i, 20, 0))
+    expansions = field.expansions
+    field.update(map)
+    assert field.expansions - expansions >= len(dijkstra(map, (0, 0, 0), 10))
+
+
+def test_positions_outside_bounds():
+    map = Map(position=(0, 0, 0), direction=0)
+    field = DistanceField(to_pos=(0, 0, 0), bounds=BOUNDS, map=map)
+    assert field.covers((6, -2, 0))
+    assert not field.covers((7, 0, 0))
+    assert field.distance((7, 0, 0)) == inf
+    assert field.next_position((7, 0, 0)) is None
+
+    with pytest.raises(ValueError):
+        DistanceField(to_pos=(10, 0, 0), bounds=BOUNDS, map=map)
@@ -0,0 +1,94 @@
+import random
+
+import mock
+import pytest
+
+from fleet import Map, HierarchicalPlanner, PathStatus, astar
+
+
+def path_cost(map: Map, path, obstacle_cost: float):
+    return sum(obstacle_cost
+               if map.is_known_obstacle(a) or map.is_known_obstacle(b)
+               else 1
+               for a, b in zip(path, path[1:]))
+
+
+def random_map(seed: int) -> Map:
+    random.seed(seed)
+    obstacles = [[random.randint(-10, 60), random.randint(-20, 10),
+                  random.randint(-10, 60)]
+                 for _ in range(3000)]
+    map = Map(position=(50, -15, 50), direction=0, obstacles=obstacles,
+              chunked=True)
+    map.remove_obstacle((50, -15, 50))
+    map.remove_obstacle((0, 0, 0))
+    return map
+
+
+def test_short_trips_use_astar():
+    map = random_map(0)
+    planner = HierarchicalPlanner(e_admissibility=1.1, obstacle_cost=10)
+    result = planner.plan(from_pos=(0, 0, 0), to_pos=(5, 5, 5), map=map)
+    expected = astar(from_pos=(0, 0, 0), to_pos=(5, 5, 5), map=map,
+                     e_admissibility=1.1, obstacle_cost=10)
+    assert result.status is PathStatus.found
+    assert result.path == expected.path
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_partial_paths_lead_to_the_goal(seed: int):
+    map = random_map(seed)
+    planner = HierarchicalPlanner(e_admissibility=1.1, obstacle_cost=10)
+    from_pos, to_pos = (50, -15, 50), (0, 0, 0)
+
+    full_path = [from_pos]
+    for _ in range(50):
+        result = planner.plan(from_pos=full_path[-1], to_pos=to_pos, map=map)
+        path = result.path
+        assert path[0] == full_path[-1]
+        # Partial paths only leave the cluster they started in on their last
+        # step
+        if result.status is PathStatus.partial:
+            clusters = {tuple(axis >> planner.CLUSTER_BITS for axis in p)
+                        for p in path[:-1]}
+            assert len(clusters) == 1
+        full_path.extend(path[1:])
+        if result.status is PathStatus.found:
+            break
+    assert full_path[-1] == to_pos
+    for a, b in zip(full_path, full_path[1:]):
+        assert sum(abs(i - j) for i, j in zip(a, b)) == 1
+
+    expected, _ = astar(from_pos=from_pos, to_pos=to_pos, map=map,
+                        e_admissibility=1.1, obstacle_cost=10)
+    assert (path_cost(map, full_path, 10)
+            <= path_cost(map, expected, 10) * 1.5)
+
+
+def test_portal_costs_are_cached():
+    map = random_map(0)
+    planner = HierarchicalPlanner(e_admissibility=1.1, obstacle_cost=10)
+    portal_costs = planner._costs
+
+    def n_cached():
+        return sum(len(costs) for costs in portal_costs.values())
+
+    planner.plan(from_pos=(50, -15, 50), to_pos=(0, 0, 0), map=map)
+    cached = n_cached()
+    assert cached > 0
+
+    # Planning again only searches legs to or from the start and goal
+    with mock.patch("fleet.hierarchical_planner.astar",
+                    wraps=astar) as searches:
+        planner.plan(from_pos=(50, -15, 50), to_pos=(0, 0, 0), map=map)
+    assert n_cached() == cached
+    assert searches.call_count < cached
+
+    # Changing the map evicts the clusters around the change, but no others
+    clusters = set(portal_costs)
+    map.add_obstacle((20, -5, 20))
+    planner._catch_up(map)
+    evicted = clusters - set(portal_costs)
+    assert evicted
+    assert all(sum(abs(a - b) for a, b in zip(cluster, (1, -1, 1))) <= 1
+               for cluster in evicted)
@@ -0,0 +1,96 @@
+import random
+
+import pytest
+
+from fleet import Map, IncrementalPlanner, astar
+from fleet.serializable.map import CHANGE_LOG_LENGTH
+
+
+def path_cost(map: Map, path, obstacle_cost: float):
+    return sum(obstacle_cost
+               if map.is_known_obstacle(a) or map.is_known_obstacle(b)
+               else 1
+               for a, b in zip(path, path[1:]))
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+@pytest.mark.parametrize("seed", range(5))
+def test_repaired_paths_are_optimal(seed: int, chunked: bool):
+    """Walk toward a goal while obstacles appear and disappear, and make sure
+    the repaired path always costs the same as a fresh search"""
+    random.seed(seed)
+    to_pos = (7, 7, 7)
+    obstacle_cost = random.choice([1.5, 3, 10])
+    map = Map(position=(0, 0, 0), direction=0, chunked=chunked,
+              obstacles=[[random.randint(-1, 8) for _ in range(3)]
+                         for _ in range(200)])
+    map.remove_obstacle((0, 0, 0))
+
+    planner = IncrementalPlanner(from_pos=map.position, to_pos=to_pos,
+                                 map=map, e_admissibility=1,
+                                 obstacle_cost=obstacle_cost)
+    while tuple(map.position) != to_pos:
+        assert planner.update(map)
+        path = planner.path()
+        expected_path, _ = astar(from_pos=map.position, to_pos=to_pos,
+                                 map=map, e_admissibility=1,
+                                 obstacle_cost=obstacle_cost)
+        assert path[0] == tuple(map.position)
+        assert path[-1] == to_pos
+        assert (path_cost(map, path, obstacle_cost)
+                == path_cost(map, expected_path, obstacle_cost))
+
+        next_pos = planner.next_position()
+        assert next_pos == path[1]
+        chance = random.random()
+        if chance < 0.3 and next_pos != to_pos:
+            map.add_obstacle(next_pos)
+        elif chance < 0.4:
+            map.remove_obstacle([random.randint(-1, 8) for _ in range(3)])
+        else:
+            map.move_to(next_pos)
+
+    assert planner.update(map)
+    assert planner.next_position() is None
+
+
+def test_repairs_are_cheaper_than_replanning():
+    random.seed(0)
+    to_pos = (30, 0, 0)
+    map = Map(position=(0, 0, 0), direction=0,
+              obstacles=[[random.randint(2, 28), random.randint(-5, 5),
+                          random.randint(-5, 5)] for _ in range(300)])
+    planner = IncrementalPlanner(from_pos=map.position, to_pos=to_pos,
+                                 map=map, e_admissibility=1, obstacle_cost=10)
+
+    repair_expansions = replan_expansions = 0
+    for _ in range(5):
+        # Discover an obstacle wherever the turtle tries to go next
+        map.add_obstacle(planner.next_position())
+        expansions = planner.expansions
+        assert planner.update(map)
+        next_pos = planner.next_position()
+        repair_expansions += planner.expansions - expansions
+
+        replanner = IncrementalPlanner(from_pos=map.position, to_pos=to_pos,
+                                       map=map, e_admissibility=1,
+                                       obstacle_cost=10)
+        assert replanner.next_position() == next_pos
+        replan_expansions += replanner.expansions
+
+    assert repair_expansions < replan_expansions / 2
+
+
+def test_update_fails_when_map_changed_too_much():
+    map = Map(position=(0, 0, 0), direction=0)
+    planner = IncrementalPlanner(from_pos=map.position, to_pos=(5, 0, 0),
+                                 map=map, e_admissibility=1, obstacle_cost=10)
+    assert planner.next_position() == (1, 0, 0)
+
+    for i in range(CHANGE_LOG_LENGTH + 1):
+        map.add_obstacle((i, 10, 10))
+    assert not planner.update(map)
+
+    assert planner.is_planning((5, 0, 0), e_admissibility=1, obstacle_cost=10)
+    assert not planner.is_planning((5, 0, 0), e_admissibility=1,
+                                   obstacle_cost=5)
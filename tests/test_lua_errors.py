@@ -0,0 +1,69 @@
+import mock
+import pytest
+from computercraft.errors import LuaException
+
+from tests import cc_mock as cc
+from fleet import lua_errors
+
+
+def test_batch_runs_in_one_round_trip():
+    with mock.patch("fleet.lua_errors.eval_lua", wraps=cc.eval_lua) \
+            as eval_lua, \
+            mock.patch.object(cc.turtle, "getItemCount",
+                              side_effect=lambda slot_id: slot_id * 2), \
+            mock.patch.object(cc.turtle, "getItemDetail", return_value=None):
+        with lua_errors.Batch() as batch:
+            counts = [batch.call("getItemCount", slot_id)
+                      for slot_id in range(1, 17)]
+            detail = batch.call("getItemDetail", 3)
+            assert not detail.ran
+            with pytest.raises(RuntimeError):
+                detail.result
+
+        assert eval_lua.call_count == 1
+        assert [count.result for count in counts] == list(range(2, 33, 2))
+        assert detail.result is None
+
+        # Empty batches don't need a round trip at all
+        lua_errors.Batch().run()
+        assert eval_lua.call_count == 1
+
+
+def test_batch_errors():
+    blocked = LuaException(lua_errors.TO_LUA[lua_errors.TurtleBlockedError])
+    with mock.patch.object(cc.turtle, "up", side_effect=blocked), \
+            mock.patch.object(cc.turtle, "down") as down:
+        batch = lua_errors.Batch()
+        select = batch.call("select", 2)
+        up = batch.call("up")
+        batch.call("down")
+
+        # The first failure is raised, and nothing after it runs
+        with pytest.raises(lua_errors.TurtleBlockedError):
+            batch.run()
+        assert select.ran and select.result is None
+        assert not up.ran
+        assert down.call_count == 0
+
+    with pytest.raises(ValueError):
+        lua_errors.Batch().call("shutdown")
+
+
+def test_batch_expected_failures():
+    """Some failures are results rather than errors, like when calling the
+    turtle functions directly"""
+    nothing_to_drop = LuaException("No items to drop")
+    with mock.patch.object(cc.turtle, "digUp", return_value=False), \
+            mock.patch.object(cc.turtle, "inspect", return_value=None), \
+            mock.patch.object(cc.turtle, "drop", side_effect=nothing_to_drop):
+        with lua_errors.Batch() as batch:
+            dig_up = batch.call("digUp")
+            dig_down = batch.call("digDown")
+            inspect = batch.call("inspect")
+            inspect_up = batch.call("inspectUp")
+            drop = batch.call("drop")
+    assert dig_up.result is False
+    assert dig_down.result is True
+    assert inspect.result is None
+    assert inspect_up.result == cc.MOCK_INSPECT_VAL
+    assert drop.result is False
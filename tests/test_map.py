@@ -1,6 +1,11 @@
+import random
+
 import numpy as np
+import pytest
 
 from fleet import Map
+from fleet.serializable.map import CHANGE_LOG_LENGTH
+from fleet.math_utils import pack_position
 
 
 def test_add_and_delete_obstacle():
@@ -31,3 +36,158 @@ def test_add_and_delete_obstacle():
     map.remove_obstacle([69, 42, 0])
     map.add_obstacle([1, 2, 3])
     assert (map.obstacles == [[1, 2, 3]]).all()
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+def test_is_known_obstacle(chunked: bool):
+    map = Map(
+        position=(0, 0, 0),
+        direction=0,
+        obstacles=[[0, 1, 2], [-3, 4, -5]],
+        chunked=chunked
+    )
+    # Any sequence type should be usable for lookups
+    assert map.is_known_obstacle([0, 1, 2])
+    assert map.is_known_obstacle((-3, 4, -5))
+    assert map.is_known_obstacle(np.array([-3, 4, -5]))
+    assert not map.is_known_obstacle((0, 1, 3))
+
+    # The index must stay in sync with every mutation
+    map.add_obstacle([7, 7, 7])
+    assert map.is_known_obstacle((7, 7, 7))
+    map.remove_obstacle([0, 1, 2])
+    assert not map.is_known_obstacle((0, 1, 2))
+    map.move_to((-3, 4, -5))
+    assert not map.is_known_obstacle((-3, 4, -5))
+    assert (map.obstacles == [[7, 7, 7]]).all()
+
+    # Removing something that isn't an obstacle is a no-op
+    map.remove_obstacle([100, 100, 100])
+    assert (map.obstacles == [[7, 7, 7]]).all()
+
+
+def test_array_storage_index():
+    """A few lookups scan the array, and frequent ones build an index"""
+    obstacles = [[i, -i, 2 * i] for i in range(100)]
+    storage = Map(position=(0, 0, 0), direction=0,
+                  obstacles=obstacles)._obstacles
+    for i in range(storage.SCANS_BEFORE_INDEX // 2):
+        assert [i, -i, 2 * i] in storage
+        assert [i, i, i + 1] not in storage
+    assert storage._keys is None
+
+    # Mutations work whether or not the index was built
+    assert storage.add([-1, -1, -1])
+    assert not storage.remove([5, 5, 5])
+    assert storage.remove([3, -3, 6])
+    assert [3, -3, 6] not in storage
+    assert storage._keys is not None
+    assert storage.add([3, -3, 6])
+    assert not storage.add([-1, -1, -1])
+    assert len(storage) == 101
+    assert storage.keys == {pack_position(row) for row in storage.array}
+
+
+def test_chunked_matches_array_storage():
+    """Run the same random mutations on both storage backends, and make sure
+    they always agree"""
+    array_map = Map(position=(0, 0, 0), direction=0)
+    chunked_map = Map(position=(0, 0, 0), direction=0, chunked=True)
+
+    def random_position():
+        # Straddle chunk boundaries, including negative chunks
+        return [random.randint(-20, 20) for _ in range(3)]
+
+    for _ in range(2000):
+        position = random_position()
+        action = random.choice(["add", "add", "remove", "move_to"])
+        for map in (array_map, chunked_map):
+            getattr(map, {"add": "add_obstacle",
+                          "remove": "remove_obstacle",
+                          "move_to": "move_to"}[action])(position)
+
+        probe = random_position()
+        assert (array_map.is_known_obstacle(probe)
+                == chunked_map.is_known_obstacle(probe)
+                == chunked_map.is_known_obstacle_key(pack_position(probe)))
+
+    assert len(array_map.obstacles) == len(chunked_map.obstacles)
+    assert (sorted(array_map.obstacles.tolist())
+            == sorted(chunked_map.obstacles.tolist()))
+
+
+def test_chunked_storage():
+    map = Map(position=(0, 0, 0), direction=0, chunked=True)
+    assert map.obstacles.shape == (0, 3)
+
+    # Real world coordinates must fit, unlike the old int8 default array
+    far_away = [29999999, -64, -29999999]
+    map.add_obstacle(far_away)
+    assert map.obstacles.tolist() == [far_away]
+    assert map.obstacles.dtype == np.int64
+
+    # Chunks are freed once they no longer hold any obstacles
+    map.add_obstacle([15, 15, 15])
+    map.add_obstacle([16, 15, 15])
+    assert len(map._obstacles.chunks) == 3
+    map.remove_obstacle(far_away)
+    map.remove_obstacle([16, 15, 15])
+    assert list(map._obstacles.chunks) == [(0, 0, 0)]
+
+    # The storage mode survives serialization
+    loaded = Map.from_dict(map.to_dict())
+    assert loaded.chunked
+    assert loaded.obstacles.tolist() == [[15, 15, 15]]
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+def test_chunk_buffers(chunked: bool):
+    obstacles = [[random.randint(-40, 40) for _ in range(3)]
+                 for _ in range(500)]
+    map = Map(position=(0, 0, 0), direction=0, obstacles=obstacles,
+              chunked=chunked)
+    map.remove_obstacle(obstacles[0])
+
+    copy = Map.from_chunk_buffers((1, 2, 3), 90, *map.to_chunk_buffers(),
+                                  version=map.version)
+    assert copy.chunked
+    assert copy.version == map.version
+    assert len(copy._obstacles) == len(map._obstacles)
+    assert (sorted(copy.obstacles.tolist())
+            == sorted(map.obstacles.tolist()))
+
+    # Counts survive, so emptied chunks are still freed
+    for position in copy.obstacles.tolist():
+        copy.remove_obstacle(position)
+    assert copy._obstacles.chunks == {}
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+def test_changes_since(chunked: bool):
+    map = Map(position=(0, 0, 0), direction=0, chunked=chunked)
+    assert map.version == 0
+    assert map.changes_since(0) == []
+
+    map.add_obstacle((1, 2, 3))
+    map.add_obstacle((1, 2, 3))  # This isn't a change
+    map.remove_obstacle((4, 5, 6))  # Neither is this
+    map.move_to((1, 2, 3))
+    assert map.version == 2
+    assert map.changes_since(0) == [pack_position((1, 2, 3))] * 2
+    assert map.changes_since(1) == [pack_position((1, 2, 3))]
+    assert map.changes_since(3) is None
+
+    # Only the version is persisted, not the change log
+    assert "changes" not in map.to_header()
+    for loaded in (Map.from_dict(map.to_dict()),
+                   Map.from_parts(map.to_header(),
+                                  map.dump_parts(only_dirty=False).get)):
+        assert loaded.version == 2
+        assert loaded.changes_since(2) == []
+        assert loaded.changes_since(1) is None
+
+    # Only the most recent changes are remembered
+    for i in range(CHANGE_LOG_LENGTH):
+        map.add_obstacle((i, 0, 0))
+    assert map.changes_since(1) is None
+    assert len(map.changes_since(2)) == CHANGE_LOG_LENGTH
@@ -27,12 +27,41 @@ def test_is_adjacent():
         assert not math_utils.is_adjacent(direction, [1, 1, 1])
 
 
+@pytest.mark.parametrize(
+    argnames=("pos",),
+    argvalues=[
+        ((0, 0, 0),),
+        ((1, -1, 1),),
+        ((-30000000, 320, 30000000),),
+        ((29999999, -64, -29999999),),
+    ]
+)
+def test_pack_position(pos: Tuple[int]):
+    key = math_utils.pack_position(pos)
+    assert math_utils.unpack_position(key) == pos
+    assert math_utils.pack_position(np.array(pos)) == key
+    assert math_utils.pack_position(list(pos)) == key
+
+    # Neighbors must never collide with each other
+    neighbor_keys = {math_utils.pack_position(neighbor)
+                     for neighbor in math_utils.get_coordinate_neighbors(pos)}
+    assert len(neighbor_keys) == 6
+    assert key not in neighbor_keys
+
+
 def test_distance():
     """Sanity test"""
     distance = math_utils.distance(np.array([1, 2, 3]), np.array([6, 7, 12]))
     assert distance == 11.445523142259598
 
 
+def test_bounding_box():
+    points = [(1, 5, -2), np.array([-3, 0, 4]), [2, 2, 2]]
+    assert math_utils.bounding_box(points) == ((-3, 0, -2), (2, 5, 4))
+    assert (math_utils.bounding_box(points, padding=1)
+            == ((-4, -1, -3), (3, 6, 5)))
+
+
 @pytest.mark.parametrize(
     argnames=("curr_pos", "curr_angle", "direction", "expected_output"),
     argvalues=[
@@ -1,10 +1,21 @@
+from concurrent.futures import Future
+from multiprocessing.shared_memory import SharedMemory
 from typing import Tuple
 
 import pytest
 import mock
 import numpy as np
 
-from fleet import NavigationTurtle
+from fleet import (
+    NavigationTurtle,
+    StepFinished,
+    UnreachableGoalError,
+    PathBudgetExhaustedError,
+    PlannerService,
+    PathResult,
+    PathStatus,
+    astar
+)
 
 
 @pytest.mark.parametrize(
@@ -83,3 +94,331 @@ def test_turn_toward(map_pos: Tuple[int],
                 assert turn_right.call_count == 1
             elif turn_direction == "either":
                 assert turn_left.call_count + turn_right.call_count == 1
+
+
+def test_move_toward_caches_path():
+    """A path should only be planned once per trip, unless the turtle
+    deviates, the target changes, or an obstacle on the path changes"""
+    turtle = NavigationTurtle()
+    turtle.direction_verified = True
+
+    def move_toward(to_pos):
+        with turtle.state:
+            try:
+                turtle.move_toward(to_pos)
+            except StepFinished:
+                pass
+            return turtle.state.map.read().position.tolist()
+
+    with mock.patch("fleet.navigation_turtle.astar", wraps=astar) as planner:
+        # Walk most of the way there along a single planned path
+        for _ in range(4):
+            move_toward((0, 4, 0))
+        assert move_toward((0, 4, 0)) == [0, 4, 0]
+        assert planner.call_count == 1
+
+        # Changing targets should replan
+        move_toward((0, 0, 0))
+        assert planner.call_count == 2
+
+        # An obstacle appearing on the remaining path should replan
+        with turtle.state as state:
+            map = state.map.read()
+            map.add_obstacle((0, 1, 0))
+            state.map.write(map)
+        move_toward((0, 0, 0))
+        assert planner.call_count == 3
+
+        # ...but obstacles elsewhere don't matter
+        with turtle.state as state:
+            map = state.map.read()
+            map.add_obstacle((5, 5, 5))
+            state.map.write(map)
+        move_toward((0, 0, 0))
+        assert planner.call_count == 3
+
+        # Deviating from the path should replan
+        with turtle.state as state:
+            map = state.map.read()
+            map.move_to((3, 3, 3))
+            state.map.write(map)
+        move_toward((0, 0, 0))
+        assert planner.call_count == 4
+
+        # The cached path should survive a restart
+        position = move_toward((0, 0, 0))
+        turtle = NavigationTurtle()
+        turtle.direction_verified = True
+        with turtle.state as state:
+            map = state.map.read()
+            map.move_to(position)
+            state.map.write(map)
+        move_toward((0, 0, 0))
+        assert planner.call_count == 4
+
+
+def test_move_toward_tunnels_with_one_plan():
+    """Moving through obstacles on the path (as when digging through them)
+    doesn't make the path stale"""
+    turtle = NavigationTurtle()
+    turtle.direction_verified = True
+    with turtle.state as state:
+        map = state.map.read()
+        for x in range(-5, 6):
+            for y in range(1, 4):
+                for z in range(-5, 6):
+                    map.add_obstacle((x, y, z))
+        state.map.write(map)
+
+    with mock.patch("fleet.navigation_turtle.astar", wraps=astar) as planner:
+        for _ in range(10):
+            with turtle.state:
+                with pytest.raises(StepFinished):
+                    turtle.move_toward((0, 4, 0), destructive=True,
+                                       path_obstacle_cost=2)
+                position = turtle.state.map.read().position.tolist()
+            if position == [0, 4, 0]:
+                break
+        else:
+            assert False, "The turtle never arrived!"
+    assert planner.call_count == 1
+
+
+def test_move_toward_incremental_planning():
+    turtle = NavigationTurtle()
+    turtle.INCREMENTAL_PLANNING = True
+    turtle.direction_verified = True
+
+    def move_toward(to_pos):
+        with turtle.state:
+            try:
+                turtle.move_toward(to_pos)
+            except StepFinished:
+                pass
+            return turtle.state.map.read().position.tolist()
+
+    with mock.patch("fleet.navigation_turtle.astar") as planner:
+        move_toward((0, 4, 0))
+        first_planner = turtle._planner
+
+        # Obstacles are repaired into the same planner
+        with turtle.state as state:
+            map = state.map.read()
+            map.add_obstacle((0, 2, 0))
+            state.map.write(map)
+        for _ in range(20):
+            if move_toward((0, 4, 0)) == [0, 4, 0]:
+                break
+        else:
+            assert False, "The turtle never arrived!"
+        assert turtle._planner is first_planner
+
+        # A new target gets a new planner
+        move_toward((0, 0, 0))
+        assert turtle._planner is not first_planner
+        assert planner.call_count == 0
+
+
+def test_move_toward_unreachable_goal():
+    turtle = NavigationTurtle()
+    turtle.direction_verified = True
+    bounds = ((-5, -5, -5), (5, 5, 5))
+
+    with turtle.state:
+        with pytest.raises(UnreachableGoalError):
+            turtle.move_toward((10, 0, 0), path_bounds=bounds)
+
+        # Goals within the bounds are still reachable
+        with pytest.raises(StepFinished):
+            turtle.move_toward((3, 0, 0), path_bounds=bounds)
+
+
+def test_move_toward_budget_exhausted():
+    """Running out of expansions isn't proof that a goal is unreachable"""
+    turtle = NavigationTurtle()
+    turtle.direction_verified = True
+    turtle.PATH_MAX_EXPANSIONS = 1
+    with turtle.state as state:
+        map = state.map.read()
+        for neighbor in [(1, 0, 0), (0, 1, 0), (0, 0, 1),
+                         (-1, 0, 0), (0, -1, 0), (0, 0, -1)]:
+            map.add_obstacle(neighbor)
+        state.map.write(map)
+
+    with turtle.state:
+        with pytest.raises(PathBudgetExhaustedError):
+            turtle.move_toward((10, 0, 0))
+    assert len(turtle._unreachable) == 0
+
+    # With a large enough budget, the turtle digs its way out
+    turtle.PATH_MAX_EXPANSIONS = 1000
+    with turtle.state:
+        with pytest.raises(StepFinished):
+            turtle.move_toward((10, 0, 0), destructive=True)
+
+
+def test_move_toward_heading_aware_planning():
+    """Each turn and each move is one step, so the turtle should arrive in
+    exactly as many steps as astar predicts"""
+    turtle = NavigationTurtle()
+    turtle.HEADING_AWARE_PLANNING = True
+    turtle.direction_verified = True
+    to_pos = (-3, 1, 2)
+
+    with turtle.state:
+        map = turtle.state.map.read()
+        predicted = astar(from_pos=map.position, to_pos=to_pos, map=map,
+                          e_admissibility=1, direction=map.direction)
+
+        for steps in range(1, 20):
+            with pytest.raises(StepFinished):
+                turtle.move_toward(to_pos)
+            if turtle.state.map.read().position.tolist() == list(to_pos):
+                break
+    assert steps == predicted.actions == 8
+
+
+def test_move_toward_registered_depot():
+    """Trips to a depot shouldn't need any path planning, as long as the
+    turtle is within the depot's bounds"""
+    turtle = NavigationTurtle()
+    turtle.direction_verified = True
+    depot = (2, 1, 0)
+    turtle.register_depot(depot, bounds=((-5, -5, -5), (5, 5, 5)))
+
+    with mock.patch("fleet.navigation_turtle.astar", wraps=astar) as planner:
+        with turtle.state:
+            assert turtle.depot_distance(depot) == 3
+            for _ in range(10):
+                with pytest.raises(StepFinished):
+                    turtle.move_toward(depot)
+                if turtle.state.map.read().position.tolist() == list(depot):
+                    break
+            assert turtle.depot_distance(depot) == 0
+        assert planner.call_count == 0
+
+        # Other targets are planned as usual
+        with turtle.state, pytest.raises(StepFinished):
+            turtle.move_toward((0, 0, 0))
+        assert planner.call_count == 1
+
+        with turtle.state, pytest.raises(KeyError):
+            turtle.depot_distance((0, 0, 0))
+
+
+def test_move_toward_hierarchical_planning():
+    """Long trips are planned one cluster at a time"""
+    turtle = NavigationTurtle()
+    turtle.HIERARCHICAL_PLANNING = True
+    turtle.direction_verified = True
+    to_pos = [40, 0, 0]
+
+    with mock.patch("fleet.navigation_turtle.astar") as planner:
+        for _ in range(60):
+            with turtle.state:
+                try:
+                    turtle.move_toward(to_pos)
+                except StepFinished:
+                    pass
+                if turtle.state.map.read().position.tolist() == to_pos:
+                    break
+        else:
+            assert False, "The turtle never arrived!"
+        assert planner.call_count == 0
+
+
+def test_move_toward_planner_service():
+    turtle = NavigationTurtle()
+    turtle.direction_verified = True
+    to_pos = [3, 2, 0]
+
+    with PlannerService(max_workers=1) as service:
+        turtle.PLANNER_SERVICE = service
+        turtle.PLANNER_TIMEOUT = 30
+        with mock.patch("fleet.navigation_turtle.astar") as planner:
+            for _ in range(10):
+                with turtle.state:
+                    with pytest.raises(StepFinished):
+                        turtle.move_toward(to_pos)
+                    if turtle.state.map.read().position.tolist() == to_pos:
+                        break
+            else:
+                assert False, "The turtle never arrived!"
+            assert planner.call_count == 0
+
+        # Closing the turtle frees the last snapshot's shared memory
+        snapshot = turtle._map_snapshot
+        assert snapshot is not None
+        turtle.close()
+        assert snapshot.is_released
+        with pytest.raises(FileNotFoundError):
+            SharedMemory(name=snapshot.name)
+
+
+def test_move_toward_planner_timeout():
+    """While the search isn't ready, the turtle takes greedy steps, and then
+    heads for the closest point on the path once it's ready"""
+    turtle = NavigationTurtle()
+    turtle.direction_verified = True
+    turtle.PLANNER_TIMEOUT = 0
+    turtle.PLANNER_SERVICE = service = mock.MagicMock()
+    to_pos = [3, 0, 0]
+    path = [(0, 0, 0), (0, 1, 0), (1, 1, 0), (2, 1, 0), (3, 1, 0), (3, 0, 0)]
+
+    def move_toward(bounds=None):
+        with turtle.state:
+            with pytest.raises(StepFinished):
+                turtle.move_toward(to_pos, path_bounds=bounds)
+            return tuple(turtle.state.map.read().position.tolist())
+
+    def follow_path(future: Future):
+        future.set_result(PathResult(path=path, obstructed=False,
+                                     status=PathStatus.found, expansions=0))
+        # Turning is a step too, so only count moves
+        with turtle.state as state:
+            visited = [tuple(state.map.read().position.tolist())]
+        for _ in range(20):
+            position = move_toward()
+            if position != visited[-1]:
+                visited.append(position)
+            if position == tuple(to_pos):
+                break
+        return visited[1:]
+
+    def restart():
+        with turtle.state as state:
+            map = state.map.read()
+            map.move_to((0, 0, 0))
+            state.map.write(map)
+        service.submit.return_value = future = Future()
+        return future
+
+    future = restart()
+    assert move_toward() == (1, 0, 0)
+    assert move_toward() == (2, 0, 0)
+    # The end of the path is closer than going back to where it started
+    assert follow_path(future) == [(3, 0, 0)]
+    assert service.submit.call_count == 1
+
+    # If there's no way onto the path, the turtle backtracks instead
+    future = restart()
+    assert move_toward() == (1, 0, 0)
+    with mock.patch("fleet.navigation_turtle.astar") as astar:
+        astar.return_value = PathResult(path=[], obstructed=False,
+                                        status=PathStatus.unreachable,
+                                        expansions=0)
+        assert follow_path(future) == [(0, 0, 0)] + path[1:]
+
+    # Greedy steps stay within the bounds
+    restart()
+    with turtle.state as state:
+        map = state.map.read()
+        map.add_obstacle((1, 0, 0))
+        state.map.write(map)
+    assert move_toward(bounds=((0, -1, 0), (3, 0, 0))) == (0, -1, 0)
+
+    # A search that's still running is cancelled when the turtle closes
+    future = service.submit.return_value
+    turtle.close()
+    assert future.cancelled()
+    assert turtle._search is None
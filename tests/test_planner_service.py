@@ -0,0 +1,107 @@
+import random
+from multiprocessing.shared_memory import SharedMemory
+from time import sleep
+
+import mock
+import pytest
+
+from fleet import Map, PlannerService, PathStatus, astar
+from fleet.planner_service import greedy_step, _attach
+
+
+@pytest.fixture(scope="module")
+def service():
+    with PlannerService(max_workers=1) as service:
+        yield service
+
+
+@pytest.mark.parametrize("chunked", [True, False])
+def test_search_matches_astar(service: PlannerService, chunked: bool):
+    random.seed(0)
+    obstacles = [[random.randint(-10, 10) for _ in range(3)]
+                 for _ in range(2000)]
+    map = Map(position=(0, 0, 0), direction=0, obstacles=obstacles,
+              chunked=chunked)
+    map.remove_obstacle((0, 0, 0))
+    kwargs = dict(from_pos=(0, 0, 0), to_pos=(8, -3, 5), e_admissibility=1,
+                  obstacle_cost=10, bounds=((-10, -10, -10), (10, 10, 10)),
+                  direction=90)
+
+    snapshot = service.snapshot(map)
+    result = service.submit(snapshot, **kwargs).result(timeout=30)
+    snapshot.release()
+
+    expected = astar(map=map, **kwargs)
+    assert result.status is expected.status is PathStatus.found
+    assert result == expected
+    assert result.actions == expected.actions
+
+
+def test_snapshots_are_freed(service: PlannerService):
+    map = Map(position=(0, 0, 0), direction=0, obstacles=[[1, 0, 0]])
+    snapshot = service.snapshot(map)
+    assert snapshot.n_chunks == 1
+    future = service.submit(snapshot, from_pos=(0, 0, 0), to_pos=(2, 0, 0),
+                            e_admissibility=1)
+
+    # Searches keep the snapshot alive after its owner is done with it
+    snapshot.release()
+    assert future.result(timeout=30).path[-1] == (2, 0, 0)
+    for _ in range(100):
+        if snapshot.is_released:
+            break
+        sleep(0.01)
+    assert snapshot.is_released
+    with pytest.raises(FileNotFoundError):
+        SharedMemory(name=snapshot.name)
+
+    # Workers attach to snapshots without the resource tracker, which would
+    # otherwise unlink them when a worker exits
+    snapshot = service.snapshot(map)
+    with mock.patch("multiprocessing.resource_tracker.register") as register:
+        memory = _attach(snapshot.name)
+    memory.close()
+    assert register.call_count == 0
+    snapshot.release()
+    assert snapshot.is_released
+
+    # Empty maps can be snapshotted too
+    snapshot = service.snapshot(Map(position=(0, 0, 0), direction=0))
+    future = service.submit(snapshot, from_pos=(0, 0, 0), to_pos=(0, 3, 0),
+                            e_admissibility=1)
+    assert len(future.result(timeout=30).path) == 4
+    snapshot.release()
+
+
+def test_greedy_step():
+    map = Map(position=(0, 0, 0), direction=0, obstacles=[[1, 0, 0]])
+
+    # Free neighbors closer to the target are preferred
+    assert greedy_step((0, 0, 0), (0, 5, 0), map) == (0, 1, 0)
+    # ...over obstacles, even if those are closer
+    assert greedy_step((0, 0, 0), (5, 0, 0), map) in [
+        (0, 1, 0), (0, -1, 0), (0, 0, 1), (0, 0, -1)]
+    # ...and over places the turtle has already been
+    assert greedy_step((0, 0, 0), (0, 5, 0), map,
+                       avoid=[(0, 1, 0)]) != (0, 1, 0)
+    # Neighbors outside of the bounds are never picked
+    assert greedy_step((0, 0, 0), (0, 5, 0), map,
+                       bounds=((-1, -1, 0), (1, 0, 0))) == (-1, 0, 0)
+    assert greedy_step((0, 0, 0), (0, 5, 0), map,
+                       bounds=((0, 0, 0), (0, 0, 0))) is None
+
+
+def test_shutdown_cancels_pending_searches():
+    map = Map(position=(0, 0, 0), direction=0, obstacles=[[1, 0, 0]])
+    service = PlannerService(max_workers=1)
+    snapshot = service.snapshot(map)
+    futures = [service.submit(snapshot, from_pos=(0, 0, 0),
+                              to_pos=(2, 0, 0), e_admissibility=1)
+               for _ in range(20)]
+    snapshot.release()
+
+    service.shutdown()
+    assert all(future.done() for future in futures)
+    assert any(future.cancelled() for future in futures)
+    assert not service._pending
+    assert snapshot.is_released
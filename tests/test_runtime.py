@@ -0,0 +1,138 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from time import time, sleep as blocking_sleep
+from types import SimpleNamespace
+
+import mock
+import pytest
+from greenlet import greenlet
+from computercraft import ser
+from computercraft.cc import parallel
+from computercraft.sess import CCSession, CCGreenlet, eval_lua
+
+from fleet import runtime
+
+
+def run_turtles(*programs):
+    """Run each program like the computercraft server would run a turtle's
+    program, all on one event loop, until every one of them is done"""
+
+    async def serve():
+        session = CCSession(sender=lambda message: None)
+        for program in programs:
+            CCGreenlet(program, sess=session).switch()
+        while session._greenlets:
+            await asyncio.sleep(0.001)
+
+    asyncio.run(serve())
+
+
+def test_sleep_doesnt_block_other_turtles():
+    events = []
+
+    def program(name, seconds):
+        def run():
+            events.append(f"{name} start")
+            runtime.sleep(seconds)
+            events.append(f"{name} end")
+        return run
+
+    start = time()
+    run_turtles(program("slow", 0.2), program("fast", 0.1))
+    assert time() - start < 0.3
+    assert events == ["slow start", "fast start", "fast end", "slow end"]
+
+
+def test_wait_and_run_blocking():
+    finished_later = Future()
+    never_finished = Future()
+    threading.Timer(0.05, finished_later.set_result, ["done"]).start()
+    results = {}
+
+    def waiter():
+        results["finished"] = runtime.wait(finished_later, timeout=5)
+        results["timed out"] = not runtime.wait(never_finished, timeout=0.05)
+
+    def blocker():
+        results["thread"] = runtime.run_blocking(
+            lambda: (blocking_sleep(0.1), threading.current_thread())[1])
+
+    start = time()
+    run_turtles(waiter, blocker)
+    assert time() - start < 0.2
+    assert results["finished"]
+    assert results["timed out"]
+    assert results["thread"] is not threading.main_thread()
+
+
+
+def test_resumed_turtles_talk_to_the_server():
+    """A turtle that was parked and resumed still gets its round trips
+    answered through the session, and the greenlets it starts are run"""
+    sent = []
+    events = []
+
+    def child():
+        events.append("child")
+
+    def program():
+        runtime.sleep(0.01)
+        parallel.waitForAll(child)
+        events.append(eval_lua(b"return 5").take())
+
+    def requests():
+        return [message for message in sent if message[:1] == b"T"]
+
+    async def serve():
+        session = CCSession(sender=sent.append)
+        CCGreenlet(program, sess=session).switch()
+        for _ in range(100):
+            if requests():
+                break
+            await asyncio.sleep(0.001)
+        assert events == ["child"]
+
+        # Answer the turtle's request like the server does
+        task_id = ser.deserialize(requests()[0][1:])
+        session.on_task_result(task_id, ser.serialize({1: True, 2: 5},
+                                                      "latin1"))
+        assert not session._greenlets
+
+    asyncio.run(serve())
+    assert events == ["child", 5]
+
+
+def test_unknown_sessions_fall_back_to_blocking():
+    """If computercraft's internals aren't what runtime expects, turtles
+    block instead of being parked"""
+
+    def program():
+        with mock.patch("fleet.runtime.os") as os, \
+                pytest.warns(RuntimeWarning, match="_greenlets"):
+            runtime.sleep(0.5)
+            assert os.sleep.call_count == 1
+            assert runtime.run_blocking(threading.current_thread) \
+                is threading.main_thread()
+            assert runtime.wait(Future(), timeout=0.01) is False
+
+    turtle = greenlet(program)
+    turtle.cc_greenlet = SimpleNamespace(_sess=SimpleNamespace(),
+                                         _task_id=b"1",
+                                         switch=turtle.switch)
+    turtle.switch()
+    assert turtle.dead
+
+
+def test_computercraft_has_parking_internals():
+    """Parking relies on computercraft internals. If an upgrade removes them,
+    turtles silently block the server, so catch it here instead."""
+    async def check():
+        session = CCSession(sender=lambda message: None)
+        task = CCGreenlet(lambda: None, sess=session)
+        for attr in runtime._TASK_ATTRS:
+            assert hasattr(task, attr), attr
+        for attr in runtime._SESSION_ATTRS:
+            assert hasattr(session, attr), attr
+
+    asyncio.run(check())
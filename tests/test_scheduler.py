@@ -0,0 +1,56 @@
+import pytest
+from computercraft.errors import LuaException
+
+from fleet import Scheduler, TokenBucket, Backoff, lua_errors
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=10, burst=3)
+
+    # A burst goes through right away, then events are spaced out
+    assert [bucket.reserve(now=0) for _ in range(3)] == [0, 0, 0]
+    assert bucket.reserve(now=0) == pytest.approx(0.1)
+    assert bucket.reserve(now=0) == pytest.approx(0.2)
+
+    # Idling refills the bucket, but never past the burst size
+    assert bucket.reserve(now=10) == 0
+    assert [bucket.reserve(now=10) for _ in range(2)] == [0, 0]
+    assert bucket.reserve(now=10) == pytest.approx(0.1)
+
+    with pytest.raises(ValueError):
+        TokenBucket(rate=0)
+
+
+def test_backoff():
+    backoff = Backoff(base=1, factor=2, max_delay=5,
+                      bases={lua_errors.TurtleBlockedError: 0})
+    error = LuaException("Oh no")
+    assert [backoff.failed(error) for _ in range(5)] == [1, 2, 4, 5, 5]
+
+    # Each exception class is counted separately, and subclasses share their
+    # parent's base
+    assert backoff.failed(ValueError()) == 1
+    assert backoff.failed(lua_errors.TurtleBlockedError("Blocked")) == 0
+
+    backoff.succeeded()
+    assert backoff.failed(error) == 1
+
+
+def test_scheduler_shares_server_budget():
+    """Every turtle has its own bucket, but they all share the server's"""
+    server_budget = TokenBucket(rate=10, burst=2)
+    schedulers = [Scheduler(TokenBucket(rate=100, burst=5),
+                            server_budget=server_budget)
+                  for _ in range(3)]
+
+    waits = [scheduler.before_step(now=0) for scheduler in schedulers]
+    assert waits == pytest.approx([0, 0, 0.1])
+
+    # Without a server budget, only the turtle's own bucket matters
+    scheduler = Scheduler(TokenBucket(rate=1), server_budget=None)
+    assert scheduler.before_step(now=0) == 0
+    assert scheduler.before_step(now=0) == pytest.approx(1)
+
+    # Being blocked is retried right away, other errors back off
+    assert scheduler.failed(lua_errors.TurtleBlockedError("Blocked")) == 0
+    assert scheduler.failed(RuntimeError()) > 0
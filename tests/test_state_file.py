@@ -1,6 +1,17 @@
+import mock
+import numpy as np
 import pytest
 
-from fleet import StateNotAcquiredError, StateFile, StateAttr, Map
+from fleet import (
+    StateNotAcquiredError,
+    StateFile,
+    StateAttr,
+    SideFileStateAttr,
+    Map,
+    JsonCodec,
+    BinaryCodec
+)
+from fleet.math_utils import pack_position
 
 
 def test_basic_usage():
@@ -71,3 +82,400 @@ def test_changing_defaults_doesnt_autocommit_to_file():
                               default=420)
     with state:
         assert state.coolkey.read() == 3
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+def test_side_file_state_attr(chunked: bool):
+    def get_statefile():
+        state = StateFile()
+        state.map = SideFileStateAttr(
+            state, "map",
+            default=Map(position=(0, 0, 0), direction=0, chunked=chunked))
+        return state
+
+    state = get_statefile()
+    with state:
+        map = state.map.read()
+        map.add_obstacle([1, 2, 3])
+        map.add_obstacle([-40, 2, 3])
+        state.map.write(map)
+
+        # Reads before the side-files are flushed still see the changes
+        assert state.map.read().is_known_obstacle([1, 2, 3])
+
+    # The state file only holds a reference, not the obstacles themselves
+    with state:
+        header = state.dict["map"]
+        assert "obstacles" not in header
+        part_paths = [state.map.side_file_dir / header["files"][part]
+                      for part in header["parts"]]
+        assert all(path.is_file() for path in part_paths)
+        assert len(part_paths) == (2 if chunked else 1)
+
+    # Validate it was committed to the filesystem
+    state = get_statefile()
+    with state:
+        map = state.map.read()
+        assert sorted(map.obstacles.tolist()) == [[-40, 2, 3], [1, 2, 3]]
+
+        # Only the part that actually changed should be written
+        part = "chunk.0.0.0.bin" if chunked else "obstacles.npy"
+        old_file = state.dict["map"]["files"][part]
+        map.add_obstacle([2, 2, 3])
+        with mock.patch.object(state, "write_side_file",
+                               wraps=state.write_side_file) as write:
+            state.map.write(map)
+        written = [(call[0][0].name, call[0][1] is not None)
+                   for call in write.call_args_list]
+        # The part goes to a new file, and the one it replaces is deleted
+        new_file = state.dict["map"]["files"][part]
+        assert new_file != old_file
+        assert written == [(old_file, False), (new_file, True)]
+
+        # Emptied chunks are deleted
+        map.remove_obstacle([-40, 2, 3])
+        state.map.write(map)
+
+    with state:
+        assert len(state.dict["map"]["parts"]) == 1
+    # Only the files that the header references are left
+    assert sorted(path.name for path in state.map.side_file_dir.iterdir()) \
+        == sorted(state.dict["map"]["files"].values())
+
+
+def test_side_file_state_attr_is_atomic():
+    """Side-files only take effect once the state that references them is
+    saved, so a save that dies halfway leaves the previous map intact"""
+    def get_statefile():
+        state = StateFile(journaled=True)
+        state.map = SideFileStateAttr(
+            state, "map",
+            default=Map(position=(0, 0, 0), direction=0, chunked=True))
+        return state
+
+    state = get_statefile()
+    with state:
+        map = state.map.read()
+        map.add_obstacle([1, 1, 1])
+        state.map.write(map)
+
+    with mock.patch.object(state, "_append_journal",
+                           side_effect=KeyboardInterrupt):
+        with pytest.raises(KeyboardInterrupt):
+            with state:
+                map = state.map.read()
+                map.add_obstacle([2, 2, 2])
+                map.remove_obstacle([1, 1, 1])
+                state.map.write(map)
+
+    with get_statefile() as reloaded:
+        assert reloaded.map.read().obstacles.tolist() == [[1, 1, 1]]
+    # The files written by the interrupted save are cleaned up
+    assert len(list(reloaded.map.side_file_dir.iterdir())) == 1
+
+
+def test_side_file_state_attr_caches_across_steps():
+    state = StateFile()
+    state.map = SideFileStateAttr(
+        state, "map",
+        default=Map(position=(0, 0, 0), direction=0, chunked=True))
+    with state:
+        map = state.map.read()
+        map.add_obstacle([1, 1, 1])
+        state.map.write(map)
+
+    with mock.patch.object(state, "read_side_file") as read_side_file:
+        # The map stays loaded between steps
+        with state:
+            assert state.map.read() is map
+        assert read_side_file.call_count == 0
+
+    # Changes that weren't written invalidate it
+    with state:
+        map.add_obstacle([2, 2, 2])
+    with state:
+        reread = state.map.read()
+        assert reread is not map
+        assert reread.obstacles.tolist() == [[1, 1, 1]]
+
+
+def test_side_file_state_attr_reads_legacy_state():
+    """Maps written by a regular StateAttr get moved into side-files"""
+    state = StateFile()
+    state.map = StateAttr(
+        state, "map",
+        default=Map(position=(0, 0, 0), direction=0,
+                    obstacles=[[1, 1, 1]]))
+
+    state = StateFile()
+    state.map = SideFileStateAttr(
+        state, "map",
+        default=Map(position=(0, 0, 0), direction=0, chunked=True))
+    with state:
+        map = state.map.read()
+        assert map.obstacles.tolist() == [[1, 1, 1]]
+        state.map.write(map)
+
+    # The map keeps the storage mode it was originally written with
+    with state:
+        assert state.dict["map"]["parts"] == ["obstacles.npy"]
+        assert state.map.read().obstacles.tolist() == [[1, 1, 1]]
+
+
+def test_journaled_state_file():
+    def get_statefile():
+        state = StateFile(journaled=True)
+        state.SNAPSHOT_EVERY_N_RECORDS = 10
+        state.counter = StateAttr(state, "counter", default=0)
+        state.big = StateAttr(state, "big", default=list(range(1000)))
+        return state
+
+    # Registering the two attributes appends two records
+    state = get_statefile()
+    snapshot_path = state._state_path
+    journal_path = state._journal_path
+    snapshot = snapshot_path.read_bytes()
+    journal_size = journal_path.stat().st_size
+
+    for i in range(1, 5):
+        with state:
+            state.counter.write(i)
+
+    # The snapshot wasn't touched, and the journal only got the changed key
+    assert snapshot_path.read_bytes() == snapshot
+    assert b"big" not in journal_path.read_bytes()[journal_size:]
+    with get_statefile() as reloaded:
+        assert reloaded.counter.read() == 4
+        assert reloaded.big.read() == list(range(1000))
+
+    # A partially written record is discarded when reading
+    with state:
+        state.counter.write(100)
+    journal_size = journal_path.stat().st_size
+    with journal_path.open("ab") as file:
+        file.write(b"\x10\x00\x00\x00garbage")
+    reloaded = get_statefile()
+    with reloaded:
+        assert reloaded.counter.read() == 100
+        assert journal_path.stat().st_size == journal_size
+        reloaded.counter.write(5)
+    with get_statefile() as reloaded:
+        assert reloaded.counter.read() == 5
+
+    # Once enough records are written, the journal is compacted
+    for i in range(6, 8):
+        with reloaded:
+            reloaded.counter.write(i)
+    assert not journal_path.exists()
+    assert snapshot_path.read_bytes() != snapshot
+    with get_statefile() as reloaded:
+        assert reloaded.counter.read() == 7
+        assert reloaded.big.read() == list(range(1000))
+
+
+def test_only_written_state_is_saved():
+    state = StateFile()
+    state.big = StateAttr(state, "big", default=list(range(1000)))
+    state.counter = StateAttr(state, "counter", default=0)
+
+    with mock.patch.object(state, "write_dict") as write_dict:
+        # Reading (or doing nothing at all) doesn't save anything
+        with state:
+            state.big.read()
+        assert write_dict.call_count == 0
+
+        with state:
+            state.counter.write(1)
+        assert write_dict.call_count == 1
+
+        # Nothing was written since the last save
+        with state:
+            pass
+        assert write_dict.call_count == 1
+
+
+@pytest.mark.parametrize("journaled", [False, True])
+@pytest.mark.parametrize("codec", [JsonCodec, BinaryCodec])
+def test_only_written_values_are_saved(journaled, codec):
+    """Mutating a value without writing it never saves the mutation, whether
+    or not the state file is journaled"""
+    def get_statefile():
+        state = StateFile(journaled=journaled, codec=codec())
+        state.counter = StateAttr(state, "counter", default=0)
+        state.points = StateAttr(state, "points", default={"a": [1]})
+        state.map = StateAttr(state, "map",
+                              default=Map(position=(0, 0, 0), direction=0))
+        return state
+
+    state = get_statefile()
+    with state:
+        state.points.read()["a"].append(2)
+        map = Map(position=(0, 0, 0), direction=0, obstacles=[[1, 1, 1]])
+        state.map.write(map)
+        # Mutations after a write aren't saved either
+        map.obstacles[0] = [5, 5, 5]
+        state.map.read().add_obstacle([2, 2, 2])
+        # Another key being written saves the whole state file when it isn't
+        # journaled, which mustn't pick up any of the mutations above
+        state.counter.write(1)
+
+    with get_statefile() as reloaded:
+        assert reloaded.counter.read() == 1
+        assert reloaded.points.read() == {"a": [1]}
+        assert reloaded.map.read().obstacles.tolist() == [[1, 1, 1]]
+
+
+def test_read_cache():
+    state = StateFile()
+    state.map = StateAttr(state, "map",
+                          default=Map(position=(0, 0, 0), direction=0))
+
+    with state:
+        with mock.patch.object(Map, "from_dict",
+                               wraps=Map.from_dict) as from_dict:
+            # Repeated reads only deserialize once
+            map = state.map.read()
+            assert state.map.read() is map
+            assert from_dict.call_count == 1
+
+            # Writing invalidates the cache
+            map.add_obstacle([1, 1, 1])
+            state.map.write(map)
+            reread = state.map.read()
+            assert reread is not map
+            assert reread.is_known_obstacle([1, 1, 1])
+            assert from_dict.call_count == 2
+
+    # Releasing the state file clears the cache
+    with state:
+        assert state.map.read() is not reread
+
+
+@pytest.mark.parametrize("attr_type", [StateAttr, SideFileStateAttr])
+def test_transient_state(attr_type):
+    """The map's change log carries over between steps without being saved"""
+    def get_statefile():
+        state = StateFile(journaled=True)
+        state.map = attr_type(state, "map",
+                              default=Map(position=(0, 0, 0), direction=0))
+        return state
+
+    state = get_statefile()
+    with state:
+        map = state.map.read()
+        map.add_obstacle([1, 1, 1])
+        state.map.write(map)
+    with state:
+        assert "changes" not in state.dict["map"]
+        map = state.map.read()
+        assert map.changes_since(0) == [pack_position([1, 1, 1])]
+
+        # Changes that weren't written don't carry over
+        map.add_obstacle([2, 2, 2])
+    with state:
+        map = state.map.read()
+        assert map.version == 1
+        assert map.changes_since(0) == [pack_position([1, 1, 1])]
+
+    # Nor does anything carry over to another process
+    with get_statefile() as reloaded:
+        assert reloaded.map.read().changes_since(0) is None
+
+
+@pytest.mark.parametrize("obj", [
+    None, True, False, 0, -1, 2 ** 63, -2 ** 70, 1.5, "", "Ünïcode", b"\x00",
+    [], [1, [2, "3"]], {"a": {"b": None}, 1: 2.0},
+])
+def test_binary_codec_round_trip(obj):
+    codec = BinaryCodec()
+    assert codec.loads(codec.dumps(obj)) == obj
+
+
+def test_binary_codec_arrays():
+    codec = BinaryCodec()
+    arrays = [np.zeros((0, 3), dtype=np.int64),
+              np.arange(30, dtype=np.int32).reshape(10, 3),
+              np.arange(30, dtype=np.float64).reshape(10, 3).T,
+              np.array([True, False])]
+    loaded = codec.loads(codec.dumps({"arrays": arrays, "tail": "tail"}))
+
+    assert loaded["tail"] == "tail"
+    for array, loaded_array in zip(arrays, loaded["arrays"]):
+        assert array.dtype == loaded_array.dtype
+        assert array.shape == loaded_array.shape
+        assert (array == loaded_array).all()
+
+    with pytest.raises(TypeError):
+        codec.dumps(np.array([object()]))
+
+    # Serializables use the decoded arrays as they are, without copying them
+    map = Map(position=(0, 0, 0), direction=0, obstacles=[[1, 2, 3]])
+    native = codec.loads(codec.dumps(map.to_native_dict()))
+    assert Map.from_dict(native).obstacles is native["obstacles"]
+
+
+def test_state_file_codec_migration():
+    """Test that state saved with one codec is carried over to another"""
+    def get_statefile(codec):
+        state = StateFile(codec=codec)
+        state.map = StateAttr(state, "map", Map(position=(0, 0, 0),
+                                                direction=0))
+        state.count = StateAttr(state, "count", 0)
+        return state
+
+    state = get_statefile(JsonCodec())
+    with state:
+        map = state.map.read()
+        map.add_obstacle((1, 2, 3))
+        state.map.write(map)
+        state.count.write(5)
+
+    for codec in [BinaryCodec(), JsonCodec(), BinaryCodec()]:
+        state = get_statefile(codec)
+        with state:
+            assert state.count.read() == 5
+            map = state.map.read()
+            assert map.obstacles.tolist() == [[1, 2, 3]]
+            map.add_obstacle((4, 5, 6))
+            assert map.is_known_obstacle((1, 2, 3))
+            state.map.write(map)
+            state.count.write(state.count.read())
+
+        # Only the state file of the current codec should remain
+        paths = list(state._state_path.parent.glob("state_file.*"))
+        assert paths == [state._state_path]
+
+        with state:
+            map = state.map.read()
+            map.remove_obstacle((4, 5, 6))
+            state.map.write(map)
+
+
+def test_intents():
+    def get_statefile():
+        state = StateFile(journaled=True)
+        state.counter = StateAttr(state, "counter", default=0)
+        return state
+
+    state = get_statefile()
+    with state:
+        state.record_intent(["add", 1])
+        state.counter.write(1)
+        state.record_intent(["add", 2])
+        assert state.intents == [["add", 1], ["add", 2]]
+
+        # Until the state is saved, the intents are pending
+        reloaded = StateFile(journaled=True)
+        with reloaded:
+            assert reloaded.intents == [["add", 1], ["add", 2]]
+            assert reloaded.dict["counter"] == 0
+    assert state.intents == []
+    with get_statefile() as reloaded:
+        assert reloaded.intents == []
+        assert reloaded.counter.read() == 1
+
+    # Intents are saved even when nothing else changed
+    with state:
+        state.record_intent(["noop"])
+    with get_statefile() as reloaded:
+        assert reloaded.intents == []
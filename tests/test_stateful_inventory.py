@@ -1,6 +1,7 @@
 import pytest
 import mock
 import cc
+from computercraft.errors import LuaException
 
 import fleet
 from fleet import StatefulTurtle, Inventory, Direction, StepFinished
@@ -58,6 +59,66 @@ def test_turtle_refreshes_on_startup():
             assert slot.slot_id == slot_id
 
 
+def test_startup_is_a_single_round_trip():
+    with MockedInventory(item_count_ret=3), \
+            mock.patch("fleet.lua_errors.eval_lua",
+                       wraps=cc.eval_lua) as eval_lua:
+        turtle = StatefulTurtle()
+        assert eval_lua.call_count == 1
+        assert all(slot.count == 3 for slot in turtle.inventory)
+
+
+def test_lazy_resync():
+    """After a dig, slots are only refreshed once an exact count is needed,
+    and then all of them are refreshed at once"""
+    turtle = StatefulTurtle()
+    turtle.inventory.mark_all_slots_unconfirmed()
+
+    with MockedInventory(item_count_ret=7) as mock_inventory, \
+            mock.patch("fleet.lua_errors.eval_lua",
+                       wraps=cc.eval_lua) as eval_lua:
+        assert turtle.inventory.confirmed_slot(16).count == 7
+        assert eval_lua.call_count == 1
+        assert mock_inventory.getItemCount.call_count == 16
+        assert all(slot.confirmed and slot.count == 7
+                   for slot in turtle.inventory)
+
+        # Confirmed slots don't need a round trip
+        assert turtle.inventory.confirmed_slot(3).count == 7
+        assert eval_lua.call_count == 1
+
+        turtle.inventory.refresh_all()
+        assert eval_lua.call_count == 2
+
+
+def test_drop_slots_in_direction():
+    turtle = StatefulTurtle()
+    turtle.select(4)
+
+    with MockedInventory(item_count_ret=0) as mock_inventory, \
+            mock.patch.object(cc.turtle, "dropUp") as drop_up, \
+            mock.patch("fleet.lua_errors.eval_lua",
+                       wraps=cc.eval_lua) as eval_lua:
+        with pytest.raises(StepFinished):
+            turtle.drop_slots_in_direction(Direction.up, range(2, 17))
+        assert eval_lua.call_count == 1
+        assert drop_up.call_count == 15
+
+        # Every slot was refreshed, and the selection was restored
+        assert mock_inventory.getItemCount.call_count == 15
+        assert [call[0] for call in mock_inventory.select.call_args_list] \
+            == [(slot_id,) for slot_id in range(2, 17)] + [(4,)]
+        assert turtle.inventory.selected_id == 4
+        assert all(slot.count == 0 and slot.confirmed
+                   for slot in turtle.inventory if slot.slot_id != 1)
+
+        # If a slot can't be selected, the turtle still knows which one is
+        mock_inventory.select.side_effect = [None, LuaException("Bad slot")]
+        with pytest.raises(LuaException):
+            turtle.drop_slots_in_direction(Direction.up, [7, 8])
+        assert turtle.inventory.selected_id == 7
+
+
 def test_select():
     with MockedInventory() as mocks:
         turtle = StatefulTurtle()
@@ -1,4 +1,6 @@
+import json
 from functools import partial
+from math import inf
 from typing import Tuple
 
 import mock
@@ -14,7 +16,9 @@ from fleet import (
     StepFinished,
     StateRecoveryError,
     lua_errors,
-    MinedBlacklistedBlockError
+    MinedBlacklistedBlockError,
+    ColumnStop,
+    JsonCodec
 )
 
 
@@ -341,3 +345,338 @@ def test_dir_uncorrupted_on_move_forward_or_backward(
             # here. This code path will be better checked in another test
             # dedicated to this
             raise NotImplementedError()
+
+
+@pytest.mark.parametrize(
+    argnames=("column", "full_after", "expected_stop", "expected_moves",
+              "expected_dug"),
+    argvalues=[
+        # Dig all the way down, through stone and air
+        (["stone", None, "stone", "stone"], None, ColumnStop.finished, 3, 2),
+        # Stop above bedrock, and above anything blacklisted
+        (["stone", "bedrock", "stone"], None, ColumnStop.unbreakable, 1, 1),
+        (["stone", "cool:chest"], None, ColumnStop.blacklisted, 1, 1),
+        # Stop once the last slot has something in it
+        (["stone", "stone", "stone"], 2, ColumnStop.inventory_full, 2, 2),
+        # Stop when a move fails, such as when a mob walks in after digging
+        (["stone", "mob"], None, ColumnStop.blocked, 1, 2),
+    ]
+)
+def test_dig_column(column, full_after, expected_stop, expected_moves,
+                    expected_dug):
+    """Dig down a column where `column` is the block below the turtle at
+    each depth, in a single round trip"""
+    turtle = StatefulTurtle()
+    depth = 0
+    dug = set()
+
+    def block_below():
+        name = column[depth]
+        if name is None or depth in dug:
+            return None
+        return {**cc.MOCK_INSPECT_VAL, b"name": name.encode()}
+
+    def dig_down():
+        if block_below() is None:
+            raise LuaException("Nothing to dig here")
+        if column[depth] == "bedrock":
+            raise LuaException(
+                lua_errors.TO_LUA[lua_errors.UnbreakableBlockError])
+        dug.add(depth)
+
+    def down():
+        nonlocal depth
+        if column[depth] == "mob":
+            raise LuaException(
+                lua_errors.TO_LUA[lua_errors.TurtleBlockedError])
+        depth += 1
+
+    def item_count(slot_id):
+        return int(slot_id == 16 and full_after is not None
+                   and len(dug) >= full_after)
+
+    with mock.patch("fleet.macros.eval_lua", wraps=cc.eval_lua) as eval_lua, \
+            mock.patch.object(cc.turtle, "inspectDown",
+                              side_effect=block_below), \
+            mock.patch.object(cc.turtle, "digDown", side_effect=dig_down), \
+            mock.patch.object(cc.turtle, "down", side_effect=down), \
+            mock.patch.object(cc.turtle, "getItemCount",
+                              side_effect=item_count), \
+            turtle.state as state:
+        result = turtle.dig_column(Direction.down, max_moves=3,
+                                   stop_slot=16)
+        map = state.map.read()
+
+    assert eval_lua.call_count == 1
+    assert result.stop is expected_stop
+    assert result.moves == expected_moves
+    assert result.dug == expected_dug
+    assert (map.position == (0, -expected_moves, 0)).all()
+    next_position = (0, -expected_moves - 1, 0)
+    assert map.is_known_obstacle(next_position) == (
+        expected_stop in (ColumnStop.unbreakable, ColumnStop.blacklisted,
+                          ColumnStop.blocked))
+    assert turtle.inventory.slot(1).confirmed == (expected_dug == 0)
+
+
+def test_fuel_estimate():
+    """The fuel level is tracked as the turtle moves, and only checked with
+    the turtle once in a while, or when it's close to a threshold"""
+    turtle = StatefulTurtle()
+    turtle.FUEL_CHECK_INTERVAL = 5
+
+    with mock.patch.object(cc.turtle, "getFuelLevel",
+                           return_value=1000) as get_fuel_level, \
+            turtle.state as state:
+        # The first check has nothing to go off of
+        assert turtle.fuel_level() == 1000
+        assert get_fuel_level.call_count == 1
+
+        for _ in range(3):
+            with pytest.raises(StepFinished):
+                turtle.move_in_direction(Direction.up)
+        assert turtle.fuel_level() == 997
+        assert state.fuel.read() == 997
+        assert get_fuel_level.call_count == 1
+
+        # Close to a threshold, the real level is used
+        assert turtle.fuel_level(threshold=990) == 1000
+        assert get_fuel_level.call_count == 2
+
+        # As it is after moving too often without a check
+        for _ in range(5):
+            with pytest.raises(StepFinished):
+                turtle.move_in_direction(Direction.down)
+        assert turtle.fuel_level() == 1000
+        assert get_fuel_level.call_count == 3
+
+        # Far below a threshold, the estimate is trusted too
+        assert turtle.fuel_level(threshold=5000) == 1000
+        assert get_fuel_level.call_count == 3
+
+        # Refueling reads the new level in the same round trip
+        get_fuel_level.return_value = 1080
+        with mock.patch("fleet.lua_errors.eval_lua",
+                        wraps=cc.eval_lua) as eval_lua, \
+                pytest.raises(StepFinished):
+            turtle.refuel(1)
+        assert eval_lua.call_count == 1
+        assert turtle.fuel_level() == 1080
+        assert get_fuel_level.call_count == 4
+
+        # Fuel might be disabled on the server, which the library's
+        # turtle.getFuelLevel() can't read, so the level is read in Lua
+        get_fuel_level.return_value = b"unlimited"
+        with mock.patch("fleet.lua_errors.eval_lua",
+                        wraps=cc.eval_lua) as eval_lua:
+            assert turtle.fuel_level(threshold=1080) == inf
+        assert eval_lua.call_args[0][0] == lua_errors.BATCH_LUA
+        with pytest.raises(StepFinished):
+            turtle.move_in_direction(Direction.up)
+        assert turtle.fuel_level(threshold=1080) == inf
+        assert get_fuel_level.call_count == 5
+
+
+def test_gps_verification():
+    """The position is dead reckoned, and only checked with GPS every
+    GPS_CHECK_INTERVAL moves, or after being blocked too many times in a row.
+    Drift is corrected and recorded."""
+    turtle = StatefulTurtle()
+    turtle.GPS_CHECK_INTERVAL = 3
+    turtle.GPS_BLOCKED_LIMIT = 2
+
+    with mock.patch.object(cc.gps, "locate",
+                           return_value=(0, 2, 0)) as gps_locate, \
+            turtle.state as state:
+        for _ in range(2):
+            with pytest.raises(StepFinished):
+                turtle.move_in_direction(Direction.up)
+        assert gps_locate.call_count == 0
+
+        # The map agrees with GPS on the third move
+        gps_locate.return_value = (0, 3, 0)
+        with pytest.raises(StepFinished):
+            turtle.move_in_direction(Direction.up)
+        assert gps_locate.call_count == 1
+        assert turtle.gps_checks == 1
+        assert turtle.drifts == []
+
+        # Then the turtle is blocked, but it's not where it thinks it is
+        gps_locate.return_value = (5, 3, 0)
+        with mock.patch.object(cc.turtle, "up") as up:
+            up.side_effect = LuaException(
+                lua_errors.TO_LUA[lua_errors.TurtleBlockedError])
+            with pytest.raises(lua_errors.TurtleBlockedError):
+                turtle.move_in_direction(Direction.up)
+            assert gps_locate.call_count == 1
+            with pytest.raises(lua_errors.TurtleBlockedError):
+                turtle.move_in_direction(Direction.up)
+        assert gps_locate.call_count == 2
+        assert len(turtle.drifts) == 1
+        assert turtle.drifts[0].tolist() == [5, 0, 0]
+        map = state.map.read()
+        assert map.position.tolist() == [5, 3, 0]
+        # The obstacle was recorded where the turtle thought it was, so it's
+        # forgotten again
+        assert not map.is_known_obstacle([0, 4, 0])
+
+        # Obstacles that were known before the turtle got blocked are kept,
+        # as are the ones found when GPS agrees with the map
+        map.add_obstacle([5, 4, 0])
+        state.map.write(map)
+        with mock.patch.object(cc.turtle, "up") as up, \
+                mock.patch.object(cc.turtle, "forward") as forward:
+            up.side_effect = forward.side_effect = LuaException(
+                lua_errors.TO_LUA[lua_errors.TurtleBlockedError])
+            with pytest.raises(lua_errors.TurtleBlockedError):
+                turtle.move_in_direction(Direction.up)
+            with pytest.raises(lua_errors.TurtleBlockedError):
+                turtle.move_in_direction(Direction.front)
+        assert gps_locate.call_count == 3
+        assert len(turtle.drifts) == 1
+        map = state.map.read()
+        assert map.is_known_obstacle([5, 4, 0])
+        assert map.is_known_obstacle([6, 3, 0])
+
+        # GPS being unavailable doesn't stop the turtle
+        gps_locate.return_value = None
+        assert turtle.verify_position() is None
+        assert turtle.gps_checks == 3
+        assert state.map.read().position.tolist() == [5, 3, 0]
+
+
+def test_multi_action_steps():
+    """Several actions can be performed in a step, with the state saved once.
+    If the turtle dies before the state is saved, the actions are recovered
+    from their intents."""
+
+    class TurningTurtle(StatefulTurtle):
+        ACTIONS_PER_STEP = 3
+
+        def step(self, state):
+            self.turn_right()
+
+    turtle = TurningTurtle()
+    with mock.patch.object(turtle.state, "record_intent",
+                           wraps=turtle.state.record_intent) as record_intent, \
+            mock.patch.object(turtle.state, "_append_journal",
+                              wraps=turtle.state._append_journal) as save:
+        turtle.run_step()
+    # Three intents, then a single save
+    assert record_intent.call_count == 3
+    assert save.call_count == 1
+    with StatefulTurtle().state as state:
+        assert state.map.read().direction == 270
+        assert state.intents == []
+
+    # Die partway through a step, after the third turn was started
+    turtle.state.__enter__()
+    for _ in range(3):
+        with pytest.raises(StepFinished):
+            turtle.step(turtle.state)
+    assert len(turtle.state.intents) == 3
+
+    # The first two turns are known to have finished
+    with mock.patch.object(cc.turtle, "getFuelLevel", return_value=10):
+        recovered = StatefulTurtle()
+        with recovered.state as state:
+            assert state.map.read().direction == (270 + 180) % 360
+            assert state.intents == []
+            assert recovered.fuel_level() == 10
+
+
+def test_generator_steps():
+    """A generator step keeps its local variables between actions, and only
+    its resume points survive a restart"""
+    started = []
+
+    class PatrolTurtle(StatefulTurtle):
+        def step(self, state):
+            first_leg = state.resume_point.read().get("leg", 0)
+            started.append(first_leg)
+            for leg in range(first_leg, 4):
+                self.turn_right(end_step=False)
+                yield {"leg": leg + 1}
+            # Step-ending methods can be used until they're done
+            result = yield from self.until_done(end_after_two_calls)
+            assert result == "done"
+
+    calls = []
+
+    def end_after_two_calls():
+        calls.append(None)
+        if len(calls) <= 2:
+            raise StepFinished()
+        return "done"
+
+    turtle = PatrolTurtle()
+    turtle.run_step()
+    turtle.run_step()
+    assert started == [0]
+    with turtle.state as state:
+        assert state.map.read().direction == 180
+        assert state.resume_point.read() == {"leg": 2}
+
+    # After a restart, the step starts over from the last resume point
+    turtle = PatrolTurtle()
+    for _ in range(4):
+        turtle.run_step()
+    assert started == [0, 2]
+    assert len(calls) == 2
+    with turtle.state as state:
+        assert state.map.read().direction == 0
+        assert state.resume_point.read() == {"leg": 4}
+
+    # Once the generator is done, its resume point is cleared and it starts
+    # over on the next step
+    turtle.run_step()
+    assert len(calls) == 3
+    turtle.run_step()
+    assert started == [0, 2, 0]
+    with turtle.state as state:
+        assert state.resume_point.read() == {"leg": 1}
+
+
+def test_inspect_all():
+    """Every direction is inspected in a single round trip"""
+    turtle = StatefulTurtle()
+    with mock.patch("fleet.lua_errors.eval_lua",
+                    wraps=cc.eval_lua) as eval_lua, \
+            mock.patch.object(cc.turtle, "inspectUp", return_value=None), \
+            mock.patch.object(cc.turtle, "inspectDown") as inspect_down:
+        blocks = turtle.inspect_all(
+            [Direction.front, Direction.up, Direction.down])
+        assert eval_lua.call_count == 1
+        assert blocks == {Direction.front: cc.MOCK_INSPECT_VAL,
+                          Direction.up: None,
+                          Direction.down: inspect_down.return_value}
+
+        # Nothing to inspect means nothing to send
+        assert turtle.inspect_all([]) == {}
+        assert eval_lua.call_count == 1
+
+        with pytest.raises(ValueError):
+            turtle.inspect_all([Direction.left])
+
+
+def test_debug_state_format():
+    """State can be kept in a plain JSON file, for debugging"""
+
+    class DebugTurtle(StatefulTurtle):
+        STATE_JOURNALED = False
+        STATE_CODEC = JsonCodec
+        MAP_CHUNKED = False
+        MAP_SIDE_FILES = False
+        ACTIONS_PER_STEP = 2
+
+        def step(self, state):
+            self.move_in_direction(Direction.up)
+
+    turtle = DebugTurtle()
+    turtle.run_step()
+    assert not turtle.state.journaled
+    assert not turtle.state._journal_path.exists()
+    saved = json.loads(turtle.state._state_path.read_text())
+    assert saved["map"]["position"] == [0, 2, 0]
+    assert saved["map"]["chunked"] is False
+    assert "obstacles" in saved["map"]